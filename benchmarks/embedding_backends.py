@@ -0,0 +1,133 @@
+'''
+Compares the embedding backends on the scraped corpus: model load time, passage throughput,
+single-query latency and peak RSS of each backend, plus recall@k of its search results
+against the fp32 PyTorch model.
+
+Each backend runs in its own process, so load time and peak RSS are measured in isolation.
+
+Usage:
+    python benchmarks/embedding_backends.py --passages 1000 --k 10 --output embedding_backends.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.queries import QUERIES
+from utils.corpus import CORPUS_PATH, iter_records
+from vector_dbs.chunking import iter_chunks
+from vector_dbs.embeddings import EMBEDDING_BACKENDS, EMBEDDING_MODEL, load_sentence_transformer
+
+
+def load_passages(corpus_path, limit):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    passages = []
+    for chunk in iter_chunks(iter_records(corpus_path), tokenizer):
+        passages.append(chunk['text'])
+        if len(passages) == limit:
+            break
+    return passages
+
+
+def _run_backend(backend, passages, queries, results):
+    start = time.perf_counter()
+    model = load_sentence_transformer(backend)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    passage_vectors = model.encode(passages, batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+    passage_seconds = time.perf_counter() - start
+
+    query_vectors = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        query_vectors.append(model.encode([query], normalize_embeddings=True, convert_to_numpy=True)[0])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    results.put({
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "passages_per_second": len(passages) / passage_seconds,
+        "query_latency_ms_p50": float(np.percentile(latencies, 50)),
+        "query_latency_ms_p95": float(np.percentile(latencies, 95)),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "passage_vectors": passage_vectors,
+        "query_vectors": np.stack(query_vectors),
+    })
+
+
+def run_backend(backend, passages, queries):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_backend, args=(backend, passages, queries, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def top_k(query_vectors, passage_vectors, k):
+    scores = query_vectors @ passage_vectors.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall_at_k(found, reference):
+    return float(np.mean([len(set(f) & set(r)) / len(r) for f, r in zip(found, reference)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs. latency comparison of the embedding backends.")
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--backends', nargs='+', choices=EMBEDDING_BACKENDS, default=list(EMBEDDING_BACKENDS))
+    parser.add_argument('--passages', type=int, default=1000, help="Number of corpus chunks to embed.")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--output', help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    passages = load_passages(args.corpus, args.passages)
+    k = min(args.k, len(passages))
+    print(f"Benchmarking {len(args.backends)} backends on {len(passages)} passages and {len(QUERIES)} queries (k={k}).")
+
+    # The fp32 model is the reference every other backend is compared against
+    backends = ['torch'] + [backend for backend in args.backends if backend != 'torch']
+    runs = {backend: run_backend(backend, passages, QUERIES) for backend in backends}
+    reference = runs['torch']
+    reference_top_k = top_k(reference["query_vectors"], reference["passage_vectors"], k)
+
+    report = []
+    for backend in backends:
+        run = runs.pop(backend)
+        # Queries from this backend against the existing fp32 index, and a full index rebuilt with this backend
+        query_only = top_k(run["query_vectors"], reference["passage_vectors"], k)
+        full = top_k(run["query_vectors"], run["passage_vectors"], k)
+        run.pop("query_vectors")
+        run.pop("passage_vectors")
+        run[f"recall@{k}_queries_only"] = recall_at_k(query_only, reference_top_k)
+        run[f"recall@{k}_full_index"] = recall_at_k(full, reference_top_k)
+        report.append(run)
+
+    print(f"\n{'backend':<10} {'load s':>7} {'passages/s':>11} {'query p50 ms':>13} {'query p95 ms':>13} "
+          f"{'peak RSS MB':>12} {'recall q-only':>14} {'recall full':>12}")
+    for run in report:
+        print(f"{run['backend']:<10} {run['load_seconds']:>7.1f} {run['passages_per_second']:>11.1f} "
+              f"{run['query_latency_ms_p50']:>13.1f} {run['query_latency_ms_p95']:>13.1f} {run['peak_rss_mb']:>12.0f} "
+              f"{run[f'recall@{k}_queries_only']:>14.3f} {run[f'recall@{k}_full_index']:>12.3f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
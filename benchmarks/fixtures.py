@@ -0,0 +1,102 @@
+'''
+Offline copy of the "Dog Owners" section of the MSD Veterinary Manual for the benchmarks: HTML
+pages with the same structure as the live site (section index, chapter pages linking to topics,
+topic pages with the content element the scraper extracts), built from a saved corpus snapshot
+and served from a local HTTP server, so the scraper can crawl it without network access.
+'''
+import html
+import json
+import os
+import sys
+from urllib.parse import urlparse
+from aiohttp import web
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scrapers.scraper import CONTENT_CLASS
+
+SNAPSHOT_PATH = "archive/old2.json"
+# Navigation and footer repeated on every page, as on the live site
+BOILERPLATE = ('<nav><a href="/dog-owners">Dog Owners</a> <a href="/veterinary-professionals">Veterinary Professionals</a></nav>',
+               '<footer><p>Copyright © 2023 Merck &amp; Co., Inc., Rahway, NJ, USA and its affiliates. All rights reserved.</p></footer>')
+
+
+def _page(title, body):
+    return (f'<!DOCTYPE html><html><head><title>{html.escape(title)}</title></head><body>{BOILERPLATE[0]}'
+            f'<h1>{html.escape(title)}</h1>{body}{BOILERPLATE[1]}</body></html>')
+
+
+def _links(items):
+    return '<ul>' + ''.join(f'<li><a href="{path}">{html.escape(text)}</a></li>' for path, text in items) + '</ul>'
+
+
+def load_snapshot(path=SNAPSHOT_PATH, max_topics=None):
+    '''
+    Returns {chapter: {topic: (url path, [paragraphs])}} from a paragraph-level corpus snapshot
+    (records with 'url', 'chapter', 'topic' and 'text'), keeping the first `max_topics` topics.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    chapters = {}
+    num_topics = 0
+    for record in records:
+        topics = chapters.setdefault(record['chapter'], {})
+        if record['topic'] not in topics:
+            if max_topics is not None and num_topics >= max_topics:
+                continue
+            topics[record['topic']] = (urlparse(record['url']).path, [])
+            num_topics += 1
+        topics[record['topic']][1].append(record['text'])
+    return {chapter: topics for chapter, topics in chapters.items() if topics}
+
+
+def build_site(chapters):
+    '''
+    Returns {url path: page HTML} of the fixture site.
+    '''
+    pages = {}
+    chapter_links = []
+    for chapter, topics in chapters.items():
+        chapter_path = os.path.dirname(next(iter(topics.values()))[0])
+        chapter_links.append((chapter_path, chapter))
+        pages[chapter_path] = _page(chapter, _links((path, topic) for topic, (path, _) in topics.items()))
+        for topic, (path, paragraphs) in topics.items():
+            content = f'<h2>{html.escape(topic)}</h2>' + ''.join(f'<p>{html.escape(text)}</p>' for text in paragraphs)
+            pages[path] = _page(topic, f'<div class="{CONTENT_CLASS}">{content}</div>')
+    pages['/dog-owners'] = _page("Dog Owners", _links(chapter_links))
+    return pages
+
+
+class FixtureServer:
+    '''
+    Serves the fixture pages on an ephemeral localhost port and counts the requests it answered.
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = 0
+        self.base_url = None
+        self._runner = None
+
+    async def _handle(self, request):
+        self.requests += 1
+        page = self.pages.get(request.path.rstrip('/') or '/')
+        if page is None:
+            raise web.HTTPNotFound()
+        return web.Response(text=page, content_type='text/html')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,154 @@
+'''
+Import-time profile of the CLI: for each action, imports the module that action runs in a fresh
+interpreter with `python -X importtime` and reports the total import time, the wall time of the
+process and the slowest imports (by cumulative time). `main.py --help` is measured too, since it
+should import nothing but argparse.
+
+Pass budgets to catch regressions, e.g. in CI; the script exits with status 1 when an action
+imports slower than its budget (or fails to import at all):
+    python benchmarks/import_time.py --budget-ms help=100 ask=150 consult=4000 --output import_time.json
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --actions consult serve --repeat 5 --top 15
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Module each CLI action imports when it runs (see main.py)
+ACTION_MODULES = {
+    'help': None,
+    'scrape': 'scrapers.scraper',
+    'create_db': 'vector_dbs.faiss_db',
+    'consult': 'services.agent',
+    'serve': 'services.server',
+    'ask': 'services.client',
+}
+
+
+def parse_importtime(stderr):
+    '''
+    Returns [(module, nesting depth, self µs, cumulative µs)] from the `-X importtime` report on stderr.
+    '''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|', 2)
+        # Nested imports are indented by two more spaces per level under the module that imported them
+        name = module.lstrip()
+        imports.append((name, (len(module) - len(name) - 1) // 2, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def profile(module):
+    '''
+    Imports `module` (or runs `main.py --help`) once in a fresh interpreter.
+    Returns (wall time in ms, parsed `-X importtime` report); raises RuntimeError if it fails.
+    '''
+    if module is None:
+        command = [sys.executable, '-X', 'importtime', os.path.join(ROOT, 'main.py'), '--help']
+    else:
+        command = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        error = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError(error[-1] if error else f"exit status {result.returncode}")
+    return wall_ms, parse_importtime(result.stderr)
+
+
+def measure(module, repeat, top):
+    '''
+    Profiles an action `repeat` times and reports the median; the slowest imports come from the
+    median run. Top-level imports are the ones not nested in another, so they add up to the total.
+    '''
+    runs = []
+    for _ in range(repeat):
+        wall_ms, imports = profile(module)
+        total_us = sum(cumulative for _, depth, _, cumulative in imports if depth == 0)
+        runs.append((total_us / 1000, wall_ms, imports))
+    runs.sort(key=lambda run: run[0])
+    import_ms, wall_ms, imports = runs[len(runs) // 2]
+    slowest = sorted(imports, key=lambda entry: entry[3], reverse=True)[:top]
+    return {
+        "module": module or "main.py --help",
+        "import_ms": import_ms,
+        "wall_ms": statistics.median(run[1] for run in runs),
+        "modules": len(imports),
+        "slowest": [{"module": name, "self_ms": self_us / 1000, "cumulative_ms": cumulative_us / 1000}
+                    for name, _, self_us, cumulative_us in slowest],
+    }
+
+
+def parse_budgets(values):
+    budgets = {}
+    for value in values or []:
+        action, _, ms = value.partition('=')
+        if action not in ACTION_MODULES or not ms:
+            raise argparse.ArgumentTypeError(f"Budgets look like 'action=ms' with an action in: {', '.join(ACTION_MODULES)}.")
+        budgets[action] = float(ms)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of each CLI action.")
+    parser.add_argument('--actions', nargs='+', choices=list(ACTION_MODULES), default=list(ACTION_MODULES),
+                        help="Actions to profile (default: all).")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per action; the median is reported (default: 3).")
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of slowest imports listed per action (default: 10).")
+    parser.add_argument('--budget-ms', nargs='+', default=None,
+                        help="Import-time budgets such as 'consult=4000'; exceeding one exits with status 1.")
+    parser.add_argument('--output', default=None,
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+    try:
+        budgets = parse_budgets(args.budget_ms)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    results = {}
+    failures = []
+    for action in args.actions:
+        try:
+            result = measure(ACTION_MODULES[action], args.repeat, args.top)
+        except RuntimeError as e:
+            print(f"\n{action}: import failed ({e})")
+            results[action] = {"module": ACTION_MODULES[action], "error": str(e)}
+            failures.append(action)
+            continue
+        results[action] = result
+        print(f"\n{action} ({result['module']}): imports {result['import_ms']:.0f} ms, "
+              f"process {result['wall_ms']:.0f} ms, {result['modules']} modules")
+        for entry in result["slowest"]:
+            print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']} (self {entry['self_ms']:.1f} ms)")
+
+        budget = budgets.get(action)
+        if budget is not None:
+            result["budget_ms"] = budget
+            if result["import_ms"] > budget:
+                print(f"  over budget: {result['import_ms']:.0f} ms > {budget:.0f} ms")
+                failures.append(action)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"python": sys.version.split()[0], "actions": results}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if failures:
+        print(f"\nImport-time check failed for: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
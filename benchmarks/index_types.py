@@ -0,0 +1,133 @@
+'''
+Measures recall@k against the exact flat index, p50/p99 single-query search latency, build time
+and index size for the FAISS index types supported by create_db, over a sweep of nprobe/efSearch.
+
+Passage vectors come from the embedding cache filled by `create_db`, so re-running the benchmark
+with other settings costs almost no model inference.
+
+Usage:
+    python benchmarks/index_types.py --k 10 --sample-queries 500 --output index_types.json
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import faiss
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.queries import QUERIES
+from utils.corpus import CORPUS_PATH, iter_records
+from vector_dbs.chunking import iter_chunks
+from vector_dbs.embedding_cache import CachedEmbeddings
+from vector_dbs.embeddings import DEFAULT_BACKEND, EMBEDDING_MODEL, cache_model_key, load_embeddings
+from vector_dbs.index_factory import build_faiss_index, factory_string, set_search_params
+
+SWEEPS = {
+    'ivf': ('nprobe', [1, 4, 16, 64]),
+    'hnsw': ('efSearch', [16, 32, 64, 128]),
+    'ivfpq': ('nprobe', [4, 16, 64]),
+    'ivfopq': ('nprobe', [4, 16, 64]),
+}
+
+
+def load_vectors(corpus_path, backend, sample_queries, seed=0):
+    '''
+    Returns (passage vectors, query vectors): the benchmark queries plus a random sample of passages used as queries.
+    '''
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    passages = [chunk['text'] for chunk in iter_chunks(iter_records(corpus_path), tokenizer)]
+
+    embeddings = CachedEmbeddings(load_embeddings(backend), cache_model_key(EMBEDDING_MODEL, backend))
+    passage_vectors = np.asarray(embeddings.embed_documents(passages), dtype=np.float32)
+    query_vectors = np.asarray([embeddings.embed_query(query) for query in QUERIES], dtype=np.float32)
+    print(f"Embedding cache: {embeddings.stats()}")
+
+    rng = np.random.default_rng(seed)
+    sampled = rng.choice(len(passage_vectors), size=min(sample_queries, len(passage_vectors)), replace=False)
+    return passage_vectors, np.concatenate([query_vectors, passage_vectors[sampled]])
+
+
+def search_latencies(index, query_vectors, k):
+    '''
+    Searches one query at a time, the way the consult agent does, and returns (results, latencies in ms).
+    '''
+    results = []
+    latencies = []
+    for query in query_vectors:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    return np.stack(results), np.asarray(latencies)
+
+
+def recall_at_k(found, reference):
+    return float(np.mean([len(set(f) & set(r)) / len(r) for f, r in zip(found, reference)]))
+
+
+def measure(index_type, index, build_seconds, params, query_vectors, reference, k):
+    set_search_params(index, params)
+    found, latencies = search_latencies(index, query_vectors, k)
+    return {
+        "index_type": index_type,
+        "params": params,
+        "build_seconds": build_seconds,
+        "index_mb": faiss.serialize_index(index).nbytes / 1024 ** 2,
+        f"recall@{k}": recall_at_k(found, reference),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall/latency benchmark of the FAISS index types.")
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--embedding-backend', default=DEFAULT_BACKEND)
+    parser.add_argument('--index-types', nargs='+', choices=list(SWEEPS), default=['ivf', 'hnsw', 'ivfpq'],
+                        help="Index types to compare with the flat index ('ivfopq' trains slowly on large vectors).")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--sample-queries', type=int, default=500, help="Number of passages to reuse as extra queries.")
+    parser.add_argument('--output', help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    passage_vectors, query_vectors = load_vectors(args.corpus, args.embedding_backend, args.sample_queries)
+    k = min(args.k, len(passage_vectors))
+    print(f"Benchmarking on {len(passage_vectors)} passages and {len(query_vectors)} queries (k={k}).")
+
+    start = time.perf_counter()
+    flat = build_faiss_index('flat', passage_vectors)
+    flat_build_seconds = time.perf_counter() - start
+    reference, _ = search_latencies(flat, query_vectors, k)
+
+    report = [measure('flat', flat, flat_build_seconds, {}, query_vectors, reference, k)]
+    for index_type in args.index_types:
+        start = time.perf_counter()
+        index = build_faiss_index(index_type, passage_vectors)
+        build_seconds = time.perf_counter() - start
+        print(f"Built {index_type} index ({factory_string(index_type, len(passage_vectors), passage_vectors.shape[1])}) "
+              f"in {build_seconds:.1f}s.")
+
+        name, values = SWEEPS[index_type]
+        for value in values:
+            report.append(measure(index_type, index, build_seconds, {name: value}, query_vectors, reference, k))
+
+    print(f"\n{'index':<8} {'params':<16} {'build s':>8} {'size MB':>8} {f'recall@{k}':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for row in report:
+        params = ','.join(f"{name}={value}" for name, value in row['params'].items()) or '-'
+        print(f"{row['index_type']:<8} {params:<16} {row['build_seconds']:>8.1f} {row['index_mb']:>8.1f} "
+              f"{row[f'recall@{k}']:>10.3f} {row['latency_ms_p50']:>8.2f} {row['latency_ms_p99']:>8.2f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
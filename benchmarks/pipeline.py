@@ -0,0 +1,291 @@
+'''
+End-to-end benchmark of the pipeline on a fixed corpus snapshot, offline: scrapes the fixture copy
+of the manual (see benchmarks/fixtures.py) from a local server, chunks and deduplicates the corpus,
+embeds the chunks, builds and saves the index, runs the golden queries in English and Ukrainian
+through retrieval and through the consult service with the stub LLM.
+
+For each stage it reports wall time, throughput and the peak RSS of the process so far; retrieval
+and answering also report p50/p95/p99 latency, and retrieval the recall@k of the golden set per
+language (a query counts as found when a retrieved chunk belongs to one of its expected topics).
+Everything is written as JSON; with `--baseline` the run is compared with an earlier one.
+
+The embedding model must be available in the local Hugging Face cache (or downloadable). Chunks
+are embedded into a fresh, temporary embedding cache, so embedding time is measured cold.
+
+Usage:
+    python benchmarks/pipeline.py --output pipeline.json
+    python benchmarks/pipeline.py --topics 40 --index-type hnsw --baseline pipeline.json --output pipeline_new.json
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.fixtures import SNAPSHOT_PATH, FixtureServer, build_site, load_snapshot
+from benchmarks.queries import GOLDEN_QUERIES
+from utils.corpus import iter_records
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_summary(latencies_ms):
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(np.mean(latencies_ms)),
+    }
+
+
+@contextlib.contextmanager
+def stage(results, name, verbose=False):
+    '''
+    Times the enclosed stage and records its wall time and the peak RSS so far under results[name],
+    which the stage fills with its own measurements. Output of the stage is hidden unless `verbose`.
+    '''
+    print(f"Running stage '{name}'...")
+    metrics = results.setdefault(name, {})
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        yield metrics
+    metrics["seconds"] = time.perf_counter() - start
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    print(f"  {metrics['seconds']:.2f} s, peak RSS {metrics['peak_rss_mb']:.0f} MB")
+
+
+async def scrape_fixtures(pages, corpus_path, cache_path, concurrency):
+    from scrapers.scraper import scrape_msdvetmanual
+
+    server = FixtureServer(pages)
+    base_url = await server.start()
+    try:
+        await scrape_msdvetmanual(concurrency=concurrency, requests_per_second=0, resume=False, base_url=base_url,
+                                  cache_path=cache_path, output_filename=corpus_path)
+    finally:
+        await server.close()
+    return server.requests
+
+
+def found(documents, topics):
+    for doc in documents:
+        sources = [doc.metadata] + (doc.metadata.get('sources') or [])
+        if any(source.get('topic') in topics for source in sources):
+            return True
+    return False
+
+
+def retrieval_recall(hits_by_language):
+    recall = {language: sum(hits) / len(hits) for language, hits in hits_by_language.items()}
+    recall["all"] = sum(sum(hits) for hits in hits_by_language.values()) / sum(len(hits) for hits in hits_by_language.values())
+    return recall
+
+
+async def answer_queries(service, questions, concurrency):
+    '''
+    Answers the questions one at a time, then all of them `concurrency` at a time.
+    Returns (sequential responses, concurrent wall time in seconds).
+    '''
+    responses = [await service.consult(question) for question in questions]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(question):
+        async with semaphore:
+            return await service.consult(question)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(question) for question in questions))
+    return responses, time.perf_counter() - start
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run(args, work_dir):
+    from transformers import AutoTokenizer
+    from langchain_core.documents import Document
+    from services.agent import TOP_K
+    from services.llm import create_llm
+    from services.server import ConsultService
+    from vector_dbs.chunking import iter_chunks
+    from vector_dbs.dedup import dedup_documents
+    from vector_dbs.embedding_cache import CachedEmbeddings, EmbeddingCache
+    from vector_dbs.embeddings import EMBEDDING_MODEL, cache_model_key, load_embeddings
+    from vector_dbs.faiss_db import load_store
+    from vector_dbs.index_factory import build_faiss_index
+    from vector_dbs.index_store import ChunkIndex
+
+    results = {}
+    corpus_path = os.path.join(work_dir, "corpus.jsonl")
+    db_path = os.path.join(work_dir, "db")
+    k = args.k or TOP_K
+
+    with stage(results, "scrape", args.verbose) as metrics:
+        pages = build_site(load_snapshot(args.snapshot, args.topics))
+        requests = asyncio.run(scrape_fixtures(pages, corpus_path, os.path.join(work_dir, "crawl_cache.sqlite"), args.concurrency))
+        records = list(iter_records(corpus_path))
+        metrics.update(pages=requests, records=len(records), corpus_bytes=os.path.getsize(corpus_path))
+    results["scrape"]["pages_per_second"] = results["scrape"]["pages"] / results["scrape"]["seconds"]
+
+    with stage(results, "chunk", args.verbose) as metrics:
+        tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+        documents = [Document(page_content=chunk['text'], metadata=chunk['metadata']) for chunk in iter_chunks(records, tokenizer)]
+        metrics["chunks"] = len(documents)
+    results["chunk"]["chunks_per_second"] = len(documents) / results["chunk"]["seconds"]
+
+    with stage(results, "dedup", args.verbose) as metrics:
+        documents = dedup_documents(documents, args.dedup_threshold) if args.dedup_threshold else documents
+        metrics.update(chunks=len(documents), collapsed=results["chunk"]["chunks"] - len(documents))
+
+    with stage(results, "load_model", args.verbose):
+        model_key = cache_model_key(EMBEDDING_MODEL, args.embedding_backend)
+        embeddings = CachedEmbeddings(load_embeddings(args.embedding_backend), model_key,
+                                      EmbeddingCache(model_key, cache_dir=os.path.join(work_dir, "embedding_cache")))
+
+    with stage(results, "embed", args.verbose) as metrics:
+        vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        metrics["tokens"] = sum(doc.metadata["token_count"] for doc in documents)
+    results["embed"]["chunks_per_second"] = len(documents) / results["embed"]["seconds"]
+    results["embed"]["tokens_per_second"] = results["embed"]["tokens"] / results["embed"]["seconds"]
+
+    with stage(results, "index", args.verbose) as metrics:
+        ids = np.arange(len(documents), dtype=np.int64)
+        store = ChunkIndex.create(db_path, build_faiss_index(args.index_type, vectors, ids), ids, documents, embeddings)
+        store.save(db_path)
+        store.close()
+        metrics.update(index_type=args.index_type, size_bytes=directory_size(db_path))
+
+    questions = [question for _, question, _ in GOLDEN_QUERIES]
+    with stage(results, "retrieve", args.verbose) as metrics:
+        faiss_db = load_store(embeddings, db_path, retrieval=args.retrieval)
+        latencies = []
+        hits_by_language = {}
+        for language, question, topics in GOLDEN_QUERIES:
+            start = time.perf_counter()
+            retrieved = faiss_db.embed_and_search([question], k)[1][0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits_by_language.setdefault(language, []).append(found(retrieved, topics))
+        # All questions again in one batch; their embeddings are cached now, so this measures search
+        start = time.perf_counter()
+        faiss_db.embed_and_search(questions, k)
+        batch_seconds = time.perf_counter() - start
+        metrics.update(retrieval=args.retrieval, k=k, queries=len(questions), latency=latency_summary(latencies),
+                       batched_queries_per_second=len(questions) / batch_seconds,
+                       **{f"recall_at_{k}": retrieval_recall(hits_by_language)})
+
+    with stage(results, "answer", args.verbose) as metrics:
+        llm = create_llm(['stub'], stub_latency=args.stub_latency)
+        service = ConsultService(faiss_db, llm)
+
+        async def answer_all():
+            try:
+                return await answer_queries(service, questions, args.concurrency)
+            finally:
+                await service.close()
+
+        responses, concurrent_seconds = asyncio.run(answer_all())
+        metrics.update(
+            stub_latency_seconds=args.stub_latency,
+            latency=latency_summary([response["timings_ms"]["total"] for response in responses]),
+            retrieval_latency=latency_summary([response["timings_ms"]["retrieval"] for response in responses]),
+            mean_context_tokens=float(np.mean([response["context_tokens"]["used"] for response in responses])),
+            concurrency=args.concurrency,
+            answers_per_second=len(questions) / concurrent_seconds,
+        )
+    faiss_db.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def numeric_leaves(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from numeric_leaves(item, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(baseline, stages):
+    '''
+    Prints each metric of this run next to its value in the baseline run.
+    '''
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    old = dict(numeric_leaves(baseline.get("stages", {})))
+    for name, value in numeric_leaves(stages):
+        if name in old:
+            change = f" ({(value - old[name]) / old[name]:+.1%})" if old[name] else ""
+            print(f"  {name}: {old[name]:.4g} -> {value:.4g}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the whole pipeline offline on a fixed corpus snapshot.")
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH,
+                        help=f"Paragraph-level corpus snapshot the fixture site is built from (default: {SNAPSHOT_PATH}).")
+    parser.add_argument('--topics', type=int, default=None,
+                        help="Only use the first N topics of the snapshot (default: all).")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Parallel scraper workers and concurrent consultations (default: 4).")
+    parser.add_argument('--embedding-backend', choices=['torch', 'onnx', 'onnx-int8'], default='torch',
+                        help="Embedding backend, as for create_db (default: torch).")
+    parser.add_argument('--index-type', choices=['flat', 'ivf', 'hnsw', 'ivfpq', 'ivfopq'], default='flat',
+                        help="FAISS index type, as for create_db (default: flat).")
+    parser.add_argument('--retrieval', choices=['hybrid', 'dense'], default='hybrid',
+                        help="Retrieval mode, as for consult (default: hybrid).")
+    parser.add_argument('--dedup-threshold', type=float, default=0.9,
+                        help="Near-duplicate threshold, as for create_db (default: 0.9; 0 keeps near-duplicates).")
+    parser.add_argument('--k', type=int, default=None,
+                        help="Chunks retrieved per question (default: what the consult agent uses).")
+    parser.add_argument('--stub-latency', type=float, default=0.0,
+                        help="Seconds the stub LLM takes per answer (default: 0, to measure the pipeline's own overhead).")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON results of an earlier run to compare with.")
+    parser.add_argument('--output', default=None,
+                        help="Write the results as JSON to this file.")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the output of each stage.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pipeline_benchmark_") as work_dir:
+        stages = run(args, work_dir)
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": {name: value for name, value in vars(args).items() if name not in ('baseline', 'output', 'verbose')},
+        "stages": stages,
+    }
+    print(json.dumps(stages, indent=2, ensure_ascii=False))
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            compare(json.load(f), stages)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
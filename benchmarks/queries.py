@@ -0,0 +1,47 @@
+'''
+Fixed query set shared by the benchmarks, in English and Ukrainian.
+'''
+
+QUERIES = [
+    "How would you differentiate between symptoms of kennel cough and canine distemper?",
+    "Is chocolate toxic to dogs?",
+    "What are the signs of hip dysplasia in large breeds?",
+    "How often should I vaccinate my puppy?",
+    "My dog is vomiting and has diarrhea, what should I do?",
+    "What causes itchy skin and hair loss in dogs?",
+    "How is heartworm disease prevented?",
+    "What are the symptoms of diabetes in dogs?",
+    "Які симптоми чумки у собак?",
+    "Чи можна давати собаці шоколад?",
+    "Як часто потрібно вакцинувати цуценя?",
+    "Що робити, якщо собака кашляє?",
+]
+
+# Golden set for retrieval recall: (language, question, topics of the manual that answer it).
+# Topic names are those of the corpus snapshot the pipeline benchmark runs on (archive/old2.json).
+GOLDEN_QUERIES = [
+    ("en", "How is kennel cough spread between dogs?", ["Kennel Cough (Infectious Tracheobronchitis) in Dogs"]),
+    ("en", "What are the symptoms of canine distemper?", ["Canine Distemper (Hardpad Disease)"]),
+    ("en", "How is heartworm disease prevented?", ["Heartworm Disease in Dogs"]),
+    ("en", "What are the signs of hip dysplasia in large breeds?", ["Hip Dysplasia"]),
+    ("en", "How do I get rid of fleas on my dog?", ["Fleas of Dogs"]),
+    ("en", "Can a vaccinated dog still get rabies?", ["Rabies in Dogs"]),
+    ("en", "Why would a dog have pale gums and anemia?", ["Anemia in Dogs"]),
+    ("en", "My dog keeps shaking its head and its ear smells bad.", ["Ear Infections and Otitis Externa in Dogs"]),
+    ("en", "How do dogs catch Lyme disease?", ["Lyme Disease (Lyme Borreliosis) in Dogs", "Ticks of Dogs"]),
+    ("en", "How is leptospirosis transmitted?", ["Leptospirosis in Dogs"]),
+    ("en", "What are the signs of pancreatitis in dogs?", ["Pancreatitis and Other Disorders of the Pancreas in Dogs",
+                                                          "Disorders of the Pancreas in Dogs"]),
+    ("en", "How often should my dog's teeth be cleaned?", ["Dental Disorders of Dogs", "Routine Health Care of Dogs"]),
+    ("uk", "Як передається кашель розплідника між собаками?", ["Kennel Cough (Infectious Tracheobronchitis) in Dogs"]),
+    ("uk", "Які симптоми чумки у собак?", ["Canine Distemper (Hardpad Disease)"]),
+    ("uk", "Як запобігти дирофіляріозу (серцевим гельмінтам)?", ["Heartworm Disease in Dogs"]),
+    ("uk", "Які ознаки дисплазії кульшового суглоба у великих порід?", ["Hip Dysplasia"]),
+    ("uk", "Як позбутися бліх у собаки?", ["Fleas of Dogs"]),
+    ("uk", "Чи може щеплена собака захворіти на сказ?", ["Rabies in Dogs"]),
+    ("uk", "Собака трясе головою, і з вуха неприємно пахне.", ["Ear Infections and Otitis Externa in Dogs"]),
+    ("uk", "Як собаки заражаються хворобою Лайма?", ["Lyme Disease (Lyme Borreliosis) in Dogs", "Ticks of Dogs"]),
+    ("uk", "Як передається лептоспіроз?", ["Leptospirosis in Dogs"]),
+    ("uk", "Які ознаки панкреатиту у собак?", ["Pancreatitis and Other Disorders of the Pancreas in Dogs",
+                                             "Disorders of the Pancreas in Dogs"]),
+]
@@ -0,0 +1,149 @@
+'''
+Load test of the HTTP consult API: sends the benchmark queries to a running server at several
+concurrency levels and reports throughput, p50/p95/p99 end-to-end latency and the server-side
+retrieval time of each level. With `--stream` it uses the server-sent events endpoint and
+also reports the time to first token seen by the client.
+
+Start the server with the offline stub LLM first, so throughput is measured without network
+access or API quota. The benchmark cycles through a small query set, so turn the answer cache off
+to measure the full pipeline (or leave it on to measure cache hits):
+    python main.py serve --llm stub --stub-latency 1.0 --answer-cache off
+
+Usage:
+    python benchmarks/serve_throughput.py --concurrency 1 4 16 64 --requests 200 --output serve_throughput.json
+    python benchmarks/serve_throughput.py --stream --concurrency 16
+
+To see what query micro-batching buys, compare against a server started with `--max-batch-size 1`.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import aiohttp
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.queries import QUERIES
+
+
+async def consult(session, url, question):
+    '''
+    Returns (time to first token in ms or None, server-side timings) of one consultation.
+    '''
+    async with session.post(url, json={"question": question}) as response:
+        payload = await response.json()
+        if response.status != 200:
+            raise aiohttp.ClientError(payload.get("error"))
+        return None, payload["timings_ms"]
+
+
+async def consult_stream(session, url, question):
+    start = time.perf_counter()
+    first_token = None
+    event = None
+    async with session.post(url, json={"question": question}) as response:
+        if response.status != 200:
+            raise aiohttp.ClientError(f"HTTP {response.status}")
+        async for line in response.content:
+            line = line.decode('utf-8').rstrip('\n')
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                if event == 'token' and first_token is None:
+                    first_token = (time.perf_counter() - start) * 1000
+                elif event == 'error':
+                    raise aiohttp.ClientError(json.loads(line[len('data: '):])["error"])
+                elif event == 'done':
+                    return first_token, json.loads(line[len('data: '):])["timings_ms"]
+    raise aiohttp.ClientError("Stream ended without a 'done' event.")
+
+
+async def run_level(session, url, concurrency, num_requests, stream):
+    '''
+    Sends `num_requests` consultations with at most `concurrency` in flight.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    first_tokens = []
+    server_timings = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                first_token, timings = await (consult_stream if stream else consult)(session, url, QUERIES[i % len(QUERIES)])
+            except aiohttp.ClientError:
+                errors += 1
+                return
+            latencies.append((time.perf_counter() - start) * 1000)
+            server_timings.append(timings)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    result = {"concurrency": concurrency, "requests": num_requests, "errors": errors,
+              "requests_per_second": len(latencies) / elapsed}
+    if latencies:
+        result.update({
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+            "retrieval_ms_mean": float(np.mean([t["retrieval"] for t in server_timings])),
+        })
+    if first_tokens:
+        result.update({
+            "ttft_ms_p50": float(np.percentile(first_tokens, 50)),
+            "ttft_ms_p95": float(np.percentile(first_tokens, 95)),
+        })
+    return result
+
+
+async def run(url, levels, num_requests, stream):
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=max(levels))) as session:
+        # One warm-up request, so model warm-up does not count against the first level
+        await run_level(session, url, 1, 1, stream)
+        return [await run_level(session, url, concurrency, num_requests, stream) for concurrency in levels]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput/latency load test of the HTTP consult API.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/consult')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help="Numbers of consultations kept in flight, one run each.")
+    parser.add_argument('--requests', type=int, default=200, help="Number of consultations per concurrency level.")
+    parser.add_argument('--stream', action='store_true', help="Use the streaming endpoint and measure time to first token.")
+    parser.add_argument('--output', help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/') + '/stream' if args.stream else args.url
+    report = asyncio.run(run(url, args.concurrency, args.requests, args.stream))
+
+    print(f"\n{'concurrency':>11} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'retrieval ms':>13} "
+          f"{'ttft p50':>9} {'ttft p95':>9} {'errors':>7}")
+    for row in report:
+        if "latency_ms_p50" not in row:
+            print(f"{row['concurrency']:>11} {'-':>8} {'-':>9} {'-':>9} {'-':>9} {'-':>13} {'-':>9} {'-':>9} {row['errors']:>7}")
+            continue
+        ttft = f"{row['ttft_ms_p50']:>9.1f} {row['ttft_ms_p95']:>9.1f}" if "ttft_ms_p50" in row else f"{'-':>9} {'-':>9}"
+        print(f"{row['concurrency']:>11} {row['requests_per_second']:>8.1f} {row['latency_ms_p50']:>9.1f} "
+              f"{row['latency_ms_p95']:>9.1f} {row['latency_ms_p99']:>9.1f} {row['retrieval_ms_mean']:>13.1f} "
+              f"{ttft} {row['errors']:>7}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,143 @@
 import argparse
-import asyncio
-from scrapers.scraper import main as scrape_main
-from vector_dbs.faiss_db import main as faiss_main
-from services.agent import main as agent_main
+
+# Each action imports its own stack when it runs, so `--help`, `ask` and `scrape` don't pay
+# for FAISS, transformers and the LLM clients (see benchmarks/import_time.py)
 
 def main():
     parser = argparse.ArgumentParser(description="Dog Disease Consultant")
-    parser.add_argument('action', choices=['scrape', 'create_db', 'consult'], 
-                        help="Action to perform: 'scrape' to fetch data, 'create_db' to build the vector database, 'consult' to start the agent.")
+    parser.add_argument('action', choices=['scrape', 'create_db', 'consult', 'serve', 'ask'],
+                        help="Action to perform: 'scrape' to fetch data, 'create_db' to build the vector database, 'consult' to start the agent, "
+                             "'serve' to run the agent as an HTTP API, 'ask' to question a running 'serve' process.")
+    parser.add_argument('question', nargs='*',
+                        help="With 'ask', the question to answer; without one, questions are read interactively.")
+
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Number of pages downloaded in parallel during 'scrape' (default: 1).")
+    parser.add_argument('--corpus', default='data/msdvetmanual_dog_owners_data.jsonl',
+                        help="Corpus file written by 'scrape' and read by 'create_db' (JSONL; use a '.jsonl.zst' name for zstd compression).")
+    parser.add_argument('--follow', action='store_true',
+                        help="With 'create_db', keep reading the corpus while a running 'scrape' is still writing it.")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="With 'create_db', re-embed every chunk instead of updating the existing index incrementally.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="With 'create_db', number of embedding worker processes (default: one per 4 CPU cores).")
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help="With 'create_db', number of chunks per embedding batch (default: 32).")
+    parser.add_argument('--embedding-backend', choices=['torch', 'onnx', 'onnx-int8'], default=None,
+                        help="Embedding backend: 'torch' (fp32), 'onnx' (ONNX Runtime) or 'onnx-int8' (int8-quantized ONNX). "
+                             "'create_db' defaults to 'torch'; 'consult' defaults to the backend the index was built with.")
+    parser.add_argument('--index-type', choices=['flat', 'ivf', 'hnsw', 'ivfpq', 'ivfopq'], default='flat',
+                        help="With 'create_db', FAISS index type: exact 'flat', 'ivf' (IVF-Flat), 'hnsw', 'ivfpq' (IVF-PQ) "
+                             "or 'ivfopq' (OPQ + IVF-PQ).")
+    parser.add_argument('--dedup-threshold', type=float, default=0.9,
+                        help="With 'create_db', collapse chunks whose estimated word-shingle Jaccard similarity is at least "
+                             "this into one (default: 0.9; 0 keeps near-duplicates).")
+    parser.add_argument('--keywords', type=int, default=0,
+                        help="With 'create_db', store the N best keyphrases of each chunk in its metadata; hybrid retrieval "
+                             "ranks chunks tagged with the question's words higher (default: 0, off).")
+    parser.add_argument('--nprobe', type=int, default=None,
+                        help="With 'consult' or 'serve', number of IVF lists to probe per search (IVF index types only).")
+    parser.add_argument('--ef-search', type=int, default=None,
+                        help="With 'consult' or 'serve', HNSW search breadth (HNSW index type only).")
+    parser.add_argument('--retrieval', choices=['hybrid', 'dense'], default='hybrid',
+                        help="With 'consult' or 'serve', fuse BM25 keyword search with dense search (hybrid) or use dense search only.")
+    parser.add_argument('--chapter', nargs='+', default=None,
+                        help="With 'consult' or 'ask', only search these chapters of the manual.")
+    parser.add_argument('--topic', nargs='+', default=None,
+                        help="With 'consult' or 'ask', only search these topics of the manual.")
+    parser.add_argument('--route-chapters', type=int, default=0,
+                        help="With 'consult' or 'serve', search each question only in its N most likely chapters (default: 0, all chapters).")
+    parser.add_argument('--context-tokens', type=int, default=1536,
+                        help="With 'consult' or 'serve', prompt token budget for the retrieved text (default: 1536).")
+    parser.add_argument('--rerank', action='store_true',
+                        help="With 'consult' or 'serve', reorder retrieved chunks with a multilingual cross-encoder.")
+    parser.add_argument('--rerank-candidates', type=int, default=20,
+                        help="With --rerank, number of first-stage chunks the cross-encoder scores (default: 20).")
+    parser.add_argument('--rerank-budget-ms', type=float, default=200.0,
+                        help="With --rerank, time limit of reranking per batch; the retrieval order is kept when it runs out (default: 200).")
+    parser.add_argument('--rerank-keep', type=int, default=2,
+                        help="With --rerank, number of best-scored chunks passed to the LLM (default: 2).")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="With 'serve', address to listen on; with 'ask', address of the server (default: 127.0.0.1).")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="With 'serve', port to listen on; with 'ask', port of the server (default: 8080).")
+    parser.add_argument('--llm', nargs='+', choices=['gemini', 'llamacpp', 'stub'], default=['gemini'],
+                        help="With 'consult' or 'serve', LLM backends that write the answers, in order of preference: later ones "
+                             "answer when earlier ones fail or time out. 'llamacpp' runs a local GGUF model, 'stub' gives "
+                             "canned offline answers (default: gemini).")
+    parser.add_argument('--llm-timeout', type=float, default=30.0,
+                        help="With 'consult' or 'serve', seconds to wait for an LLM backend (for streams: for each next piece) "
+                             "before failing over to the next one (default: 30).")
+    parser.add_argument('--llm-concurrency', type=int, default=8,
+                        help="With 'serve', maximum number of requests in flight per LLM backend (default: 8).")
+    parser.add_argument('--llama-model', default=None,
+                        help="Path of the GGUF model used by the 'llamacpp' LLM backend.")
+    parser.add_argument('--llama-threads', type=int, default=None,
+                        help="Number of CPU threads of the 'llamacpp' LLM backend (default: chosen by llama.cpp).")
+    parser.add_argument('--stub-latency', type=float, default=1.0,
+                        help="With '--llm stub', seconds the stub takes per answer (default: 1.0).")
+    parser.add_argument('--retrieval-threads', type=int, default=4,
+                        help="With 'serve', number of threads embedding queries and searching the index (default: 4).")
+    parser.add_argument('--max-batch-size', type=int, default=16,
+                        help="With 'serve', maximum number of concurrent questions embedded and searched together; 1 disables batching (default: 16).")
+    parser.add_argument('--batch-window-ms', type=float, default=5.0,
+                        help="With 'serve', how long the first question of a batch waits for others to join it (default: 5 ms).")
+    parser.add_argument('--answer-cache', choices=['off', 'memory', 'disk'], default='memory',
+                        help="With 'consult' or 'serve', cache answers in memory, also on disk ('data/answer_cache.sqlite'), or not at all (default: memory).")
+    parser.add_argument('--answer-cache-ttl', type=float, default=24 * 3600,
+                        help="With 'consult' or 'serve', seconds a cached answer stays valid (default: 86400).")
+    parser.add_argument('--semantic-threshold', type=float, default=0.95,
+                        help="With 'consult' or 'serve', minimum cosine similarity for a differently worded question with the same "
+                             "retrieved chunks to reuse a cached answer (default: 0.95).")
+    parser.add_argument('--stream', action='store_true',
+                        help="With 'consult', show the retrieved sources right away and print the answer as it is generated.")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Start a fresh 'scrape' run instead of resuming an interrupted one from the crawl cache.")
+    parser.add_argument('--metrics-log', default=None,
+                        help="With 'scrape', 'create_db', 'consult' or 'serve', append a JSON line per timed pipeline stage "
+                             "to this file, and the counters and stage timings when the process exits.")
+
+    args = parser.parse_intermixed_args()
+    if args.question and args.action != 'ask':
+        parser.error(f"unrecognized arguments: {' '.join(args.question)} (only 'ask' takes a question)")
 
-    args = parser.parse_args()
+    if args.metrics_log:
+        import atexit
+        from utils.metrics import METRICS
+        METRICS.open_log(args.metrics_log)
+        atexit.register(METRICS.close_log)
 
     if args.action == 'scrape':
-        scrape_main()
+        from scrapers.scraper import main as scrape_main
+        scrape_main(concurrency=args.concurrency, resume=not args.no_resume, output_filename=args.corpus)
     elif args.action == 'create_db':
-        faiss_main('data/msdvetmanual_dog_owners_data.json')
+        from vector_dbs.faiss_db import main as faiss_main
+        faiss_main(args.corpus, follow=args.follow, rebuild=args.rebuild, workers=args.workers, batch_size=args.batch_size,
+                   backend=args.embedding_backend or 'torch', index_type=args.index_type, keywords=args.keywords,
+                   dedup_threshold=args.dedup_threshold)
     elif args.action == 'consult':
-        agent_main()
+        from services.agent import main as agent_main
+        agent_main(embedding_backend=args.embedding_backend, search_params={'nprobe': args.nprobe, 'efSearch': args.ef_search},
+                   answer_cache=args.answer_cache, answer_cache_ttl=args.answer_cache_ttl, semantic_threshold=args.semantic_threshold,
+                   stream=args.stream, llm_backends=args.llm, llm_timeout=args.llm_timeout, stub_latency=args.stub_latency,
+                   llama_model=args.llama_model, llama_threads=args.llama_threads, retrieval=args.retrieval,
+                   chapters=args.chapter, topics=args.topic, route_chapters=args.route_chapters,
+                   context_tokens=args.context_tokens, rerank=args.rerank, rerank_candidates=args.rerank_candidates,
+                   rerank_budget_ms=args.rerank_budget_ms, rerank_keep=args.rerank_keep)
+    elif args.action == 'serve':
+        from services.server import main as server_main
+        server_main(host=args.host, port=args.port, llm_backends=args.llm, embedding_backend=args.embedding_backend,
+                    search_params={'nprobe': args.nprobe, 'efSearch': args.ef_search},
+                    retrieval_threads=args.retrieval_threads, stub_latency=args.stub_latency,
+                    max_batch_size=args.max_batch_size, batch_window_ms=args.batch_window_ms, answer_cache=args.answer_cache,
+                    answer_cache_ttl=args.answer_cache_ttl, semantic_threshold=args.semantic_threshold,
+                    llm_timeout=args.llm_timeout, llm_concurrency=args.llm_concurrency, llama_model=args.llama_model,
+                    llama_threads=args.llama_threads, retrieval=args.retrieval, route_chapters=args.route_chapters,
+                    context_tokens=args.context_tokens, rerank=args.rerank, rerank_candidates=args.rerank_candidates,
+                    rerank_budget_ms=args.rerank_budget_ms, rerank_keep=args.rerank_keep)
+    elif args.action == 'ask':
+        from services.client import main as ask_main
+        ask_main(f"http://{args.host}:{args.port}", ' '.join(args.question) or None, chapters=args.chapter, topics=args.topic)
 
 if __name__ == "__main__":
     main()
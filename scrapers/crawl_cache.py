@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+
+CACHE_PATH = "data/crawl_cache.sqlite"
+
+
+def content_hash(html):
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+def stable_id(url):
+    """
+    Derives a deterministic UUID from the page URL, so a topic keeps the same ID across crawls.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, url))
+
+
+class CrawlCache:
+    """
+    SQLite-backed store of raw page HTML keyed by URL, with the content hash and
+    ETag/Last-Modified validators needed for conditional re-crawls.
+
+    Every crawl is recorded as a run. Pages are stamped with the run that fetched them,
+    so an interrupted run can be resumed without touching pages it already stored.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                html TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                run_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            );
+        """)
+        self.run_id = None
+
+    def start_run(self, resume=True):
+        """
+        Resumes the last run if it never finished (and `resume` is set), otherwise starts a new one.
+        """
+        last = self.conn.execute("SELECT id, finished_at FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+        if resume and last is not None and last["finished_at"] is None:
+            self.run_id = last["id"]
+            done = self.conn.execute("SELECT COUNT(*) FROM pages WHERE run_id = ?", (self.run_id,)).fetchone()[0]
+            print(f"Resuming interrupted crawl run {self.run_id} ({done} pages already checkpointed).")
+        else:
+            with self.conn:
+                self.run_id = self.conn.execute("INSERT INTO runs (started_at) VALUES (?)", (time.time(),)).lastrowid
+        return self.run_id
+
+    def finish_run(self):
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), self.run_id))
+
+    def get(self, url):
+        row = self.conn.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_checkpointed(self, entry):
+        """
+        True if the entry was already fetched during the current run.
+        """
+        return entry is not None and entry["run_id"] == self.run_id
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url, html, etag=None, last_modified=None):
+        """
+        Saves a freshly downloaded page and returns True if its content differs from the cached copy.
+        """
+        new_hash = content_hash(html)
+        previous = self.get(url)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (url, html, content_hash, etag, last_modified, fetched_at, run_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, html, new_hash, etag, last_modified, time.time(), self.run_id),
+            )
+        return previous is None or previous["content_hash"] != new_hash
+
+    def mark_not_modified(self, url):
+        """
+        Records a 304 response: the cached copy is still current and now belongs to this run.
+        """
+        with self.conn:
+            self.conn.execute("UPDATE pages SET fetched_at = ?, run_id = ? WHERE url = ?", (time.time(), self.run_id, url))
+
+    def close(self):
+        self.conn.close()
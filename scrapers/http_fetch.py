@@ -0,0 +1,78 @@
+import asyncio
+import httpx
+
+DEFAULT_TIMEOUT_SECONDS = 30.0
+
+
+class HttpFetcher:
+    """
+    Downloads server-rendered pages over a pooled, keep-alive HTTP client.
+    This is the default fetch path; it needs no browser.
+    """
+
+    def __init__(self, user_agent, max_connections, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.client = httpx.AsyncClient(
+            headers={"User-Agent": user_agent},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            follow_redirects=True,
+        )
+
+    async def get(self, url, headers=None):
+        """
+        Issues a GET request. Rate limiting (429) and server errors raise, so callers can retry them;
+        other statuses, including 304, are returned as-is.
+        """
+        response = await self.client.get(url, headers=headers)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class BrowserFetcher:
+    """
+    Fallback for pages whose content is only produced by JavaScript.
+    Chromium is started on the first render, so crawls that never need it never pay for it.
+    """
+
+    def __init__(self, user_agent, max_pages):
+        self.user_agent = user_agent
+        self._semaphore = asyncio.Semaphore(max(1, max_pages))
+        self._start_lock = asyncio.Lock()
+        self._playwright = None
+        self._browser = None
+        self._context = None
+
+    async def _ensure_started(self):
+        async with self._start_lock:
+            if self._context is None:
+                from playwright.async_api import async_playwright
+
+                print("Starting headless Chromium for pages that need JavaScript rendering.")
+                self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(headless=True)
+                self._context = await self._browser.new_context(user_agent=self.user_agent)
+
+    async def render(self, url):
+        """
+        Loads `url` in a fresh page and returns the rendered HTML.
+        """
+        await self._ensure_started()
+        async with self._semaphore:
+            page = await self._context.new_page()
+            try:
+                response = await page.goto(url, wait_until="domcontentloaded")
+                if response is not None and response.status >= 400:
+                    raise RuntimeError(f"HTTP {response.status}")
+                return await page.content()
+            finally:
+                await page.close()
+
+    async def close(self):
+        if self._browser is not None:
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
@@ -1,146 +1,300 @@
 import asyncio
-import json
-import uuid
 import random
-from playwright.async_api import async_playwright
-from bs4 import BeautifulSoup
+from collections import Counter
+from urllib.parse import urlparse
+import lxml.html
 import sys
 import os
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from scrapers.crawl_cache import CACHE_PATH, CrawlCache, stable_id
+from scrapers.http_fetch import BrowserFetcher, HttpFetcher
+from utils.corpus import CORPUS_PATH, CorpusWriter
+from utils.metrics import METRICS
+
+BASE_URL = "https://www.msdvetmanual.com"
+CONTENT_CLASS = "TopicMainContent_content__MEmoN"
+
+DEFAULT_CONCURRENCY = 1
+REQUESTS_PER_SECOND_PER_HOST = 2.0
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 1.0
+
 user_agents = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Safari/605.1.15",
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:97.0) Gecko/20100101 Firefox/97.0"
 ]
 
-async def scrape_msdvetmanual():
+
+class HostRateLimiter:
+    """
+    Spaces out requests so that each host receives at most `rate` requests per second,
+    no matter how many workers are crawling in parallel.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND_PER_HOST):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, url):
+        host = urlparse(url).netloc
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def with_retry(url, rate_limiter, action, retries=MAX_RETRIES):
+    """
+    Runs `action` (a coroutine factory that loads `url`), retrying with exponential backoff
+    and jitter when it raises (network errors, 429 and 5xx responses).
+    """
+    for attempt in range(retries + 1):
+        await rate_limiter.wait(url)
+        try:
+            return await action()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            METRICS.count("scrape_retries")
+            delay = BACKOFF_BASE_SECONDS * 2 ** attempt + random.uniform(0, BACKOFF_BASE_SECONDS)
+            print(f"WARNING: Loading '{url}' failed ({e}). Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+
+async def fetch_html(fetchers, url, rate_limiter, cache, stats, required_marker=None):
+    """
+    Returns the HTML for `url`, going through the crawl cache:
+    pages checkpointed by the current run are reused as-is, others are revalidated
+    with a conditional request and only downloaded again when they changed.
+    Pages are downloaded over plain HTTP; if `required_marker` is missing from the
+    server response, the page is rendered in the browser instead.
+    """
+    http_fetcher, browser_fetcher = fetchers
+
+    entry = cache.get(url)
+    if cache.is_checkpointed(entry):
+        stats["checkpointed"] += 1
+        return entry["html"]
+
+    headers = cache.conditional_headers(entry)
+    with METRICS.span("scrape.http"):
+        response = await with_retry(url, rate_limiter, lambda: http_fetcher.get(url, headers=headers))
+
+    if response.status_code == 304 and entry is not None:
+        cache.mark_not_modified(url)
+        stats["unchanged"] += 1
+        return entry["html"]
+    if not response.is_success:
+        raise RuntimeError(f"HTTP {response.status_code}")
+
+    html = response.text
+    if required_marker and required_marker not in html:
+        with METRICS.span("scrape.render"):
+            html = await with_retry(url, rate_limiter, lambda: browser_fetcher.render(url))
+        stats["rendered"] += 1
+
+    changed = cache.store(url, html, etag=response.headers.get("etag"), last_modified=response.headers.get("last-modified"))
+    stats["downloaded" if changed else "unchanged"] += 1
+    return html
+
+
+def links_from_html(html):
+    """
+    Returns (href, text) pairs for every <a> element in the HTML.
+    """
+    tree = lxml.html.fromstring(html)
+    return [(a.get('href'), a.text_content()) for a in tree.iter('a')]
+
+
+def filter_main_category_links(links, base_url=BASE_URL):
+    """
+    Keeps links of the form /dog-owners/<category>, deduplicated by URL.
+    """
+    main_category_links = {}
+    for href, text in links:
+        if href and href.startswith("/dog-owners/") and href != "/dog-owners" and '#' not in href:
+            path_segments = href.strip('/').split('/')
+            if len(path_segments) == 2 and path_segments[0] == 'dog-owners':
+                full_url = f"{base_url}{href}"
+                main_category_links.setdefault(full_url, {"text": text.strip(), "url": full_url})
+    return list(main_category_links.values())
+
+
+def filter_subsection_links(links, main_category_url, base_url=BASE_URL):
+    """
+    Keeps links of the form /dog-owners/<category>/<topic> below the given category, deduplicated by URL.
+    """
+    main_category_path_segment = main_category_url.replace(base_url, "")
+    category_slug = main_category_path_segment.strip('/').split('/')[-1]
+    subsection_links = {}
+    for href, text in links:
+        if href and href.startswith(main_category_path_segment + '/') and '#' not in href:
+            path_segments = href.strip('/').split('/')
+            if len(path_segments) == 3 and path_segments[0] == 'dog-owners' and path_segments[1] == category_slug:
+                full_url = f"{base_url}{href}"
+                # Ensure we don't add the main category URL itself as a subsection
+                if full_url != main_category_url:
+                    subsection_links.setdefault(full_url, {"text": text.strip(), "url": full_url})
+    return list(subsection_links.values())
+
+
+def extract_text(html):
+    """
+    Finds the topic content element in the page HTML, strips images and headings from it
+    and returns its whitespace-normalized text ('' if the page has no content element).
+    """
+    tree = lxml.html.fromstring(html)
+    content = next((el for el in tree.find_class(CONTENT_CLASS) if el.tag == 'div'), None)
+    if content is None:
+        return ''
+
+    # Remove all <img>, <h2> and <h3> tags (and any inline scripts), keeping the text that follows them
+    for tag in list(content.iter('img', 'h2', 'h3', 'script', 'style')):
+        tag.drop_tree()
+
+    return ' '.join(content.text_content().split()).strip()
+
+
+async def process_category(fetchers, job, queue, rate_limiter, cache, stats):
+    print(f"\n--- Processing Main Category: {job['chapter']} ({job['url']}) ---")
+
+    html = await fetch_html(fetchers, job['url'], rate_limiter, cache, stats)
+    with METRICS.span("scrape.extract", kind="links"):
+        subsection_links = filter_subsection_links(links_from_html(html), job['url'], job['base_url'])
+
+    print(f"Found {len(subsection_links)} potential subsections for '{job['chapter']}'.")
+
+    for sub_link_info in subsection_links:
+        queue.put_nowait({
+            "kind": "topic",
+            "url": sub_link_info["url"],
+            "chapter": job["chapter"],
+            "topic": sub_link_info["text"],
+            "base_url": job["base_url"],
+        })
+
+
+async def process_topic(fetchers, job, rate_limiter, cache, stats, writer):
+    subsection_name = job["topic"]
+    subsection_url = job["url"]
+
+    print(f"--- Scraping Subsection: '{subsection_name}' ({subsection_url}) ---")
+
+    html = await fetch_html(fetchers, subsection_url, rate_limiter, cache, stats, required_marker=CONTENT_CLASS)
+    with METRICS.span("scrape.extract", kind="text"):
+        full_text = extract_text(html)
+
+    if full_text:
+        writer.write({
+            "id": stable_id(subsection_url), # Stable ID for each topic, derived from its URL
+            "url": subsection_url,
+            "chapter": job["chapter"],
+            "topic": subsection_name,
+            "text": full_text
+        })
+        print(f"Successfully scraped '{subsection_name}'.")
+    else:
+        print(f"WARNING: Could not find main content element for '{subsection_name}' at {subsection_url}. Skipping.")
+
+
+async def crawl_worker(fetchers, queue, rate_limiter, cache, stats, writer):
+    """
+    Pulls category and topic jobs off the shared queue until cancelled.
+    """
+    while True:
+        job = await queue.get()
+        try:
+            # A failed page also counts as errors{stage="scrape.page"}
+            with METRICS.span("scrape.page", kind=job["kind"]):
+                if job["kind"] == "category":
+                    await process_category(fetchers, job, queue, rate_limiter, cache, stats)
+                else:
+                    await process_topic(fetchers, job, rate_limiter, cache, stats, writer)
+        except Exception as e:
+            print(f"ERROR: Failed to scrape '{job['url']}': {e}")
+        finally:
+            queue.task_done()
+
+
+async def scrape_msdvetmanual(concurrency=DEFAULT_CONCURRENCY, requests_per_second=REQUESTS_PER_SECOND_PER_HOST,
+                              resume=True, base_url=BASE_URL, cache_path=CACHE_PATH, output_filename=CORPUS_PATH):
     """
     Scrapes text content from the 'Dog Owners' section of the MSD Vet Manual website.
     It navigates to main categories, then to their subsections, extracts text,
-    and saves it into a JSON file formatted for a vector database.
-    """
-    base_url = "https://www.msdvetmanual.com/dog-owners"
-    scraped_data = []
-
-    async with async_playwright() as p:
-        
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page(user_agent=random.choice(user_agents))
-
-        print(f"Navigating to base URL: {base_url}")
-
-        await page.goto(base_url, wait_until="domcontentloaded")
-        
-        all_links = await page.locator("a").all()
-        main_category_links = []
-        
-        for link_element in all_links:
-            href = await link_element.get_attribute("href")
-            text = await link_element.text_content()
-            
-            if href and href.startswith("/dog-owners/") and href != "/dog-owners" and '#' not in href:
-                path_segments = href.strip('/').split('/')
-                if len(path_segments) == 2 and path_segments[0] == 'dog-owners':
-                    full_url = f"https://www.msdvetmanual.com{href}"
-                    main_category_links.append({"text": text.strip(), "url": full_url})
-
-        # Use a dictionary to remove duplicate links based on their URL
-        unique_main_category_links = {link['url']: link for link in main_category_links}.values()
-        print(f"Found {len(unique_main_category_links)} potential main categories.")
-        
-        for main_cat_link_info in unique_main_category_links:
-            main_category_name = main_cat_link_info["text"]
-            main_category_url = main_cat_link_info["url"]
-
-            print(f"\n--- Processing Main Category: {main_category_name} ({main_category_url}) ---")
-            
-            await page.goto(main_category_url, wait_until="domcontentloaded")
-            
-            all_links_on_category_page = await page.locator("a").all()
-            subsection_links = []
-
-            for link_element in all_links_on_category_page:
-                href = await link_element.get_attribute("href")
-                text = await link_element.text_content()
-
-                main_category_path_segment = main_cat_link_info["url"].replace("https://www.msdvetmanual.com", "")
-                if href and href.startswith(main_category_path_segment + '/') and '#' not in href:
-                    path_segments = href.strip('/').split('/')
-                    if len(path_segments) == 3 and path_segments[0] == 'dog-owners' and path_segments[1] == main_category_path_segment.strip('/').split('/')[-1]:
-                        full_url = f"https://www.msdvetmanual.com{href}"
-                        # Ensure we don't add the main category URL itself as a subsection
-                        if full_url != main_category_url:
-                            subsection_links.append({"text": text.strip(), "url": full_url})
-            
-            unique_subsection_links = {link['url']: link for link in subsection_links}.values()
-            
-            print(f"Found {len(unique_subsection_links)} potential subsections for '{main_category_name}'.")
-
-            for sub_link_info in unique_subsection_links:
-                subsection_name = sub_link_info["text"]
-                subsection_url = sub_link_info["url"]
-
-                print(f"--- Scraping Subsection: '{subsection_name}' ({subsection_url}) ---")
-                
-                try:
-                    await page.goto(subsection_url, wait_until="domcontentloaded")
-                    
-                    content_locator = page.locator("div.TopicMainContent_content__MEmoN").first
-                    if content_locator:
-                        html_content = await content_locator.inner_html()
-                        soup = BeautifulSoup(html_content, 'html.parser')
-                        
-                        # Remove all <img> tags
-                        for img_tag in soup.find_all('img'):
-                            img_tag.decompose()
-                        
-                        # Remove all <h2> tags
-                        for h2_tag in soup.find_all('h2'):
-                            h2_tag.decompose()
-
-                        # Remove all <h3> tags
-                        for h3_tag in soup.find_all('h3'):
-                            h3_tag.decompose()
-
-                        full_text = soup.get_text()
-
-                    
-                    if full_text:
-                        
-                        cleaned_text = ' '.join(full_text.split()).strip()
-                        
-                        scraped_data.append({
-                            "id": str(uuid.uuid4()), # Unique ID for each text chunk
-                            "url": subsection_url,
-                            "chapter": main_category_name,
-                            "topic": subsection_name,
-                            "text": cleaned_text
-                        })
-                        print(f"Successfully scraped '{subsection_name}'.")
-                    else:
-                        print(f"WARNING: Could not find main content element for '{subsection_name}' at {subsection_url}. Skipping.")
-
-                except Exception as e:
-                    print(f"ERROR: Failed to scrape '{subsection_url}': {e}")
-                
-        await browser.close()
-
-    output_filename = "data/msdvetmanual_dog_owners_data.json"
-    
-    # Create the directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-    
-    with open(output_filename, "w", encoding="utf-8") as f:
-        json.dump(scraped_data, f, ensure_ascii=False, indent=2)
-    
+    and streams each topic as a JSON line into the corpus file ('.zst' for compressed output)
+    as soon as it is scraped, so downstream stages can start reading before the crawl ends.
+    Records go to '<corpus>.tmp', which replaces the corpus only once the crawl has finished.
+
+    Pages are downloaded by `concurrency` workers sharing a pooled HTTP client and parsed
+    in-process; headless Chromium is only started for pages whose content needs JavaScript.
+    Requests are rate limited per host and retried. Pages go through the on-disk crawl
+    cache, so unchanged pages are not downloaded again and an interrupted crawl resumes
+    from its checkpoint unless `resume` is False. `base_url` can point at a local fixture server.
+    """
+    rate_limiter = HostRateLimiter(requests_per_second)
+    queue = asyncio.Queue()
+    stats = Counter()
+    start_url = f"{base_url}/dog-owners"
+
+    cache = CrawlCache(cache_path)
+    cache.start_run(resume=resume)
+
+    user_agent = random.choice(user_agents)
+    concurrency = max(1, concurrency)
+    fetchers = (HttpFetcher(user_agent, max_connections=concurrency), BrowserFetcher(user_agent, max_pages=concurrency))
+    writer = CorpusWriter(output_filename)
+
+    try:
+        print(f"Navigating to base URL: {start_url}")
+
+        start_html = await fetch_html(fetchers, start_url, rate_limiter, cache, stats)
+        main_category_links = filter_main_category_links(links_from_html(start_html), base_url)
+
+        print(f"Found {len(main_category_links)} potential main categories.")
+
+        for main_cat_link_info in main_category_links:
+            queue.put_nowait({
+                "kind": "category",
+                "url": main_cat_link_info["url"],
+                "chapter": main_cat_link_info["text"],
+                "base_url": base_url,
+            })
+
+        print(f"Crawling with {concurrency} parallel worker(s).")
+        workers = [asyncio.create_task(crawl_worker(fetchers, queue, rate_limiter, cache, stats, writer)) for _ in range(concurrency)]
+
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Only a finished crawl replaces the corpus; an interrupted one leaves the previous corpus in place
+        writer.commit()
+    finally:
+        writer.close()
+        for fetcher in fetchers:
+            await fetcher.close()
+
+    cache.finish_run()
+    cache.close()
+
     print(f"\nScraping complete. Data saved to {output_filename}")
-    print(f"Total entries scraped: {len(scraped_data)}")
+    print(f"Total entries scraped: {writer.count}")
+    print(f"Pages downloaded: {stats['downloaded']}, unchanged: {stats['unchanged']}, "
+          f"reused from checkpoint: {stats['checkpointed']}, rendered in browser: {stats['rendered']}")
+    METRICS.count("scrape_topics_written", writer.count)
+    for outcome, pages in stats.items():
+        METRICS.count("scrape_pages", pages, outcome=outcome)
 
-def main():
-    asyncio.run(scrape_msdvetmanual())
+def main(concurrency=DEFAULT_CONCURRENCY, resume=True, output_filename=CORPUS_PATH):
+    asyncio.run(scrape_msdvetmanual(concurrency=concurrency, resume=resume, output_filename=output_filename))
 
 if __name__ == "__main__":
     main()
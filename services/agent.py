@@ -1,26 +1,51 @@
+import asyncio
 import os
 import sys
-from langchain_community.vectorstores.faiss import FAISS
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
-import google.generativeai as genai
+import time
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from vector_dbs.embedding_cache import CachedEmbeddings
+from vector_dbs.embeddings import EMBEDDING_MODEL, cache_model_key, load_embeddings
+from vector_dbs.faiss_db import indexed_backend, load_store
+from vector_dbs.reranker import RERANK_BUDGET_MS, RERANK_CANDIDATES, RERANK_KEEP, RERANK_MODEL, CrossEncoderReranker
+from services.answer_cache import SIMILARITY_THRESHOLD, TTL_SECONDS, create_answer_cache
+from services.context import CONTEXT_TOKEN_BUDGET, build_context
+from services.llm import LLM_MAX_CONCURRENCY, LLM_TIMEOUT_SECONDS, STUB_LATENCY_SECONDS, create_llm
+from utils.metrics import METRICS
+
 DB_PATH = "vector_dbs/vet_manual_faiss_db"
-MODEL_NAME = 'gemini-1.5-flash'
+TOP_K = 3
 
-def consult_the_expert(query, gemini_model, faiss_db):
+def load_knowledge_base(embedding_backend=None, search_params=None, db_path=DB_PATH, retrieval='hybrid', route_chapters=0,
+                        rerank=False, rerank_candidates=RERANK_CANDIDATES, rerank_budget_ms=RERANK_BUDGET_MS, rerank_keep=RERANK_KEEP):
     """
-    Performs Retrieval-Augmented Generation to answer a user's query using Gemini.
+    Loads the embedding model and the FAISS index the consultant retrieves from.
+    Queries are embedded with the backend the index was built with, unless overridden.
+    `retrieval` is 'hybrid' (BM25 and dense results fused) or 'dense'; `route_chapters` > 0
+    searches each question only in that many of its most likely chapters. With `rerank`, the top
+    `rerank_candidates` chunks are reordered by a cross-encoder within `rerank_budget_ms` and the
+    best `rerank_keep` are kept.
     """
-    results = faiss_db.similarity_search(query, k=3)
-
-    if not results:
-        retrieved_texts = "No relevant information found in the manual."
-    else:
-        retrieved_contents = [doc.page_content for doc in results]
-        retrieved_texts = "\n\n---\n\n".join(retrieved_contents)
+    # Repeated questions are embedded once and then served from the on-disk embedding cache
+    backend = embedding_backend or indexed_backend(db_path)
+    embeddings = CachedEmbeddings(load_embeddings(backend), cache_model_key(EMBEDDING_MODEL, backend))
+    print(f"Loaded embedding model '{EMBEDDING_MODEL}' ({backend} backend).")
+    faiss_db = load_store(embeddings, db_path, search_params, retrieval, route_chapters)
+    if rerank:
+        try:
+            faiss_db.reranker = CrossEncoderReranker(candidates=rerank_candidates, budget_ms=rerank_budget_ms, keep=rerank_keep)
+            print(f"Loaded reranker '{RERANK_MODEL}'.")
+        except Exception as e:
+            print(f"WARNING: Could not load the reranker ({e}); continuing without reranking.")
+    return faiss_db
+
+def build_prompt(query, context):
+    """
+    Builds the LLM prompt from the user's query and the context assembled by build_context.
+    """
+    retrieved_texts = context["text"] or "No relevant information found in the manual."
 
     prompt = f"""
         You are a helpful veterinary assistant providing information based on a veterinary manual.
@@ -41,59 +66,177 @@ def consult_the_expert(query, gemini_model, faiss_db):
 
         ANSWER:
     """
+    return prompt
+
+def retrieve_or_cached(query, faiss_db, answer_cache=None, filters=None):
+    """
+    Checks the exact answer cache, retrieves the chunks for the query, then checks the semantic cache.
+    Returns (cached entry or None, query vector, retrieved documents).
+    Only answers given under the same chapter/topic `filters` are reused.
+    """
+    if answer_cache is not None:
+        cached = answer_cache.get_exact(query, filters)
+        if cached is not None:
+            return cached, None, None
+
+    with METRICS.span("consult.retrieve"):
+        (query_vector,), (results,) = faiss_db.embed_and_search([query], TOP_K, [filters])
+    if answer_cache is not None:
+        cached = answer_cache.get_semantic(query_vector, [doc.metadata["chunk_id"] for doc in results], filters)
+        if cached is not None:
+            return cached, query_vector, results
+    return None, query_vector, results
+
+def packed_context(results, context_tokens):
+    """
+    build_context, timed, with the prompt size added to the token counters.
+    """
+    with METRICS.span("consult.context"):
+        context = build_context(results, context_tokens)
+    METRICS.count("prompts")
+    METRICS.count("prompt_context_tokens", context["tokens"])
+    METRICS.count("prompt_tokens_saved", context["saved_tokens"])
+    return context
+
+def context_report(context):
+    return (f"(Context: {context['tokens']} prompt tokens, {context['saved_tokens']} fewer than "
+            f"the {context['chunk_tokens']} of the retrieved chunks joined verbatim)")
+
+async def consult_the_expert(query, llm, faiss_db, answer_cache=None, filters=None, context_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Performs Retrieval-Augmented Generation to answer a user's query with the given LLM backend.
+    With an `answer_cache`, repeated and near-identical questions are answered without calling the LLM.
+    `filters` ({"chapter": [...], "topic": [...]}) restricts retrieval to parts of the manual, and
+    the retrieved text is packed into `context_tokens` prompt tokens.
+    """
+    cached, query_vector, results = retrieve_or_cached(query, faiss_db, answer_cache, filters)
+    if cached is not None:
+        return cached["answer"]
 
+    context = packed_context(results, context_tokens)
+    print(context_report(context))
     try:
-        response = gemini_model.generate_content(
-            prompt,
-            generation_config={
-                "temperature": 0.7,
-                "max_output_tokens": 1024,
-                "top_p": 1,
-                "top_k": 1,
-            },
-        )
-        return response.text
+        answer = await llm.generate(build_prompt(query, context))
     except Exception as e:
-        return f"Error communicating with Gemini API: {e}."
+        METRICS.count("errors", stage="consult.llm")
+        return f"Error communicating with the LLM: {e}."
+
+    if answer_cache is not None:
+        answer_cache.put(query, query_vector, [doc.metadata for doc in results], answer, filters)
+    return answer
 
-def main():
-    API_KEY = os.environ.get("GOOGLE_API_KEY")
-    if API_KEY is None:
-        print("Error: GOOGLE_API_KEY environment variable is not set.")
-        print("Please set it before running the script. Example: export GOOGLE_API_KEY='YOUR_API_KEY'")
+async def stream_the_expert(query, llm, faiss_db, answer_cache=None, filters=None, context_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Streaming variant of consult_the_expert: yields ("sources", [chunk metadata]) as soon as
+    retrieval is done, ("context", build_context result), then ("token", text) pieces of the
+    answer as the LLM generates them.
+    """
+    cached, query_vector, results = retrieve_or_cached(query, faiss_db, answer_cache, filters)
+    if cached is not None:
+        yield "sources", cached["sources"]
+        yield "token", cached["answer"]
         return
 
+    sources = [doc.metadata for doc in results]
+    yield "sources", sources
+    context = packed_context(results, context_tokens)
+    yield "context", context
+
+    pieces = []
     try:
-        genai.configure(api_key=API_KEY)
-        print("Gemini API client configured successfully.")
+        async for piece in llm.stream(build_prompt(query, context)):
+            pieces.append(piece)
+            yield "token", piece
     except Exception as e:
-        print(f"Error configuring Gemini API client: {e}")
+        METRICS.count("errors", stage="consult.llm")
+        yield "token", f"Error communicating with the LLM: {e}."
         return
 
-    gemini_model = genai.GenerativeModel(MODEL_NAME)
+    if answer_cache is not None:
+        answer_cache.put(query, query_vector, sources, ''.join(pieces), filters)
+
+async def print_streamed_answer(events):
+    """
+    Prints the retrieved sources, then the answer as it arrives, and reports the time to first token.
+    """
+    start = time.perf_counter()
+    first_token = None
+    async for kind, value in events:
+        if kind == "sources":
+            titles = [f"{source.get('chapter')} / {source.get('topic')}" for source in value]
+            print(f"\nSources: {'; '.join(titles) if titles else 'none found'}")
+        elif kind == "context":
+            print(context_report(value))
+        else:
+            if first_token is None:
+                first_token = time.perf_counter()
+                METRICS.observe("consult.first_token", first_token - start)
+                print("\nAssistant: ", end="", flush=True)
+            print(value, end="", flush=True)
+    if first_token is not None:
+        print(f"\n\n(first token after {(first_token - start) * 1000:.0f} ms, "
+              f"answer complete after {(time.perf_counter() - start) * 1000:.0f} ms)")
+
+async def consult_loop(llm, faiss_db, cache, stream, filters=None, context_tokens=CONTEXT_TOKEN_BUDGET):
+    print("\nDog Disease Consultant is ready. Type 'exit' to quit.")
+    loop = asyncio.get_running_loop()
+    while True:
+        user_question = await loop.run_in_executor(None, input, "\nYour question: ")
+        if user_question.lower() == 'exit':
+            break
+        
+        # One trace per question, so its stages can be told apart in the metrics log
+        with METRICS.trace(), METRICS.span("consult", mode="stream" if stream else "answer"):
+            if stream:
+                await print_streamed_answer(stream_the_expert(user_question, llm, faiss_db, cache, filters, context_tokens))
+                continue
+            answer = await consult_the_expert(user_question, llm, faiss_db, cache, filters, context_tokens)
+        print(f"\nAssistant: {answer}")
 
+def main(embedding_backend=None, search_params=None, answer_cache='memory', answer_cache_ttl=TTL_SECONDS,
+         semantic_threshold=SIMILARITY_THRESHOLD, stream=False, llm_backends=('gemini',), llm_timeout=LLM_TIMEOUT_SECONDS,
+         stub_latency=STUB_LATENCY_SECONDS, llama_model=None, llama_threads=None, retrieval='hybrid',
+         chapters=None, topics=None, route_chapters=0, context_tokens=CONTEXT_TOKEN_BUDGET, rerank=False,
+         rerank_candidates=RERANK_CANDIDATES, rerank_budget_ms=RERANK_BUDGET_MS, rerank_keep=RERANK_KEEP):
+    """
+    Interactive consultation. Answers come from the first of `llm_backends` ('gemini', 'llamacpp', 'stub')
+    that responds within `llm_timeout` seconds. `chapters`/`topics` restrict every search to those
+    parts of the manual; otherwise `route_chapters` > 0 picks the likely chapters of each question.
+    The retrieved text is packed into at most `context_tokens` prompt tokens.
+    With `rerank`, retrieved chunks are reordered by a cross-encoder (see load_knowledge_base).
+    """
     try:
-        embeddings = HuggingFaceEmbeddings(model_name='intfloat/multilingual-e5-large')
+        llm = create_llm(llm_backends, llm_timeout, LLM_MAX_CONCURRENCY, stub_latency=stub_latency,
+                         llama_model=llama_model, llama_threads=llama_threads)
+        print(f"LLM backend configured successfully: {llm.name}.")
     except Exception as e:
-        print(f"Error loading embedding model: {e}")
+        print(f"Error configuring the LLM backend: {e}")
         return
 
     try:
-        loaded_faiss_db = FAISS.load_local(DB_PATH, embeddings, allow_dangerous_deserialization=True)
+        loaded_faiss_db = load_knowledge_base(embedding_backend, search_params, retrieval=retrieval, route_chapters=route_chapters,
+                                              rerank=rerank, rerank_candidates=rerank_candidates,
+                                              rerank_budget_ms=rerank_budget_ms, rerank_keep=rerank_keep)
         print(f"Successfully connected to FAISS.")
     except Exception as e:
-        print(f"Error connecting to FAISS: {e}")
+        print(f"Error loading the embedding model or connecting to FAISS: {e}")
         print(f"Please ensure the database exists at '{DB_PATH}'.")
         return
 
-    print("\nDog Disease Consultant is ready. Type 'exit' to quit.")
-    while True:
-        user_question = input("\nYour question: ")
-        if user_question.lower() == 'exit':
-            break
-        
-        answer = consult_the_expert(user_question, gemini_model, loaded_faiss_db)
-        print(f"\nAssistant: {answer}")
+    try:
+        filters = loaded_faiss_db.normalize_filters({"chapter": chapters, "topic": topics})
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    cache = create_answer_cache(answer_cache, answer_cache_ttl, semantic_threshold)
+    asyncio.run(consult_loop(llm, loaded_faiss_db, cache, stream, filters, context_tokens))
+
+    if cache is not None:
+        print(f"Answer cache: {cache.stats()}")
+        cache.close()
+    if loaded_faiss_db.reranker is not None:
+        print(f"Reranker: {loaded_faiss_db.reranker.stats()}")
 
 if __name__ == "__main__":
     main()
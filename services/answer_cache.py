@@ -0,0 +1,268 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from vector_dbs.embedding_cache import normalize_text
+from vector_dbs.partitions import Partitions
+from utils.metrics import METRICS
+
+ANSWER_CACHE_PATH = "data/answer_cache.sqlite"
+ANSWER_CACHE_MODES = ('off', 'memory', 'disk')
+MAX_ENTRIES = 1000
+TTL_SECONDS = 24 * 3600
+SIMILARITY_THRESHOLD = 0.95
+# Separates the question from the chapter/topic filter it was answered under in cache keys
+FILTER_SEPARATOR = '\x1f'
+
+
+def normalize_query(query):
+    '''
+    Case- and whitespace-insensitive form of a question, ignoring trailing punctuation.
+    '''
+    return re.sub(r'[\s?!.]+$', '', normalize_text(query).casefold())
+
+
+def filter_key(filters):
+    return json.dumps(Partitions.key(filters), ensure_ascii=False) if filters else ''
+
+
+def cache_key(query, filters=None):
+    '''
+    Key of the answer to a question asked under `filters` (a normalized chapter/topic filter or None),
+    so answers limited to parts of the manual and answers from the whole manual never replace each other.
+    '''
+    scope = filter_key(filters)
+    return normalize_query(query) + FILTER_SEPARATOR + scope if scope else normalize_query(query)
+
+
+class AnswerCache:
+    '''
+    Two-tier cache of LLM answers.
+
+    The exact tier matches the normalized question and is checked before retrieval. The semantic
+    tier is checked after retrieval: it matches a cached question whose embedding is within
+    `similarity_threshold` (cosine) of the new one and which retrieved the same chunks, so the
+    cached answer was written from the same context. Both tiers only match answers given under
+    the same chapter/topic filter.
+
+    Entries expire after `ttl` seconds; beyond `max_entries` the least recently used are evicted.
+    With a `path`, entries are also written to a SQLite file and survive restarts. Lookups run on
+    the server's event loop, so the writes are only queued there; a background thread commits
+    whatever has queued up in one transaction, and `close` waits for the last of them.
+    '''
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._by_chunks = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        self.conn = None
+        self._writer = None
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            # Written by the writer thread once loaded
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    chunk_ids TEXT NOT NULL,
+                    sources TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+            """)
+            self._load()
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-cache")
+
+    def _load(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl,))
+        rows = self.conn.execute(
+            "SELECT key, vector, chunk_ids, sources, answer, created_at FROM answers ORDER BY last_used DESC LIMIT ?",
+            (self.max_entries,)).fetchall()
+        for key, vector, chunk_ids, sources, answer, created_at in reversed(rows):
+            self._insert(key, {
+                "vector": np.frombuffer(vector, dtype=np.float32),
+                "chunk_ids": tuple(json.loads(chunk_ids)),
+                "sources": json.loads(sources),
+                "answer": answer,
+                "created_at": created_at,
+            })
+
+    def _write(self, sql, params):
+        '''
+        Queues a statement for the SQLite file and makes sure a flush will pick it up.
+        '''
+        with self._pending_lock:
+            self._pending.append((sql, params))
+            if len(self._pending) > 1:
+                # A flush is already queued and has not taken the pending statements yet
+                return
+        self._writer.submit(self._flush)
+
+    def _flush(self):
+        with self._pending_lock:
+            statements, self._pending = self._pending, []
+        with METRICS.span("answer_cache.flush"):
+            with self.conn:
+                for sql, params in statements:
+                    self.conn.execute(sql, params)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._by_chunks.setdefault(entry["chunk_ids"], set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._by_chunks[entry["chunk_ids"]]
+        keys.discard(key)
+        if not keys:
+            del self._by_chunks[entry["chunk_ids"]]
+        if self.conn is not None:
+            self._write("DELETE FROM answers WHERE key = ?", (key,))
+
+    def _touch(self, key):
+        self._entries.move_to_end(key)
+        if self.conn is not None:
+            self._write("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        return self._entries[key]
+
+    def _expired(self, entry):
+        return time.time() - entry["created_at"] > self.ttl
+
+    def get_exact(self, query, filters=None):
+        '''
+        Returns the cached entry ({"answer", "sources", ...}) for the question under `filters`, or None.
+        A miss here is only counted once the semantic tier has been checked too.
+        '''
+        key = cache_key(query, filters)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            self._remove(key)
+            return None
+        self.exact_hits += 1
+        METRICS.count("answer_cache_lookups", result="exact_hit")
+        return self._touch(key)
+
+    def get_semantic(self, query_vector, chunk_ids, filters=None):
+        '''
+        Returns the entry of the most similar cached question that retrieved the same chunks under
+        the same `filters`, or None.
+        '''
+        scope = filter_key(filters)
+        best_key, best_similarity = None, self.similarity_threshold
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query_vector) or 1.0
+        for key in list(self._by_chunks.get(tuple(sorted(chunk_ids)), ())):
+            entry = self._entries[key]
+            if self._expired(entry):
+                self._remove(key)
+                continue
+            if key.partition(FILTER_SEPARATOR)[2] != scope:
+                continue
+            similarity = float(entry["vector"] @ query_vector) / ((np.linalg.norm(entry["vector"]) or 1.0) * query_norm)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+
+        if best_key is None:
+            self.misses += 1
+            METRICS.count("answer_cache_lookups", result="miss")
+            return None
+        self.semantic_hits += 1
+        METRICS.count("answer_cache_lookups", result="semantic_hit")
+        return self._touch(best_key)
+
+    def put(self, query, query_vector, sources, answer, filters=None):
+        '''
+        Caches the answer to `query` asked under `filters`; `sources` is the metadata of the retrieved chunks.
+        '''
+        key = cache_key(query, filters)
+        if key in self._entries:
+            self._remove(key)
+        entry = {
+            "vector": np.asarray(query_vector, dtype=np.float32),
+            "chunk_ids": tuple(sorted(source["chunk_id"] for source in sources)),
+            "sources": sources,
+            "answer": answer,
+            "created_at": time.time(),
+        }
+        self._insert(key, entry)
+        if self.conn is not None:
+            self._write(
+                "INSERT OR REPLACE INTO answers (key, vector, chunk_ids, sources, answer, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, entry["vector"].tobytes(), json.dumps(entry["chunk_ids"]), json.dumps(sources, ensure_ascii=False),
+                 answer, entry["created_at"], entry["created_at"]))
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self.conn is not None:
+            # Commits the writes still queued
+            self._writer.shutdown()
+            self.conn.close()
+            self.conn = None
+
+
+def create_answer_cache(mode='memory', ttl=TTL_SECONDS, similarity_threshold=SIMILARITY_THRESHOLD, path=ANSWER_CACHE_PATH):
+    '''
+    Returns the answer cache for `mode` ('off', 'memory' or 'disk'), or None when caching is off.
+    '''
+    if mode not in ANSWER_CACHE_MODES:
+        raise ValueError(f"Unknown answer cache mode '{mode}'. Choose one of: {', '.join(ANSWER_CACHE_MODES)}.")
+    if mode == 'off':
+        return None
+    return AnswerCache(path if mode == 'disk' else None, ttl=ttl, similarity_threshold=similarity_threshold)
+
+
+def test():
+    cache = AnswerCache()
+    vector = np.ones(4, dtype=np.float32)
+    sources = [{"chunk_id": "1_0"}]
+    filters = {"chapter": ["Digestive Disorders of Dogs"]}
+    cache.put("Is chocolate toxic?", vector, sources, "whole manual")
+    cache.put("Is chocolate toxic?", vector, sources, "one chapter", filters)
+
+    assert cache.get_exact("is chocolate toxic")["answer"] == "whole manual"
+    assert cache.get_exact("is chocolate toxic", filters)["answer"] == "one chapter"
+    assert cache.get_exact("is chocolate toxic", {"topic": ["Chocolate Poisoning"]}) is None
+    assert cache.get_semantic(vector, ["1_0"])["answer"] == "whole manual"
+    assert cache.get_semantic(vector, ["1_0"], filters)["answer"] == "one chapter"
+    print("Filtered and unfiltered answers are cached separately.")
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,132 @@
+import asyncio
+import contextvars
+import os
+import sys
+import time
+from collections import Counter
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.metrics import METRICS
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_BATCH_WINDOW_MS = 5.0
+
+
+class QueryBatcher:
+    '''
+    Micro-batches retrieval across concurrent requests: questions arriving within `window_ms`
+    of the first one in a batch, up to `max_batch_size`, are embedded in one forward pass and
+    searched in one FAISS call on the executor.
+    Each question gets back its embedding and the retrieved documents. Questions with different
+    chapter/topic filters share the batch's forward pass; FAISS is called once per distinct filter.
+
+    At most `max_concurrent_batches` batches run at once; while they do, new questions queue up
+    and form the next batch, so batches grow with load. A longer window trades latency at low load
+    for larger batches; `max_batch_size=1` disables batching.
+    '''
+
+    def __init__(self, faiss_db, executor, k, max_batch_size=DEFAULT_MAX_BATCH_SIZE, window_ms=DEFAULT_BATCH_WINDOW_MS,
+                 max_concurrent_batches=1):
+        self.faiss_db = faiss_db
+        self.executor = executor
+        self.k = k
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window_ms / 1000
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue = None
+        self._task = None
+        self._running = set()
+
+        self.batch_sizes = Counter()
+        self.queue_wait_seconds = 0.0
+        self.batch_seconds = 0.0
+
+    async def search(self, question, filters=None):
+        '''
+        Returns (query vector, retrieved documents) for `question` once its batch has been searched.
+        '''
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((question, filters, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            batch = await self._collect()
+            task = asyncio.create_task(self._search(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _search(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.batch_sizes[len(batch)] += 1
+        self.queue_wait_seconds += sum(start - enqueued for _, _, _, enqueued in batch)
+
+        # A batch serves several requests, so it is traced on its own; the context is copied into
+        # the executor thread so that the retrieval.* spans of the batch belong to its trace
+        with METRICS.trace():
+            for _, _, _, enqueued in batch:
+                METRICS.observe("retrieval.queue_wait", start - enqueued)
+            try:
+                with METRICS.span("retrieval.batch"):
+                    search = contextvars.copy_context().run
+                    vectors, results = await loop.run_in_executor(
+                        self.executor, search, self.faiss_db.embed_and_search, [question for question, _, _, _ in batch],
+                        self.k, [filters for _, filters, _, _ in batch])
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                self.batch_seconds += time.perf_counter() - start
+                self._slots.release()
+
+        for (_, _, future, _), vector, documents in zip(batch, vectors, results):
+            if not future.done():
+                future.set_result((vector, documents))
+
+    def stats(self):
+        batches = sum(self.batch_sizes.values())
+        queries = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "batches": batches,
+            "queries": queries,
+            "mean_batch_size": queries / batches if batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "mean_queue_wait_ms": self.queue_wait_seconds / queries * 1000 if queries else 0.0,
+            "mean_batch_ms": self.batch_seconds / batches * 1000 if batches else 0.0,
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
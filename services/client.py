@@ -0,0 +1,90 @@
+import json
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_SERVER_URL = "http://127.0.0.1:8080"
+
+
+def iter_events(response):
+    '''
+    Yields (event, data) pairs of a server-sent events response, with `data` decoded from JSON.
+    '''
+    event, data = None, []
+    for raw_line in response:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+        if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+        elif not line and event is not None:
+            yield event, json.loads('\n'.join(data) or 'null')
+            event, data = None, []
+
+
+def ask(server_url, question, chapters=None, topics=None):
+    '''
+    Sends `question` to the /consult/stream endpoint of a running server and prints the sources,
+    then the answer as it arrives, like the streaming `consult` mode does.
+    Raises urllib.error.URLError when the server cannot be reached.
+    '''
+    payload = {"question": question}
+    if chapters:
+        payload["chapters"] = chapters
+    if topics:
+        payload["topics"] = topics
+    request = urllib.request.Request(f"{server_url}/consult/stream", data=json.dumps(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    first_token = None
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error", e.reason)
+        except ValueError:
+            message = e.reason
+        print(f"Error: {message}")
+        return
+
+    with response:
+        for event, data in iter_events(response):
+            if event == 'sources':
+                titles = [f"{source.get('chapter')} / {source.get('topic')}" for source in data]
+                print(f"\nSources: {'; '.join(titles) if titles else 'none found'}")
+            elif event == 'token':
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    print("\nAssistant: ", end="", flush=True)
+                print(data["text"], end="", flush=True)
+            elif event == 'error':
+                print(f"\nError: {data['error']}")
+            elif event == 'done':
+                used = (data.get("context_tokens") or {}).get("used")
+                context = f", {used} context tokens" if used is not None else ""
+                print(f"\n\n(first token after {((first_token or time.perf_counter()) - start) * 1000:.0f} ms{context}, "
+                      f"answer complete after {(time.perf_counter() - start) * 1000:.0f} ms)")
+
+
+def main(server_url=DEFAULT_SERVER_URL, question=None, chapters=None, topics=None):
+    '''
+    Asks a resident `serve` process, which keeps the embedding model, index and LLM loaded, so
+    repeated questions from the command line skip the model loading of `consult`. Only the
+    standard library is imported here. Without a `question`, questions are read interactively.
+    '''
+    try:
+        if question is not None:
+            ask(server_url, question, chapters, topics)
+            return
+        print(f"Asking the server at {server_url}. Type 'exit' to quit.")
+        while True:
+            question = input("\nYour question: ").strip()
+            if question.lower() == 'exit':
+                break
+            if question:
+                ask(server_url, question, chapters, topics)
+    except urllib.error.URLError as e:
+        print(f"Error: could not reach the server at {server_url} ({e.reason}).")
+        print("Start one with 'python main.py serve' (it keeps the models loaded between questions) or use 'consult'.")
+    except (KeyboardInterrupt, EOFError):
+        print()
@@ -0,0 +1,127 @@
+import os
+import re
+import sys
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from vector_dbs.chunking import PASSAGE_PREFIX
+
+CONTEXT_TOKEN_BUDGET = 1536
+SEPARATOR = "\n\n---\n\n"
+# Shortest shared span treated as chunk overlap rather than a coincidental repeat
+MIN_OVERLAP_CHARS = 16
+# Pieces that would be cut below this many tokens are left out instead
+MIN_PIECE_TOKENS = 32
+# Rough characters per token, for chunks saved without a token count
+CHARS_PER_TOKEN = 4
+
+
+def split_chunk_id(chunk_id):
+    '''
+    Returns (parent record ID, window number) of a chunk ID such as "<record id>_3".
+    '''
+    parent, _, index = chunk_id.rpartition('_')
+    if not parent or not index.isdigit():
+        return chunk_id, 0
+    return parent, int(index)
+
+
+def strip_prefix(text):
+    return text[len(PASSAGE_PREFIX):] if text.startswith(PASSAGE_PREFIX) else text
+
+
+def overlap_length(left, right):
+    '''
+    Length of the longest suffix of `left` that is also a prefix of `right` (0 if shorter than MIN_OVERLAP_CHARS).
+    '''
+    if len(left) < MIN_OVERLAP_CHARS or len(right) < MIN_OVERLAP_CHARS:
+        return 0
+    head = right[:MIN_OVERLAP_CHARS]
+    start = left.find(head, max(0, len(left) - len(right)))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(head, start + 1)
+    return 0
+
+
+def chunk_tokens(doc):
+    '''
+    Prompt tokens of a retrieved chunk as it used to be sent, prefix included.
+    '''
+    return doc.metadata.get("token_count") or len(doc.page_content) // CHARS_PER_TOKEN + 1
+
+
+def _spans(documents):
+    '''
+    Merges the chunks of each parent record into runs of consecutive windows. Returns a list of
+    (text, tokens per character) per run, parents in order of their best-ranked chunk and runs
+    in document order within a parent.
+    '''
+    by_parent = {}
+    for doc in documents:
+        parent, index = split_chunk_id(doc.metadata.get("chunk_id", ""))
+        by_parent.setdefault(parent, {})[index] = doc
+
+    spans = []
+    for windows in by_parent.values():
+        text, previous = None, None
+        for index in sorted(windows):
+            doc = windows[index]
+            piece = strip_prefix(doc.page_content)
+            if text is not None and index == previous + 1:
+                text += piece[overlap_length(text, piece):]
+                tokens += chunk_tokens(doc)
+                chars += len(doc.page_content)
+            else:
+                if text is not None:
+                    spans.append((text, tokens / max(chars, 1)))
+                text, tokens, chars = piece, chunk_tokens(doc), len(doc.page_content)
+            previous = index
+        spans.append((text, tokens / max(chars, 1)))
+    return spans
+
+
+def _truncate(text, max_chars):
+    '''
+    Cuts `text` to at most `max_chars`, preferably after a sentence, otherwise between words.
+    '''
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    sentence_end = max((m.end() for m in re.finditer(r'[.!?](\s|$)', cut)), default=0)
+    if sentence_end > max_chars // 2:
+        return cut[:sentence_end].rstrip()
+    return cut.rsplit(None, 1)[0] if ' ' in cut else cut
+
+
+def build_context(documents, token_budget=CONTEXT_TOKEN_BUDGET):
+    '''
+    Assembles the prompt context from retrieved chunks, most relevant first.
+
+    The "passage: " prefixes are stripped, consecutive windows of the same record are merged with
+    their shared overlap kept once, and text is added until `token_budget` (estimated from the
+    chunks' token counts) is reached; the last piece that does not fit is cut at a sentence.
+    Returns {"text", "tokens", "chunk_tokens", "saved_tokens"}, where `chunk_tokens` is what the
+    chunks would have cost joined verbatim.
+    '''
+    naive_tokens = sum(chunk_tokens(doc) for doc in documents)
+    pieces, tokens = [], 0
+    for text, density in _spans(documents):
+        remaining = token_budget - tokens
+        piece_tokens = round(len(text) * density)
+        if piece_tokens > remaining:
+            if remaining < MIN_PIECE_TOKENS:
+                break
+            text = _truncate(text, int(remaining / density))
+            piece_tokens = round(len(text) * density)
+        pieces.append(text)
+        tokens += piece_tokens
+
+    return {
+        "text": SEPARATOR.join(pieces),
+        "tokens": tokens,
+        "chunk_tokens": naive_tokens,
+        "saved_tokens": max(0, naive_tokens - tokens),
+    }
@@ -0,0 +1,264 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.metrics import METRICS
+
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 1024,
+    "top_p": 1,
+    "top_k": 1,
+}
+LLM_BACKENDS = ('gemini', 'llamacpp', 'stub')
+STUB_LATENCY_SECONDS = 1.0
+LLM_TIMEOUT_SECONDS = 30.0
+LLM_MAX_CONCURRENCY = 8
+LLAMA_CONTEXT_TOKENS = 4096
+
+
+class GeminiLLM:
+    '''
+    Asynchronous client of the Gemini API. The model object, and with it the API connection,
+    is created once and reused by every request.
+    '''
+
+    name = 'gemini'
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL_NAME, generation_config=GENERATION_CONFIG, timeout=LLM_TIMEOUT_SECONDS):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+        self.generation_config = generation_config
+        self.request_options = {"timeout": timeout}
+
+    async def generate(self, prompt):
+        response = await self.model.generate_content_async(
+            prompt, generation_config=self.generation_config, request_options=self.request_options)
+        return response.text
+
+    async def stream(self, prompt):
+        '''
+        Yields pieces of the answer as Gemini generates them.
+        '''
+        response = await self.model.generate_content_async(
+            prompt, generation_config=self.generation_config, request_options=self.request_options, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class LlamaCppLLM:
+    '''
+    Local CPU model in GGUF format, run with llama.cpp (`pip install llama-cpp-python`).
+
+    The model is loaded once and generates on a dedicated thread, one answer at a time;
+    pieces of the answer are handed to the event loop as they are produced.
+    '''
+
+    name = 'llamacpp'
+
+    def __init__(self, model_path, threads=None, context_tokens=LLAMA_CONTEXT_TOKENS, generation_config=GENERATION_CONFIG):
+        from llama_cpp import Llama
+
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"GGUF model not found at '{model_path}'.")
+        self.model = Llama(model_path=model_path, n_ctx=context_tokens, n_threads=threads, verbose=False)
+        self.generation_config = generation_config
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llamacpp")
+
+    def _generate(self, prompt, on_piece, cancelled):
+        completion = self.model.create_chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.generation_config["max_output_tokens"],
+            temperature=self.generation_config["temperature"],
+            top_p=self.generation_config["top_p"],
+            top_k=self.generation_config["top_k"],
+            stream=True,
+        )
+        for chunk in completion:
+            if cancelled.is_set():
+                break
+            piece = chunk["choices"][0]["delta"].get("content")
+            if piece:
+                on_piece(piece)
+
+    async def stream(self, prompt):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def run():
+            try:
+                self._generate(prompt, lambda piece: loop.call_soon_threadsafe(queue.put_nowait, piece), cancelled)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        future = loop.run_in_executor(self.executor, run)
+        try:
+            while (piece := await queue.get()) is not done:
+                yield piece
+            await future
+        finally:
+            # Stops generation early when the caller gives up, e.g. on a timeout
+            cancelled.set()
+
+    async def generate(self, prompt):
+        return ''.join([piece async for piece in self.stream(prompt)])
+
+
+class StubLLM:
+    '''
+    Offline stand-in for the LLM: returns a deterministic answer after `latency` seconds,
+    so serving throughput can be measured without network access or API quota.
+    When streaming, the words of the answer arrive evenly spread over that time.
+    '''
+
+    name = 'stub'
+
+    def __init__(self, latency=STUB_LATENCY_SECONDS):
+        self.latency = latency
+
+    @staticmethod
+    def answer(prompt):
+        return f"Stub answer to a prompt of {len(prompt)} characters."
+
+    async def generate(self, prompt):
+        await asyncio.sleep(self.latency)
+        return self.answer(prompt)
+
+    async def stream(self, prompt):
+        words = self.answer(prompt).split(' ')
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield word if i == 0 else ' ' + word
+
+
+class FailoverLLM:
+    '''
+    Puts timeouts, concurrency limits and failover in front of a list of backends, in order of preference.
+
+    Each backend handles at most `max_concurrency` requests at a time; a request that fails or
+    gets no answer (for streams: no next piece) within `timeout` seconds is retried on the next
+    backend. A stream only fails over before its first piece, since the client already has the
+    beginning of the answer after that.
+    '''
+
+    def __init__(self, backends, timeout=LLM_TIMEOUT_SECONDS, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.backends = backends
+        self.timeout = timeout
+        self._slots = {backend.name: asyncio.Semaphore(max_concurrency) for backend in backends}
+        self.requests = Counter()
+        self.failures = Counter()
+        self.timeouts = Counter()
+        self.latency_seconds = Counter()
+
+    @property
+    def name(self):
+        return ' -> '.join(backend.name for backend in self.backends)
+
+    async def generate(self, prompt):
+        errors = []
+        for backend in self.backends:
+            self.requests[backend.name] += 1
+            start = time.perf_counter()
+            try:
+                async with self._slots[backend.name]:
+                    answer = await asyncio.wait_for(backend.generate(prompt), self.timeout)
+                self._record_success(backend, "llm.generate", time.perf_counter() - start)
+                return answer
+            except Exception as e:
+                errors.append(self._record_failure(backend, e))
+        raise RuntimeError("; ".join(errors))
+
+    async def stream(self, prompt):
+        errors = []
+        for backend in self.backends:
+            self.requests[backend.name] += 1
+            start = time.perf_counter()
+            started = False
+            try:
+                async with self._slots[backend.name]:
+                    pieces = backend.stream(prompt)
+                    try:
+                        while True:
+                            try:
+                                piece = await asyncio.wait_for(pieces.__anext__(), self.timeout)
+                            except StopAsyncIteration:
+                                break
+                            started = True
+                            yield piece
+                    finally:
+                        await pieces.aclose()
+                self._record_success(backend, "llm.stream", time.perf_counter() - start)
+                return
+            except Exception as e:
+                errors.append(self._record_failure(backend, e))
+                if started:
+                    raise
+        raise RuntimeError("; ".join(errors))
+
+    def _record_success(self, backend, span, seconds):
+        self.latency_seconds[backend.name] += seconds
+        METRICS.count("llm_requests", backend=backend.name, outcome="ok")
+        METRICS.observe(span, seconds, backend=backend.name)
+
+    def _record_failure(self, backend, error):
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts[backend.name] += 1
+            METRICS.count("llm_requests", backend=backend.name, outcome="timeout")
+            return f"{backend.name} timed out after {self.timeout}s"
+        self.failures[backend.name] += 1
+        METRICS.count("llm_requests", backend=backend.name, outcome="failure")
+        return f"{backend.name} failed: {error}"
+
+    def stats(self):
+        stats = {}
+        for backend in self.backends:
+            name = backend.name
+            succeeded = self.requests[name] - self.failures[name] - self.timeouts[name]
+            stats[name] = {
+                "requests": self.requests[name],
+                "failures": self.failures[name],
+                "timeouts": self.timeouts[name],
+                "mean_latency_ms": self.latency_seconds[name] / succeeded * 1000 if succeeded else 0.0,
+            }
+        return stats
+
+
+def create_backend(name, stub_latency=STUB_LATENCY_SECONDS, llama_model=None, llama_threads=None, timeout=LLM_TIMEOUT_SECONDS):
+    '''
+    Creates one LLM backend: 'gemini' (needs GOOGLE_API_KEY), 'llamacpp' (needs a GGUF `llama_model`) or 'stub'.
+    Raises ValueError when the backend cannot be set up.
+    '''
+    if name == 'gemini':
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if api_key is None:
+            raise ValueError("GOOGLE_API_KEY environment variable is not set. "
+                             "Example: export GOOGLE_API_KEY='YOUR_API_KEY', or use another LLM backend.")
+        return GeminiLLM(api_key, timeout=timeout)
+    if name == 'llamacpp':
+        if not llama_model:
+            raise ValueError("The 'llamacpp' backend needs the path of a GGUF model (--llama-model).")
+        return LlamaCppLLM(llama_model, threads=llama_threads)
+    if name == 'stub':
+        return StubLLM(stub_latency)
+    raise ValueError(f"Unknown LLM backend '{name}'. Choose one of: {', '.join(LLM_BACKENDS)}.")
+
+
+def create_llm(names, timeout=LLM_TIMEOUT_SECONDS, max_concurrency=LLM_MAX_CONCURRENCY, **backend_options):
+    '''
+    Returns a FailoverLLM over the named backends, tried in the given order.
+    '''
+    backends = [create_backend(name, timeout=timeout, **backend_options) for name in dict.fromkeys(names)]
+    return FailoverLLM(backends, timeout, max_concurrency)
@@ -0,0 +1,332 @@
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.agent import TOP_K, build_prompt, load_knowledge_base, packed_context
+from services.answer_cache import SIMILARITY_THRESHOLD, TTL_SECONDS, create_answer_cache
+from services.context import CONTEXT_TOKEN_BUDGET
+from services.batching import DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE, QueryBatcher
+from vector_dbs.reranker import RERANK_BUDGET_MS, RERANK_CANDIDATES, RERANK_KEEP
+from services.llm import LLM_MAX_CONCURRENCY, LLM_TIMEOUT_SECONDS, STUB_LATENCY_SECONDS, create_llm
+from utils.metrics import METRICS
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_RETRIEVAL_THREADS = 4
+# Number of recent time-to-first-token samples kept for /stats
+TTFT_SAMPLES = 1000
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class ConsultService:
+    '''
+    Answers consultations concurrently: retrieval (query embedding and FAISS search) runs on
+    a thread pool, so it never blocks the event loop, while LLM calls are awaited, so many
+    consultations can wait on the LLM at the same time. Questions arriving together are
+    retrieved in micro-batches (see `QueryBatcher`), and answers already given are served
+    from the `answer_cache` when there is one.
+    '''
+
+    def __init__(self, faiss_db, llm, retrieval_threads=DEFAULT_RETRIEVAL_THREADS, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 batch_window_ms=DEFAULT_BATCH_WINDOW_MS, answer_cache=None, context_tokens=CONTEXT_TOKEN_BUDGET):
+        self.faiss_db = faiss_db
+        self.llm = llm
+        self.answer_cache = answer_cache
+        self.context_tokens = context_tokens
+        self.prompts = 0
+        self.prompt_context_tokens = 0
+        self.prompt_tokens_saved = 0
+        self.ttft_ms = deque(maxlen=TTFT_SAMPLES)
+        self.executor = ThreadPoolExecutor(max_workers=retrieval_threads, thread_name_prefix="retrieval")
+        self.batcher = QueryBatcher(faiss_db, self.executor, TOP_K, max_batch_size, batch_window_ms,
+                                    max_concurrent_batches=retrieval_threads)
+
+    async def retrieve(self, question, filters=None):
+        # Includes the wait for the question's batch; the retrieval.* spans time the batch itself
+        with METRICS.span("consult.retrieve"):
+            return await self.batcher.search(question, filters)
+
+    async def _lookup(self, question, filters, start):
+        '''
+        Checks the exact answer cache, retrieves, then checks the semantic answer cache, both for
+        answers given under the same chapter/topic filter. Returns (cached entry or None, cache tier,
+        query vector, documents, time retrieval finished).
+        '''
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get_exact(question, filters)
+            if cached is not None:
+                return cached, "exact", None, None, start
+
+        query_vector, documents = await self.retrieve(question, filters)
+        retrieved = time.perf_counter()
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get_semantic(query_vector, [doc.metadata["chunk_id"] for doc in documents], filters)
+            if cached is not None:
+                return cached, "semantic", query_vector, documents, retrieved
+        return None, None, query_vector, documents, retrieved
+
+    def _context(self, documents):
+        context = packed_context(documents, self.context_tokens)
+        self.prompts += 1
+        self.prompt_context_tokens += context["tokens"]
+        self.prompt_tokens_saved += context["saved_tokens"]
+        return context
+
+    async def consult(self, question, filters=None):
+        with METRICS.span("consult", mode="answer"):
+            start = time.perf_counter()
+            cached, cache_hit, query_vector, documents, retrieved = await self._lookup(question, filters, start)
+            if cached is not None:
+                return self._response(cached["answer"], cached["sources"], cache_hit, start, retrieved)
+
+            sources = [doc.metadata for doc in documents]
+            context = self._context(documents)
+            answer = await self.llm.generate(build_prompt(question, context))
+            if self.answer_cache is not None:
+                self.answer_cache.put(question, query_vector, sources, answer, filters)
+            return self._response(answer, sources, None, start, retrieved, context)
+
+    async def consult_stream(self, question, filters=None):
+        '''
+        Streaming variant of `consult`: yields ('sources', [...]) as soon as retrieval is done,
+        then ('token', text) pieces as the LLM writes them, and finally ('done', {...}) with
+        the cache tier, prompt context size and timings, including the time to the first token.
+        Its spans are recorded from these timings rather than with `METRICS.span`, which must not
+        stay open across a yield.
+        '''
+        start = time.perf_counter()
+        context = None
+        cached, cache_hit, query_vector, documents, retrieved = await self._lookup(question, filters, start)
+        if cached is not None:
+            yield 'sources', cached["sources"]
+            first_token = time.perf_counter()
+            yield 'token', cached["answer"]
+        else:
+            sources = [doc.metadata for doc in documents]
+            yield 'sources', sources
+            context = self._context(documents)
+            first_token = None
+            pieces = []
+            async for piece in self.llm.stream(build_prompt(question, context)):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                pieces.append(piece)
+                yield 'token', piece
+            if self.answer_cache is not None:
+                self.answer_cache.put(question, query_vector, sources, ''.join(pieces), filters)
+
+        finished = time.perf_counter()
+        first_token = first_token or finished
+        self.ttft_ms.append((first_token - start) * 1000)
+        METRICS.observe("consult.first_token", first_token - start)
+        METRICS.observe("consult", finished - start, mode="stream")
+        yield 'done', {
+            "cache_hit": cache_hit,
+            "context_tokens": self._context_tokens(context),
+            "timings_ms": {
+                "retrieval": (retrieved - start) * 1000,
+                "first_token": (first_token - start) * 1000,
+                "total": (finished - start) * 1000,
+            },
+        }
+
+    @staticmethod
+    def _context_tokens(context):
+        if context is None:
+            return None
+        return {"used": context["tokens"], "saved": context["saved_tokens"]}
+
+    @classmethod
+    def _response(cls, answer, sources, cache_hit, start, retrieved, context=None):
+        finished = time.perf_counter()
+        return {
+            "answer": answer,
+            "sources": sources,
+            "cache_hit": cache_hit,
+            "context_tokens": cls._context_tokens(context),
+            "timings_ms": {
+                "retrieval": (retrieved - start) * 1000,
+                "llm": (finished - retrieved) * 1000,
+                "total": (finished - start) * 1000,
+            },
+        }
+
+    def stats(self):
+        stats = {"batching": self.batcher.stats(), "llm": self.llm.stats()}
+        if self.prompts:
+            stats["context"] = {
+                "prompts": self.prompts,
+                "mean_tokens": self.prompt_context_tokens / self.prompts,
+                "mean_tokens_saved": self.prompt_tokens_saved / self.prompts,
+                "tokens_saved": self.prompt_tokens_saved,
+            }
+        if self.ttft_ms:
+            ttft = sorted(self.ttft_ms)
+            stats["streaming"] = {
+                "samples": len(ttft),
+                "ttft_ms_p50": ttft[len(ttft) // 2],
+                "ttft_ms_p95": ttft[min(len(ttft) - 1, int(len(ttft) * 0.95))],
+            }
+        if self.answer_cache is not None:
+            stats["answer_cache"] = self.answer_cache.stats()
+        if self.faiss_db.reranker is not None:
+            stats["reranker"] = self.faiss_db.reranker.stats()
+        return stats
+
+    async def close(self):
+        await self.batcher.close()
+        self.executor.shutdown()
+        if self.answer_cache is not None:
+            self.answer_cache.close()
+
+
+async def read_question(request):
+    '''
+    Returns (question, chapter/topic filter or None) of a JSON request body.
+    Raises ValueError if there is no question or the filter names unknown chapters or topics.
+    '''
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict) or not str(payload.get("question", "")).strip():
+        raise ValueError("Request body must be JSON with a 'question'.")
+    filters = {"chapter": payload.get("chapters"), "topic": payload.get("topics")}
+    return str(payload["question"]).strip(), request.app['service'].faiss_db.normalize_filters(filters)
+
+
+async def handle_consult(request):
+    try:
+        question, filters = await read_question(request)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    try:
+        with METRICS.trace():
+            return web.json_response(await request.app['service'].consult(question, filters))
+    except Exception as e:
+        return web.json_response({"error": f"Error answering the question: {e}"}, status=502)
+
+
+async def handle_consult_stream(request):
+    '''
+    Server-sent events: a 'sources' event with the retrieved chunks' metadata, 'token' events
+    with pieces of the answer, then 'done' with timings (or 'error').
+    '''
+    try:
+        question, filters = await read_question(request)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    try:
+        with METRICS.trace():
+            async for event, data in request.app['service'].consult_stream(question, filters):
+                payload = {"text": data} if event == 'token' else data
+                await response.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+    except ConnectionResetError:
+        METRICS.count("stream_disconnects")
+        return response
+    except Exception as e:
+        METRICS.count("errors", stage="consult")
+        error = json.dumps({"error": f"Error answering the question: {e}"})
+        await response.write(f"event: error\ndata: {error}\n\n".encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def handle_health(request):
+    return web.json_response({"status": "ok", "documents": len(request.app['service'].faiss_db)})
+
+
+async def handle_chapters(request):
+    partitions = request.app['service'].faiss_db.partitions
+    if partitions is None:
+        return web.json_response({"chapters": {}})
+    return web.json_response({"chapters": partitions.topics_by_chapter})
+
+
+async def handle_stats(request):
+    return web.json_response({**request.app['service'].stats(), "metrics": METRICS.snapshot()})
+
+
+async def handle_metrics(request):
+    '''
+    The stage timings and counters in the Prometheus text format, for scraping.
+    '''
+    return web.Response(text=METRICS.prometheus_text(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+
+
+def create_app(service):
+    app = web.Application()
+    app['service'] = service
+    app.add_routes([
+        web.post('/consult', handle_consult),
+        web.post('/consult/stream', handle_consult_stream),
+        web.get('/health', handle_health),
+        web.get('/chapters', handle_chapters),
+        web.get('/stats', handle_stats),
+        web.get('/metrics', handle_metrics),
+    ])
+
+    async def close_service(app):
+        await app['service'].close()
+
+    app.on_cleanup.append(close_service)
+    return app
+
+
+def main(host=DEFAULT_HOST, port=DEFAULT_PORT, llm_backends=('gemini',), embedding_backend=None, search_params=None,
+         retrieval_threads=DEFAULT_RETRIEVAL_THREADS, stub_latency=STUB_LATENCY_SECONDS,
+         max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_window_ms=DEFAULT_BATCH_WINDOW_MS, answer_cache='memory',
+         answer_cache_ttl=TTL_SECONDS, semantic_threshold=SIMILARITY_THRESHOLD, llm_timeout=LLM_TIMEOUT_SECONDS,
+         llm_concurrency=LLM_MAX_CONCURRENCY, llama_model=None, llama_threads=None, retrieval='hybrid',
+         route_chapters=0, context_tokens=CONTEXT_TOKEN_BUDGET, rerank=False, rerank_candidates=RERANK_CANDIDATES,
+         rerank_budget_ms=RERANK_BUDGET_MS, rerank_keep=RERANK_KEEP):
+    '''
+    Serves the consultant over HTTP: POST /consult with {"question": "..."} returns the answer,
+    the metadata of the retrieved chunks and per-stage timings, and POST /consult/stream streams
+    them as server-sent events. GET /health reports readiness and GET /stats the retrieval batch
+    sizes, LLM backend health, answer cache hit rates, time to first token and per-stage timings,
+    which GET /metrics exports in the Prometheus text format.
+
+    The embedding model, the index and the LLM backends are loaded once at startup. Answers come
+    from the first of `llm_backends` that responds within `llm_timeout` seconds; use 'stub' to
+    serve canned answers after a fixed `stub_latency`, e.g. for offline throughput benchmarks.
+    Chunks are retrieved with BM25 and dense search fused (`retrieval='hybrid'`) or dense search only.
+    Requests may restrict retrieval with "chapters" and "topics" lists (GET /chapters lists them);
+    with `route_chapters` > 0, other questions are searched in their most likely chapters only.
+    The retrieved text is packed into at most `context_tokens` prompt tokens, after the optional
+    cross-encoder reranking (`rerank`) has picked the best `rerank_keep` of `rerank_candidates` chunks.
+    '''
+    try:
+        llm = create_llm(llm_backends, llm_timeout, llm_concurrency, stub_latency=stub_latency,
+                         llama_model=llama_model, llama_threads=llama_threads)
+    except Exception as e:
+        print(f"Error configuring the LLM backend: {e}")
+        return
+
+    try:
+        faiss_db = load_knowledge_base(embedding_backend, search_params, retrieval=retrieval, route_chapters=route_chapters,
+                                       rerank=rerank, rerank_candidates=rerank_candidates, rerank_budget_ms=rerank_budget_ms,
+                                       rerank_keep=rerank_keep)
+    except Exception as e:
+        print(f"Error loading the embedding model or connecting to FAISS: {e}")
+        return
+    print(f"Loaded FAISS index with {len(faiss_db)} chunks; answering with: {llm.name}.")
+
+    service = ConsultService(faiss_db, llm, retrieval_threads, max_batch_size, batch_window_ms,
+                             create_answer_cache(answer_cache, answer_cache_ttl, semantic_threshold), context_tokens)
+    web.run_app(create_app(service), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import io
+import json
+import os
+import time
+
+CORPUS_PATH = "data/msdvetmanual_dog_owners_data.jsonl"
+FOLLOW_POLL_SECONDS = 0.5
+
+
+def _in_progress_marker(path):
+    return path + ".inprogress"
+
+
+def _partial_path(path):
+    return path + ".tmp"
+
+
+def _writer_running(path):
+    """
+    Whether the corpus at `path` is still being written: its in-progress marker exists and the
+    process ID recorded in it is alive. Raises RuntimeError when the writer died before finishing.
+    """
+    try:
+        with open(_in_progress_marker(path), "r") as f:
+            content = f.read().strip()
+    except FileNotFoundError:
+        return False
+    try:
+        pid = int(content)
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except (ValueError, ProcessLookupError):
+        raise RuntimeError(f"The writer of '{path}' stopped before finishing it (marker '{_in_progress_marker(path)}' "
+                           f"left behind); its records so far are in '{_partial_path(path)}'. Run it again.")
+    return True
+
+
+def _open_text(path, mode, compressed=None):
+    """
+    Opens a corpus file for text reading or writing, transparently (de)compressing '.zst' files
+    (or any file with `compressed=True`).
+    """
+    if compressed is None:
+        compressed = path.endswith(".zst")
+    if not compressed:
+        return open(path, mode, encoding="utf-8")
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing '.zst' corpora requires the 'zstandard' package: pip install zstandard")
+
+    raw = open(path, mode + "b")
+    if mode == "w":
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    else:
+        stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+class CorpusWriter:
+    """
+    Writes corpus records as JSON lines, one record at a time, to '<path>.tmp', which replaces
+    the corpus file only on `commit`. A failed or interrupted run therefore never leaves a
+    partial corpus in its place, for `create_db` to mistake for the whole manual.
+
+    While writing, a '<path>.inprogress' marker holding the writer's process ID exists next to
+    the file, so readers using `iter_records(path, follow=True)` read the records as they are
+    written and keep waiting for new ones. A writer closed without committing leaves the marker
+    behind; followers then see that its process is gone and fail instead of waiting forever.
+    Uncompressed corpora are flushed after every record. Used as a context manager, the writer
+    commits when the block ends without an exception.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.committed = False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(_in_progress_marker(path), "w") as f:
+            f.write(str(os.getpid()))
+        self._file = _open_text(_partial_path(path), "w", compressed=path.endswith(".zst"))
+        self._flush_each = not path.endswith(".zst")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if self._flush_each:
+            self._file.flush()
+        self.count += 1
+
+    def commit(self):
+        """
+        Closes the file and moves it onto the corpus path.
+        """
+        self._file.close()
+        os.replace(_partial_path(self.path), self.path)
+        self.committed = True
+        if os.path.exists(_in_progress_marker(self.path)):
+            os.remove(_in_progress_marker(self.path))
+
+    def close(self):
+        """
+        Closes the file; without a `commit`, the corpus file is left as it was.
+        """
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None and not self.committed:
+            self.commit()
+        else:
+            self.close()
+
+
+def iter_records(path, follow=False):
+    """
+    Lazily yields the records of a corpus file.
+
+    JSONL files (optionally '.zst' compressed) are read line by line. Legacy '.json'
+    files holding a single array are still accepted, but are loaded in one go.
+    With `follow=True`, reading an uncompressed corpus that is still being written
+    waits for new records until the writer commits it, and raises RuntimeError if the
+    writer's process died before that.
+    """
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    source = path
+    if follow and _writer_running(path):
+        # Records are written to the partial file, which becomes the corpus when the writer commits
+        source = _partial_path(path)
+    try:
+        f = _open_text(source, "r", compressed=path.endswith(".zst"))
+    except FileNotFoundError:
+        if source == path:
+            raise
+        # The writer committed in the meantime
+        f = _open_text(path, "r")
+
+    with f:
+        pending = ""
+        while True:
+            line = f.readline()
+            if line:
+                pending += line
+                # A line without its newline is a record the writer has not finished yet
+                if not pending.endswith("\n"):
+                    continue
+                if pending.strip():
+                    yield json.loads(pending)
+                pending = ""
+            elif follow and _writer_running(path):
+                time.sleep(FOLLOW_POLL_SECONDS)
+            else:
+                break
+        if pending.strip():
+            yield json.loads(pending)
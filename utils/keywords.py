@@ -1,52 +1,178 @@
 import json
+import re
 import sys
 import os
-from keybert import KeyBERT
+import unicodedata
+from collections import Counter
+import numpy as np
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-def process_json_with_keybert(input_filename, output_filename):
+from utils.corpus import CORPUS_PATH, CorpusWriter, iter_records
+from vector_dbs.chunking import PASSAGE_PREFIX, iter_chunks
+
+KEYWORDS_PER_TEXT = 5
+MAX_PHRASE_WORDS = 2
+# Only the most frequent candidate phrases of each text are embedded and scored
+MAX_CANDIDATES = 32
+MIN_WORD_LENGTH = 3
+# Records (or chunks) whose candidate phrases are embedded together in one call
+KEYWORD_BATCH_SIZE = 256
+KEYWORDS_OUTPUT_PATH = 'data/msdvetmanual_dog_owners_data_with_keywords.jsonl'
+
+# Candidate phrases never start, end or run across these words
+STOP_WORDS = frozenset('''
+a about above after again against all also am an and any are as at be because been before being below between both
+but by can could did do does doing down during each either even ever few for from further had has have having he her
+here hers herself him himself his how however if in into is it its itself just may me might more most much must my
+myself no nor not now of off often on once only or other our ours ourselves out over own same she should since so
+some such than that the their theirs them themselves then there these they this those through to too under until up
+usually very was we were what when where whether which while who whom why will with within without would you your
+yours yourself yourselves dog dogs
+а аби або але без би був була були було бути в вам вас ви від він вона вони воно все всі де для до його її з за
+зі і й їх їм к коли крім лише ми на над не нею ним них ні о обо от па по під при про та так також там те тим
+то тобто того тому у хоча це цей ці цього чи чим що щоб як яка які який якщо собак собаки собака
+'''.split())
+
+_WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")
+
+
+def candidate_phrases(text, max_words=MAX_PHRASE_WORDS, max_candidates=MAX_CANDIDATES):
+    '''
+    Returns the `max_candidates` most frequent phrases of 1 to `max_words` consecutive content words
+    of `text` (lowercased, English or Ukrainian), most frequent first.
+    '''
+    if text.startswith(PASSAGE_PREFIX):
+        text = text[len(PASSAGE_PREFIX):]
+    counts = Counter()
+    run = []
+    for word in _WORD_PATTERN.findall(unicodedata.normalize('NFC', text).casefold()) + [None]:
+        if word is not None and len(word) >= MIN_WORD_LENGTH and word not in STOP_WORDS:
+            run.append(word)
+            continue
+        for n in range(1, max_words + 1):
+            counts.update(' '.join(run[i:i + n]) for i in range(len(run) - n + 1))
+        run = []
+    return [phrase for phrase, _ in counts.most_common(max_candidates)]
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def extract_keywords(texts, vectors, embeddings, top_n=KEYWORDS_PER_TEXT):
+    '''
+    Returns the `top_n` keyphrases of each text: its candidate phrases ranked by the cosine
+    similarity of their embedding to the text's own embedding (a row of `vectors`), as KeyBERT does.
+
+    The text embeddings are the ones already computed for the index, so only the candidate phrases
+    are embedded: those of the whole batch at once, each distinct phrase once, through `embeddings`
+    (a CachedEmbeddings, so phrases seen in earlier builds are not embedded again).
+    '''
+    candidates = [candidate_phrases(text) for text in texts]
+    phrases = list(dict.fromkeys(phrase for text_phrases in candidates for phrase in text_phrases))
+    if not phrases:
+        return [[] for _ in texts]
+    rows = {phrase: row for row, phrase in enumerate(phrases)}
+    phrase_vectors = _normalized(embeddings.embed_documents(phrases))
+
+    keywords = []
+    for text_vector, text_phrases in zip(_normalized(vectors), candidates):
+        scores = phrase_vectors[[rows[phrase] for phrase in text_phrases]] @ text_vector if text_phrases else []
+        keywords.append([text_phrases[i] for i in np.argsort(-np.asarray(scores), kind='stable')[:top_n]])
+    return keywords
+
+
+def add_keywords(documents, vectors, embeddings, top_n=KEYWORDS_PER_TEXT, batch_size=KEYWORD_BATCH_SIZE):
+    '''
+    Stores the keyphrases of each chunk under its metadata's "keywords", where the BM25 index
+    picks them up. `vectors` are the chunks' embeddings, in the order of `documents`.
+    '''
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        keywords = extract_keywords([doc.page_content for doc in batch], vectors[start:start + batch_size], embeddings, top_n)
+        for doc, doc_keywords in zip(batch, keywords):
+            doc.metadata["keywords"] = doc_keywords
+
+
+def _record_vectors(records, tokenizer, embeddings):
+    '''
+    Returns {record ID: embedding}, each the mean of the embeddings of the record's index chunks,
+    which come from the embedding cache when the index has been built.
+    '''
+    chunks = list(iter_chunks(records, tokenizer))
+    if not chunks:
+        return {}
+    vectors_by_record = {}
+    for chunk, vector in zip(chunks, _normalized(embeddings.embed_documents([chunk['text'] for chunk in chunks]))):
+        vectors_by_record.setdefault(chunk['metadata']['chunk_id'].rpartition('_')[0], []).append(vector)
+    return {record_id: np.mean(vectors, axis=0) for record_id, vectors in vectors_by_record.items()}
+
+
+def process_corpus(input_filename, output_filename, workers=None, batch_size=KEYWORD_BATCH_SIZE, backend=None,
+                   top_n=KEYWORDS_PER_TEXT):
     """
-    Opens a JSON file, applies KeyBERT to the 'text' field of each entry,
-    and saves the modified data to a new JSON file with keywords.
+    Streams the entries of a corpus file, extracts the keyphrases of the 'text' field of each entry,
+    and writes the entries with their "keywords" to a new JSONL corpus file as each batch is done.
+
+    Keyphrases are scored with the multilingual E5 model the index uses (see `extract_keywords`),
+    so Ukrainian pages get keywords too. Entries are processed `batch_size` at a time; embedding
+    runs on `workers` processes, and chunks and phrases already embedded come from the embedding cache.
 
     Args:
-        input_filename (str): The path to the input JSON file.
-        output_filename (str): The path to the output JSON file.
+        input_filename (str): The path to the input corpus file (JSONL, '.jsonl.zst' or legacy JSON array).
+        output_filename (str): The path to the output corpus file.
     """
-    try:
-        with open(input_filename, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
+    if not os.path.exists(input_filename):
         print(f"Error: The file '{input_filename}' was not found.")
         return
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from '{input_filename}'. Please ensure it's valid JSON.")
-        return
 
-    kw_model = KeyBERT()
+    from transformers import AutoTokenizer
+    from vector_dbs.embedding_cache import CachedEmbeddings
+    from vector_dbs.embedding_pool import ParallelEmbeddings
+    from vector_dbs.embeddings import EMBEDDING_MODEL, cache_model_key
+    from vector_dbs.faiss_db import indexed_backend
 
-    if not isinstance(data, list):
-        print("Error: The JSON structure is not supported. It should be a list of objects.")
-        return
+    backend = backend or indexed_backend()
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    embedding_pool = ParallelEmbeddings(EMBEDDING_MODEL, workers=workers, backend=backend)
+    embeddings = CachedEmbeddings(embedding_pool, cache_model_key(EMBEDDING_MODEL, backend))
 
-    processed_data = []
-    for entry in data:
-        if "text" in entry and isinstance(entry["text"], str):
-            keywords_with_probs = kw_model.extract_keywords(entry["text"])
-            keywords_only = [keyword for keyword, _ in keywords_with_probs]
-            entry["keywords"] = keywords_only
-        processed_data.append(entry)
+    def write_batch(writer, batch):
+        records = [entry for entry in batch if isinstance(entry.get("text"), str) and entry.get("id") is not None]
+        vectors = _record_vectors(records, tokenizer, embeddings) if records else {}
+        records = [entry for entry in records if str(entry["id"]) in vectors]
+        if records:
+            keywords = extract_keywords([entry["text"] for entry in records], [vectors[str(entry["id"])] for entry in records],
+                                        embeddings, top_n)
+            for entry, entry_keywords in zip(records, keywords):
+                entry["keywords"] = entry_keywords
+        for entry in batch:
+            writer.write(entry)
 
     try:
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump(processed_data, f, indent=4)
+        with CorpusWriter(output_filename) as writer:
+            batch = []
+            for entry in iter_records(input_filename):
+                if not isinstance(entry, dict):
+                    print("Error: The corpus structure is not supported. Each record should be an object.")
+                    return
+                batch.append(entry)
+                if len(batch) == batch_size:
+                    write_batch(writer, batch)
+                    batch = []
+            if batch:
+                write_batch(writer, batch)
         print(f"Keywords extracted and saved to '{output_filename}'")
+        print(f"Embedding cache: {embeddings.stats()}")
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode JSON from '{input_filename}'. Please ensure it's a valid corpus file.")
     except IOError as e:
         print(f"Error writing to file '{output_filename}': {e}")
+    finally:
+        embedding_pool.close()
 
 if __name__ == "__main__":
-    input_json_file = 'data/msdvetmanual_dog_owners_data.json'
-    output_json_file = 'data/msdvetmanual_dog_owners_data_with_keywords.json'
-    process_json_with_keybert(input_json_file, output_json_file)
\ No newline at end of file
+    process_corpus(CORPUS_PATH, KEYWORDS_OUTPUT_PATH)
@@ -0,0 +1,191 @@
+import bisect
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+METRIC_PREFIX = "dogvet"
+# Upper bounds, in seconds, of the buckets of the span duration histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (trace ID, name of the innermost open span) of the current task or thread
+_current = contextvars.ContextVar("metrics_trace", default=(None, None))
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    '''
+    Counters and span-duration histograms of the pipeline stages, cheap enough to leave on:
+    recording one is a dict update under a lock, and nothing is written unless a JSON log is open.
+
+    `span(name)` times a block and adds it to the `<prefix>_span_seconds{span=name}` histogram;
+    an exception leaving the block also counts as `errors_total{stage=name}`. Spans opened inside
+    `trace()` share its trace ID (per asyncio task or thread), and when `open_log` was called each
+    finished span is written as a JSON line, so the stages of one consultation can be lined up.
+    The totals are exported with `prometheus_text` (for /metrics) or `snapshot` (plain JSON).
+    '''
+
+    def __init__(self, buckets=DURATION_BUCKETS, prefix=METRIC_PREFIX):
+        self.buckets = buckets
+        self.prefix = prefix
+        self._counters = {}
+        # (span name, labels) -> [count per bucket..., count above the last bucket, sum of seconds, count]
+        self._spans = {}
+        self._lock = threading.Lock()
+        self._log = None
+
+    def count(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, error=None, **labels):
+        '''
+        Records a span of `seconds` that was timed by the caller (e.g. across the yields of a stream).
+        '''
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._spans.get(key)
+            if histogram is None:
+                histogram = self._spans[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            if error is not None:
+                error_key = ("errors", _labels_key({"stage": name}))
+                self._counters[error_key] = self._counters.get(error_key, 0) + 1
+            if self._log is not None:
+                trace_id, parent = _current.get()
+                record = {"ts": round(time.time(), 6), "trace": trace_id, "span": name, "parent": parent,
+                          "ms": round(seconds * 1000, 3), **labels}
+                if error is not None:
+                    record["error"] = error
+                self._log.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @contextmanager
+    def span(self, name, **labels):
+        '''
+        Times the enclosed block. It must not enclose a `yield` of a generator, which may be resumed
+        or closed in another context; time those stages with `observe` instead.
+        '''
+        trace_id, parent = _current.get()
+        token = _current.set((trace_id, name))
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            self.observe(name, time.perf_counter() - start, error, **labels)
+
+    @contextmanager
+    def trace(self):
+        '''
+        Starts a new trace for the spans of the enclosed block; yields its ID.
+        '''
+        trace_id = uuid.uuid4().hex[:16]
+        token = _current.set((trace_id, None))
+        try:
+            yield trace_id
+        finally:
+            _current.reset(token)
+
+    def _quantile(self, histogram, q):
+        '''
+        Upper bound of the bucket holding the `q` quantile (inf if it is above the last bucket).
+        '''
+        rank = q * histogram[-1]
+        seen = 0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        '''
+        Returns {"counters": {...}, "spans": {...}} with span counts, mean and p50/p95/p99 (bucket
+        upper bounds) in milliseconds, keyed like Prometheus series, e.g. 'llm.generate{backend="stub"}'.
+        '''
+        with self._lock:
+            counters = dict(self._counters)
+            spans = {key: list(histogram) for key, histogram in self._spans.items()}
+        return {
+            "counters": {f"{name}{_format_labels(labels)}": value for (name, labels), value in sorted(counters.items())},
+            "spans": {
+                f"{name}{_format_labels(labels)}": {
+                    "count": histogram[-1],
+                    "mean_ms": histogram[-2] / histogram[-1] * 1000,
+                    "p50_ms": self._quantile(histogram, 0.50) * 1000,
+                    "p95_ms": self._quantile(histogram, 0.95) * 1000,
+                    "p99_ms": self._quantile(histogram, 0.99) * 1000,
+                }
+                for (name, labels), histogram in sorted(spans.items())
+            },
+        }
+
+    def prometheus_text(self):
+        '''
+        The counters and histograms in the Prometheus text exposition format.
+        '''
+        with self._lock:
+            counters = sorted(self._counters.items())
+            spans = sorted((key, list(histogram)) for key, histogram in self._spans.items())
+
+        lines = []
+        for name in dict.fromkeys(name for (name, _), _ in counters):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.extend(f"{self.prefix}_{name}_total{_format_labels(labels)} {value}"
+                         for (counter, labels), value in counters if counter == name)
+        if spans:
+            family = f"{self.prefix}_span_seconds"
+            lines.append(f"# TYPE {family} histogram")
+            for (name, labels), histogram in spans:
+                series = (("span", name),) + labels
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram):
+                    cumulative += count
+                    lines.append(f"{family}_bucket{_format_labels(series, [('le', repr(bound))])} {cumulative}")
+                lines.append(f"{family}_bucket{_format_labels(series, [('le', '+Inf')])} {histogram[-1]}")
+                lines.append(f"{family}_sum{_format_labels(series)} {histogram[-2]}")
+                lines.append(f"{family}_count{_format_labels(series)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def open_log(self, path):
+        '''
+        Appends a JSON line per finished span to the file at `path` from now on.
+        '''
+        with self._lock:
+            self._log = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def close_log(self):
+        '''
+        Writes the final snapshot to the JSON log, if one is open, and closes it.
+        '''
+        if self._log is None:
+            return
+        snapshot = self.snapshot()
+        with self._lock:
+            self._log.write(json.dumps({"ts": round(time.time(), 6), "event": "metrics", **snapshot}, ensure_ascii=False) + "\n")
+            self._log.close()
+            self._log = None
+
+
+# Shared by every stage of the process
+METRICS = Metrics()
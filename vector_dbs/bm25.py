@@ -0,0 +1,134 @@
+import math
+import os
+import re
+import unicodedata
+import numpy as np
+from vector_dbs.chunking import PASSAGE_PREFIX
+
+BM25_DIRNAME = "bm25"
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TERM_LENGTH = 32
+# Keyphrases stored in chunk metadata are indexed this many extra times, so chunks tagged
+# with a query term outrank chunks that merely mention it
+KEYWORD_BOOST = 2
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    '''
+    Lowercased word tokens of `text`, for English and Ukrainian alike; drugs and diseases keep
+    their exact spelling, which is what lexical search is for.
+    '''
+    if text.startswith(PASSAGE_PREFIX):
+        text = text[len(PASSAGE_PREFIX):]
+    return [token[:MAX_TERM_LENGTH] for token in _TOKEN_PATTERN.findall(unicodedata.normalize('NFC', text).casefold())
+            if len(token) > 1 or token.isdigit()]
+
+
+def boosted_text(text, keywords=None):
+    '''
+    Text of a chunk as the BM25 index sees it: the text followed by its keyphrases, repeated KEYWORD_BOOST times.
+    '''
+    if not keywords:
+        return text
+    return text + ' ' + ' '.join(keywords * KEYWORD_BOOST)
+
+
+class BM25Index:
+    '''
+    Inverted BM25 index over the chunks of the vector store, keyed by the same FAISS IDs.
+
+    Postings are stored in CSR form: for term i (position in the sorted `terms` array),
+    `doc_rows[offsets[i]:offsets[i + 1]]` are the chunks containing it and `term_freqs` the
+    matching counts. Each array is a separate .npy file, memory-mapped on load, so opening
+    the index reads almost nothing and only the postings of query terms are paged in.
+    '''
+
+    ARRAYS = ('terms', 'offsets', 'doc_rows', 'term_freqs', 'doc_ids', 'doc_lengths')
+
+    def __init__(self, terms, offsets, doc_rows, term_freqs, doc_ids, doc_lengths):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_rows = doc_rows
+        self.term_freqs = term_freqs
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, chunks):
+        '''
+        Builds the index from (FAISS ID, chunk text) pairs.
+        '''
+        doc_ids = []
+        doc_lengths = []
+        postings = {}
+        for row, (doc_id, text) in enumerate(chunks):
+            tokens = tokenize(text)
+            doc_ids.append(doc_id)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        doc_rows = np.empty(offsets[-1], dtype=np.int32)
+        term_freqs = np.empty(offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(terms):
+            entries = np.asarray(postings[term], dtype=np.int64).reshape(-1, 2)
+            doc_rows[offsets[i]:offsets[i + 1]] = entries[:, 0]
+            term_freqs[offsets[i]:offsets[i + 1]] = np.minimum(entries[:, 1], np.iinfo(np.uint16).max)
+
+        return cls(np.asarray(terms, dtype=f'<U{MAX_TERM_LENGTH}'), offsets, doc_rows, term_freqs,
+                   np.asarray(doc_ids, dtype=np.int64), np.asarray(doc_lengths, dtype=np.float32))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name), allow_pickle=False)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*(np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r', allow_pickle=False) for name in cls.ARRAYS))
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in BM25Index.ARRAYS)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def search(self, query, k, allowed=None):
+        '''
+        Returns (FAISS IDs, BM25 scores) of the `k` best-matching chunks, best first.
+        `allowed` optionally restricts the search to chunks whose FAISS ID is set in this boolean array.
+        '''
+        num_docs = len(self.doc_ids)
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not num_docs or not tokens:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.zeros(num_docs, dtype=np.float32)
+        positions = np.searchsorted(self.terms, tokens)
+        for token, i in zip(tokens, positions):
+            if i >= len(self.terms) or self.terms[i] != token:
+                continue
+            rows = self.doc_rows[self.offsets[i]:self.offsets[i + 1]]
+            freqs = self.term_freqs[self.offsets[i]:self.offsets[i + 1]].astype(np.float32)
+            idf = math.log(1 + (num_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[rows] / self.average_length)
+            scores[rows] += idf * freqs * (BM25_K1 + 1) / (freqs + norm)
+
+        if allowed is not None:
+            scores[~allowed[self.doc_ids]] = 0
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched])]
+        return self.doc_ids[matched], scores[matched]
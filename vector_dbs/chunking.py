@@ -0,0 +1,72 @@
+import numpy as np
+
+MAX_TOKENS = 512
+CHUNK_SIZE_TOKENS = 480
+OVERLAP_TOKENS = 50
+PASSAGE_PREFIX = "passage: "
+BATCH_SIZE = 256
+
+
+def chunk_windows(num_tokens, chunk_size=CHUNK_SIZE_TOKENS, overlap=OVERLAP_TOKENS):
+    '''
+    Returns (starts, ends) token index arrays of the overlapping windows covering `num_tokens` tokens.
+    Consecutive windows share exactly `overlap` tokens.
+    '''
+    stride = chunk_size - overlap
+    if num_tokens <= chunk_size:
+        num_chunks = 1 if num_tokens > 0 else 0
+    else:
+        num_chunks = int(np.ceil((num_tokens - overlap) / stride))
+    starts = np.arange(num_chunks) * stride
+    ends = np.minimum(starts + chunk_size, num_tokens)
+    return starts, ends
+
+
+def _chunk_batch(batch, tokenizer, chunk_size, overlap, extra_tokens):
+    encodings = tokenizer(
+        [item['text'] for item in batch],
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_attention_mask=False,
+    )
+
+    for item, offsets in zip(batch, encodings['offset_mapping']):
+        offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        starts, ends = chunk_windows(len(offsets), chunk_size, overlap)
+        char_starts = offsets[starts, 0]
+        char_ends = offsets[ends - 1, 1]
+
+        for i, (char_start, char_end) in enumerate(zip(char_starts.tolist(), char_ends.tolist())):
+            metadata = {
+                "chapter": item['chapter'],
+                "topic": item['topic'],
+                "chunk_id": f"{item['id']}_{i}",
+                "token_count": int(ends[i] - starts[i]) + extra_tokens,
+            }
+            # Records of a compacted corpus list the near-duplicates merged into them
+            if item.get('sources'):
+                metadata["sources"] = item['sources']
+            yield {"text": PASSAGE_PREFIX + item['text'][char_start:char_end], "metadata": metadata}
+
+
+def iter_chunks(records, tokenizer, chunk_size=CHUNK_SIZE_TOKENS, overlap=OVERLAP_TOKENS, batch_size=BATCH_SIZE):
+    '''
+    Splits corpus records into overlapping token windows and yields one {'text', 'metadata'} dict per window.
+
+    Records are tokenized `batch_size` at a time in a single call to the fast tokenizer,
+    and each chunk's text is sliced out of the original record text using the token character
+    offsets, so no decode/re-encode round-trips are needed. Each chunk text carries the
+    "passage: " prefix recommended for E5 models; `token_count` includes it and the special tokens.
+    '''
+    extra_tokens = len(tokenizer(PASSAGE_PREFIX, add_special_tokens=False)['input_ids']) + tokenizer.num_special_tokens_to_add()
+    if chunk_size + extra_tokens > MAX_TOKENS:
+        raise ValueError(f"chunk_size={chunk_size} plus prefix and special tokens exceeds the model limit of {MAX_TOKENS} tokens.")
+
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _chunk_batch(batch, tokenizer, chunk_size, overlap, extra_tokens)
+            batch = []
+    if batch:
+        yield from _chunk_batch(batch, tokenizer, chunk_size, overlap, extra_tokens)
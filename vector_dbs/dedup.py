@@ -0,0 +1,156 @@
+import os
+import re
+import sys
+import time
+import unicodedata
+import zlib
+import numpy as np
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.corpus import CORPUS_PATH, CorpusWriter, iter_records
+from vector_dbs.chunking import PASSAGE_PREFIX
+
+# Estimated Jaccard similarity of word shingles above which two texts count as duplicates
+DEFAULT_DEDUP_THRESHOLD = 0.9
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 128
+# 32 bands of 4 rows: pairs above ~0.6 similarity almost always share a band, pairs below ~0.2 rarely do
+LSH_BANDS = 32
+COMPACTED_CORPUS_PATH = "data/msdvetmanual_dog_owners_data_compacted.jsonl"
+# Metadata fields of each merged record or chunk kept under the canonical one's "sources"
+SOURCE_FIELDS = ('id', 'chunk_id', 'url', 'chapter', 'topic')
+
+_WORD_PATTERN = re.compile(r'\w+')
+# Largest prime below 2**32: with 32-bit hashes and coefficients, a * x + b fits in a uint64
+_PRIME = np.uint64(4294967291)
+_rng = np.random.default_rng(0)
+_A = _rng.integers(1, int(_PRIME), NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, int(_PRIME), NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    '''
+    32-bit hashes of the distinct `size`-word shingles of `text` (lowercased, prefix stripped).
+    A text shorter than `size` words is a single shingle.
+    '''
+    if text.startswith(PASSAGE_PREFIX):
+        text = text[len(PASSAGE_PREFIX):]
+    words = _WORD_PATTERN.findall(unicodedata.normalize('NFC', text).casefold())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    grams = {' '.join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash_signatures(texts):
+    '''
+    MinHash signature (NUM_PERMUTATIONS values) of each text's shingles; the share of equal
+    values of two signatures estimates the Jaccard similarity of the texts. Empty texts get
+    a signature that matches nothing.
+    '''
+    signatures = np.empty((len(texts), NUM_PERMUTATIONS), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        hashes = shingles(text)
+        if len(hashes):
+            signatures[row] = ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+        else:
+            signatures[row] = np.iinfo(np.uint64).max - row
+    return signatures
+
+
+def near_duplicate_groups(texts, threshold=DEFAULT_DEDUP_THRESHOLD):
+    '''
+    Groups texts whose estimated Jaccard similarity is at least `threshold` (transitively).
+    Returns lists of indices with more than one member, each sorted, so the first is the earliest text.
+
+    Only texts that share an LSH band (a run of signature values) are compared, so the cost grows
+    with the number of texts rather than the number of pairs.
+    '''
+    signatures = minhash_signatures(texts)
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    candidates = set()
+    for band in range(LSH_BANDS):
+        buckets = {}
+        for i, key in enumerate(map(bytes, signatures[:, band * rows:(band + 1) * rows])):
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            candidates.update((members[a], members[b]) for a in range(len(members)) for b in range(a + 1, len(members)))
+
+    if candidates:
+        pairs = np.array(sorted(candidates), dtype=np.int64)
+        similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+        for i, j in pairs[similarity >= threshold].tolist():
+            parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(texts)):
+        groups.setdefault(find(i), []).append(i)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def merged_sources(metadatas):
+    '''
+    The "sources" of a canonical record or chunk: where each of its duplicates (itself first) came from.
+    '''
+    sources = []
+    for metadata in metadatas:
+        for source in metadata.get('sources') or [metadata]:
+            source = {field: source[field] for field in SOURCE_FIELDS if source.get(field) is not None}
+            if source not in sources:
+                sources.append(source)
+    return sources
+
+
+def dedup_documents(documents, threshold=DEFAULT_DEDUP_THRESHOLD):
+    '''
+    Collapses near-duplicate chunks into the first of each group, whose metadata gets the merged
+    "sources" of the group (so chapter and topic filters still find it). Returns the remaining
+    documents, in their original order.
+    '''
+    removed = set()
+    for group in near_duplicate_groups([doc.page_content for doc in documents], threshold):
+        canonical = documents[group[0]]
+        canonical.metadata['sources'] = merged_sources([documents[i].metadata for i in group])
+        removed.update(group[1:])
+    return [doc for i, doc in enumerate(documents) if i not in removed]
+
+
+def compact_corpus(input_filename, output_filename, threshold=DEFAULT_DEDUP_THRESHOLD):
+    """
+    Writes the records of a corpus file to a new one with near-duplicate records collapsed into
+    the first of each group, which lists all of them under "sources".
+
+    Args:
+        input_filename (str): The path to the input corpus file (JSONL, '.jsonl.zst' or legacy JSON array).
+        output_filename (str): The path to the output corpus file.
+    """
+    if not os.path.exists(input_filename):
+        print(f"Error: The file '{input_filename}' was not found.")
+        return
+
+    start = time.perf_counter()
+    records = [record for record in iter_records(input_filename) if isinstance(record, dict)]
+    removed = set()
+    for group in near_duplicate_groups([str(record.get('text') or '') for record in records], threshold):
+        records[group[0]]['sources'] = merged_sources([records[i] for i in group])
+        removed.update(group[1:])
+
+    with CorpusWriter(output_filename) as writer:
+        for i, record in enumerate(records):
+            if i not in removed:
+                writer.write(record)
+    print(f"Collapsed {len(removed)} near-duplicate records of {len(records)} in {time.perf_counter() - start:.1f} s; "
+          f"saved the compacted corpus to '{output_filename}'")
+
+if __name__ == "__main__":
+    compact_corpus(CORPUS_PATH, COMPACTED_CORPUS_PATH)
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from utils.metrics import METRICS
+
+CACHE_DIR = "vector_dbs/embedding_cache"
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+VECTORS_FILENAME = "vectors.f32"
+INDEX_FILENAME = "index.sqlite"
+
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    '''
+    Content-addressed cache of embedding vectors for one model.
+
+    Vectors live in a memory-mapped float32 file, one row per entry; a SQLite index file maps
+    the hash of the normalized text to its row and last access time. SQLite transactions
+    serialize writers, so an index build and a running consult process can share the cache;
+    within a process, a lock lets retrieval threads share one instance.
+    Once the vectors would exceed `max_bytes`, the least recently used entries are evicted
+    and their rows reused.
+    '''
+
+    def __init__(self, model_name, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.path = os.path.join(cache_dir, model_name.replace('/', '__'))
+        os.makedirs(self.path, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.vectors_path = os.path.join(self.path, VECTORS_FILENAME)
+        open(self.vectors_path, 'ab').close()
+
+        self.conn = sqlite3.connect(os.path.join(self.path, INDEX_FILENAME), timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                row INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        self._mm = None
+
+    def _meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def _vectors(self, dim, min_rows):
+        '''
+        Returns the memory map of the vectors file, remapping it if another writer has grown the file.
+        '''
+        if self._mm is None or self._mm.shape[0] < min_rows:
+            rows = os.path.getsize(self.vectors_path) // (dim * 4)
+            self._mm = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(rows, dim)) if rows else None
+        return self._mm
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, texts):
+        '''
+        Returns a list with the cached vector for each text, or None where there is no entry.
+        '''
+        with self._lock:
+            dim = self._meta('dim')
+            if dim is None or not texts:
+                return [None] * len(texts)
+
+            keys = [text_key(text) for text in texts]
+            found = {}
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self.conn.execute(f"SELECT key, row FROM entries WHERE key IN ({placeholders})", batch).fetchall())
+            if not found:
+                return [None] * len(texts)
+
+            vectors = self._vectors(dim, max(found.values()) + 1)
+            self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+            return [np.array(vectors[found[key]]) if key in found else None for key in keys]
+
+    def put_many(self, texts, vectors):
+        '''
+        Stores vectors for the given texts, evicting least recently used entries when the cache is full.
+        '''
+        with self._lock:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if not len(texts):
+                return
+            dim = vectors.shape[1]
+            max_rows = max(1, self.max_bytes // (dim * 4))
+
+            new = dict(zip((text_key(text) for text in texts), vectors))
+
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                stored_dim = self._meta('dim')
+                if stored_dim is None:
+                    self._set_meta('dim', dim)
+                    self._set_meta('next_row', 0)
+                elif stored_dim != dim:
+                    raise ValueError(f"Embedding cache at '{self.path}' holds {stored_dim}-d vectors, got {dim}-d.")
+
+                candidate_keys = list(new)
+                for start in range(0, len(candidate_keys), 500):
+                    batch = candidate_keys[start:start + 500]
+                    placeholders = ','.join('?' * len(batch))
+                    for (key,) in self.conn.execute(f"SELECT key FROM entries WHERE key IN ({placeholders})", batch).fetchall():
+                        new.pop(key, None)
+                keys = list(new)[-max_rows:]
+                if not keys:
+                    self.conn.execute("COMMIT")
+                    return
+
+                next_row = self._meta('next_row')
+                fresh_rows = min(len(keys), max(0, max_rows - next_row))
+                rows = list(range(next_row, next_row + fresh_rows))
+
+                overflow = len(keys) - fresh_rows
+                if overflow > 0:
+                    evicted = self.conn.execute("SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (overflow,)).fetchall()
+                    self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+                    rows.extend(row for _, row in evicted)
+                self._set_meta('next_row', next_row + fresh_rows)
+
+                needed_rows = max(rows) + 1
+                if os.path.getsize(self.vectors_path) < needed_rows * dim * 4:
+                    # Grow geometrically so repeated small inserts don't remap the file every time
+                    target_rows = min(max(needed_rows, 2 * (os.path.getsize(self.vectors_path) // (dim * 4))), max_rows)
+                    with open(self.vectors_path, 'r+b') as f:
+                        f.truncate(max(target_rows, needed_rows) * dim * 4)
+
+                mm = self._vectors(dim, needed_rows)
+                for key, row in zip(keys, rows):
+                    mm[row] = new[key]
+                mm.flush()
+
+                now = time.time()
+                self.conn.executemany("INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                                      [(key, row, now) for key, row in zip(keys, rows)])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        self._mm = None
+        self.conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Wraps a LangChain embeddings object so that texts already seen by this model are served
+    from the `EmbeddingCache` and only new texts reach the model.
+    '''
+
+    def __init__(self, embeddings, model_name, cache=None):
+        self.embeddings = embeddings
+        self.cache = cache if cache is not None else EmbeddingCache(model_name)
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        cached = self.cache.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        METRICS.count("embedding_cache_lookups", len(texts) - len(missing), result="hit")
+        METRICS.count("embedding_cache_lookups", len(missing), result="miss")
+
+        if missing:
+            # A text repeated within the call (by cache key) is embedded once and copied to each position
+            positions = {}
+            for i in missing:
+                positions.setdefault(text_key(texts[i]), []).append(i)
+            unique = [rows[0] for rows in positions.values()]
+            computed = self.embeddings.embed_documents([texts[i] for i in unique])
+            self.cache.put_many([texts[i] for i in unique], computed)
+            for rows, vector in zip(positions.values(), computed):
+                for i in rows:
+                    cached[i] = vector
+
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in cached]
+
+    def embed_query(self, text):
+        cached = self.cache.get_many([text])[0]
+        if cached is not None:
+            self.hits += 1
+            METRICS.count("embedding_cache_lookups", result="hit")
+            return cached.tolist()
+
+        self.misses += 1
+        METRICS.count("embedding_cache_lookups", result="miss")
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many([text], [vector])
+        return vector
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), {len(self.cache)} cached vectors"
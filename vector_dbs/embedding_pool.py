@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.embeddings import Embeddings
+from vector_dbs.embeddings import DEFAULT_BACKEND, load_sentence_transformer, sentence_transformer_args
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_THREADS_PER_WORKER = 4
+
+_worker_model = None
+
+
+def _load_model(model_name, backend, threads):
+    '''
+    Loads the sentence-transformers model on the given backend, pinned to `threads` intra-op threads.
+    '''
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if backend == 'torch':
+        # The ONNX backends get their thread count through the ONNX Runtime session options instead
+        import torch
+
+        torch.set_num_threads(threads)
+    return load_sentence_transformer(backend, model_name, threads)
+
+
+def _init_worker(model_name, backend, threads):
+    global _worker_model
+    _worker_model = _load_model(model_name, backend, threads)
+
+
+def _encode_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+
+
+class ParallelEmbeddings(Embeddings):
+    '''
+    Embeds documents on a pool of worker processes, each holding its own copy of the model and
+    limited to `threads_per_worker` torch (or ONNX Runtime) threads, so a build uses every core
+    without the threads of different workers fighting each other.
+
+    Texts are sorted by length before batching, so each batch pads to a similar length,
+    and batches are streamed to the workers as they become free. Note that every worker
+    loads the full model, so memory use grows with `workers`.
+    With `workers=1` the model runs in the calling process.
+    '''
+
+    def __init__(self, model_name, workers=None, threads_per_worker=None, batch_size=DEFAULT_BATCH_SIZE, backend=DEFAULT_BACKEND):
+        cpus = os.cpu_count() or 1
+        if workers is None:
+            threads_per_worker = threads_per_worker or min(DEFAULT_THREADS_PER_WORKER, cpus)
+            workers = max(1, cpus // threads_per_worker)
+        self.model_name = model_name
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker or max(1, cpus // self.workers)
+        self.batch_size = batch_size
+        self._pool = None
+        self._model = None
+
+    def _encode_batches(self, batches):
+        if self.workers == 1:
+            if self._model is None:
+                self._model = _load_model(self.model_name, self.backend, self.threads_per_worker)
+            return (self._model.encode(batch, batch_size=len(batch), convert_to_numpy=True) for batch in batches)
+
+        if self._pool is None:
+            # Export the quantized model once here, rather than racing to do it in every worker
+            sentence_transformer_args(self.backend, self.model_name)
+            print(f"Starting {self.workers} embedding workers with {self.threads_per_worker} threads each.")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.backend, self.threads_per_worker),
+            )
+        return self._pool.map(_encode_batch, batches)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        texts = [text.replace("\n", " ") for text in texts]
+
+        # Longest first: similar lengths share a batch, and the slowest batches start early
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        batches = [[texts[i] for i in order[start:start + self.batch_size]] for start in range(0, len(order), self.batch_size)]
+
+        start_time = time.perf_counter()
+        vectors = np.concatenate(list(self._encode_batches(batches)))
+        elapsed = time.perf_counter() - start_time
+        print(f"Embedded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / elapsed:.1f} chunks/sec).")
+
+        result = np.empty_like(vectors)
+        result[order] = vectors
+        return result.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,83 @@
+import os
+
+EMBEDDING_MODEL = 'intfloat/multilingual-e5-large'
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+DEFAULT_BACKEND = 'torch'
+ONNX_EXPORT_DIR = "vector_dbs/onnx_models"
+QUANTIZATION_CONFIG = "avx2"
+
+
+def cache_model_key(model_name=EMBEDDING_MODEL, backend=DEFAULT_BACKEND):
+    '''
+    Key for the embedding cache; backends produce slightly different vectors, so they don't share entries.
+    '''
+    return model_name if backend == 'torch' else f"{model_name}:{backend}"
+
+
+def _quantized_model_dir(model_name):
+    return os.path.join(ONNX_EXPORT_DIR, model_name.replace('/', '__') + '__qint8')
+
+
+def _quantized_file_name():
+    return f"onnx/model_qint8_{QUANTIZATION_CONFIG}.onnx"
+
+
+def _export_quantized_model(model_name):
+    '''
+    Exports the model to ONNX and applies dynamic int8 quantization, once; later loads reuse the export.
+    '''
+    save_dir = _quantized_model_dir(model_name)
+    if os.path.exists(os.path.join(save_dir, _quantized_file_name())):
+        return save_dir
+
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    print(f"Exporting int8-quantized ONNX model for '{model_name}' to {save_dir} (one-time step)...")
+    model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+    model.save(save_dir)
+    export_dynamic_quantized_onnx_model(model, QUANTIZATION_CONFIG, save_dir)
+    return save_dir
+
+
+def sentence_transformer_args(backend=DEFAULT_BACKEND, model_name=EMBEDDING_MODEL, threads=None):
+    '''
+    Returns (model_name_or_path, constructor kwargs) for loading `model_name` with the given backend:
+    'torch' is the fp32 PyTorch model, 'onnx' the same weights on ONNX Runtime and
+    'onnx-int8' a dynamically int8-quantized ONNX export.
+    '''
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Choose one of: {', '.join(EMBEDDING_BACKENDS)}.")
+    if backend == 'torch':
+        return model_name, {}
+
+    onnx_kwargs = {}
+    if threads:
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        onnx_kwargs["session_options"] = session_options
+
+    if backend == 'onnx':
+        return model_name, {"backend": "onnx", "model_kwargs": onnx_kwargs}
+
+    onnx_kwargs["file_name"] = _quantized_file_name()
+    return _export_quantized_model(model_name), {"backend": "onnx", "model_kwargs": onnx_kwargs}
+
+
+def load_sentence_transformer(backend=DEFAULT_BACKEND, model_name=EMBEDDING_MODEL, threads=None):
+    from sentence_transformers import SentenceTransformer
+
+    model_path, kwargs = sentence_transformer_args(backend, model_name, threads)
+    return SentenceTransformer(model_path, device="cpu", **kwargs)
+
+
+def load_embeddings(backend=DEFAULT_BACKEND, model_name=EMBEDDING_MODEL):
+    '''
+    Returns LangChain embeddings for `model_name` running on the selected backend.
+    '''
+    from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+
+    model_path, kwargs = sentence_transformer_args(backend, model_name)
+    return HuggingFaceEmbeddings(model_name=model_path, model_kwargs=kwargs)
@@ -1,87 +1,252 @@
+import hashlib
 import json
-import math
+import shutil
 import sys
+import time
 import os
-from transformers import AutoTokenizer
-from langchain_community.vectorstores.faiss import FAISS
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
-from langchain.docstore.document import Document
+import numpy as np
+from langchain_core.documents import Document
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-MAX_TOKENS = 512
-CHUNK_SIZE_TOKENS = 480
-OVERLAP_TOKENS = 50
+from utils.corpus import CORPUS_PATH, iter_records
+from utils.keywords import add_keywords
+from utils.metrics import METRICS
+from vector_dbs.chunking import CHUNK_SIZE_TOKENS, OVERLAP_TOKENS, iter_chunks
+from vector_dbs.dedup import DEFAULT_DEDUP_THRESHOLD, dedup_documents
+from vector_dbs.embedding_cache import CachedEmbeddings
+from vector_dbs.embedding_pool import DEFAULT_BATCH_SIZE, ParallelEmbeddings
+from vector_dbs.embeddings import DEFAULT_BACKEND, EMBEDDING_MODEL, cache_model_key, load_embeddings
+from vector_dbs.index_factory import (DEFAULT_INDEX_TYPE, DEFAULT_SEARCH_PARAMS, build_faiss_index, set_search_params,
+                                      supports_removal)
+from vector_dbs.index_store import STORE_FORMAT, ChunkIndex
+
 DB_PATH = "vector_dbs/vet_manual_faiss_db"
+MANIFEST_FILENAME = "manifest.json"
+
+
+def chunk_hash(document):
+    '''
+    Hash of a chunk's text and metadata, used to detect chunks that changed since the last build.
+    '''
+    payload = json.dumps([document.page_content, document.metadata], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_manifest(db_path=DB_PATH):
+    try:
+        with open(os.path.join(db_path, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_index(faiss_db, manifest, db_path=DB_PATH):
+    '''
+    Writes the index and its manifest next to the docstore in the temporary directory the store
+    was built in, and swaps it in place of `db_path`, so an interrupted save never leaves
+    a half-written index behind.
+    '''
+    tmp_path = db_path + '.tmp'
+    old_path = db_path + '.old'
+
+    faiss_db.save(tmp_path)
+    faiss_db.close()
+    with open(os.path.join(tmp_path, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(db_path):
+        os.rename(db_path, old_path)
+    os.rename(tmp_path, db_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def new_store(documents_by_id, embeddings, path, index_type=DEFAULT_INDEX_TYPE, keywords=0):
+    '''
+    Embeds all chunks and builds a new store in `path` around an index of the given type.
+    With `keywords` > 0, that many keyphrases of each chunk are stored in its metadata.
+    '''
+    shutil.rmtree(path, ignore_errors=True)
+    documents = list(documents_by_id.values())
+    vectors = embed_chunks(documents, embeddings, keywords)
+    with METRICS.span("create_db.index", index_type=index_type):
+        ids = np.arange(len(documents), dtype=np.int64)
+        index = build_faiss_index(index_type, vectors, ids)
+        return ChunkIndex.create(path, index, ids, documents, embeddings)
+
+
+def embed_chunks(documents, embeddings, keywords=0):
+    '''
+    Returns the embeddings of the chunks as a float32 array, after storing `keywords` keyphrases
+    of each in its metadata when `keywords` > 0.
+    '''
+    with METRICS.span("create_db.embed"):
+        vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    METRICS.count("create_db_embedded_chunks", len(documents))
+    if keywords:
+        with METRICS.span("create_db.keywords"):
+            add_keywords(documents, vectors, embeddings, keywords)
+    return vectors
+
+
+def load_store(embeddings, db_path=DB_PATH, search_params=None, retrieval='dense', route_chapters=0):
+    '''
+    Opens the saved store with its index memory-mapped and applies search-time parameters
+    (nprobe, efSearch), defaulting to the ones suggested for the index type it was built with.
+    `retrieval='hybrid'` also searches the BM25 index and fuses both rankings; with `route_chapters`,
+    questions are only searched in their most likely chapters.
+    '''
+    faiss_db = ChunkIndex.load(db_path, embeddings)
+    faiss_db.set_retrieval(retrieval)
+    faiss_db.set_router(route_chapters)
+    manifest = load_manifest(db_path) or {}
+    params = dict(DEFAULT_SEARCH_PARAMS.get(manifest.get("index_type", DEFAULT_INDEX_TYPE), {}))
+    # Only override parameters that exist for this index type (e.g. nprobe is meaningless for HNSW)
+    params.update({name: value for name, value in (search_params or {}).items() if value is not None and name in params})
+    set_search_params(faiss_db.index, params)
+    return faiss_db
 
 
-def main(input_json):
+def build_index(documents_by_id, manifest, settings, embeddings, rebuild=False):
     '''
-    Performs chunking of the given document based on E5 tokenizer, and then constructs FAISS vector store.
+    Builds a new store, or updates a copy of the saved one according to its manifest, in a temporary
+    directory next to DB_PATH. Returns None if the saved index is already up to date.
     '''
+    tmp_path = DB_PATH + '.tmp'
+    previous = None if rebuild else load_manifest(DB_PATH)
+    defaults = {"embedding_backend": DEFAULT_BACKEND, "index_type": DEFAULT_INDEX_TYPE, "keywords": 0, "dedup_threshold": 0}
+    if previous is not None and any(previous.get(key, defaults.get(key)) != value for key, value in settings.items()):
+        print("Embedding model, backend, chunking settings, deduplication, index type, keyphrases or storage format changed "
+              "since the last build; rebuilding the index.")
+        previous = None
+
+    index_type = settings["index_type"]
+    keywords = settings["keywords"]
+    if previous is None:
+        print(f"Setting up FAISS database at: {DB_PATH}")
+        return new_store(documents_by_id, embeddings, tmp_path, index_type, keywords)
+
+    old_chunks = previous["chunks"]
+    removed = [chunk_id for chunk_id, digest in old_chunks.items() if manifest["chunks"].get(chunk_id) != digest]
+    added = [chunk_id for chunk_id, digest in manifest["chunks"].items() if old_chunks.get(chunk_id) != digest]
+    print(f"Updating FAISS database at: {DB_PATH} ({len(added)} chunks to embed, {len(removed)} to remove, "
+          f"{len(manifest['chunks']) - len(added)} unchanged)")
+
+    if not added and not removed:
+        print("FAISS index is already up to date.")
+        return None
+    if removed and not supports_removal(index_type):
+        # Unchanged chunks come straight from the embedding cache, so this only re-trains the index
+        print(f"Removing vectors is not supported by the '{index_type}' index; rebuilding it from cached embeddings.")
+        return new_store(documents_by_id, embeddings, tmp_path, index_type, keywords)
 
-    with open(input_json, 'r') as f:
-        data = json.load(f)
+    # The saved store keeps serving queries while a writable copy is updated
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(DB_PATH, tmp_path)
+    faiss_db = ChunkIndex.load(tmp_path, embeddings, mmap=False)
+    if removed:
+        with METRICS.span("create_db.index", index_type=index_type):
+            faiss_db.delete(removed)
+    if added:
+        documents = [documents_by_id[chunk_id] for chunk_id in added]
+        vectors = embed_chunks(documents, embeddings, keywords)
+        with METRICS.span("create_db.index", index_type=index_type):
+            faiss_db.add(documents, vectors)
+    return faiss_db
 
-    embedding_model = 'intfloat/multilingual-e5-large'
-    tokenizer = AutoTokenizer.from_pretrained(embedding_model)
 
-    chunked_documents = []
+def indexed_backend(db_path=DB_PATH):
+    '''
+    Embedding backend the saved index was built with, so queries can be embedded the same way.
+    '''
+    manifest = load_manifest(db_path) or {}
+    return manifest.get("embedding_backend", DEFAULT_BACKEND)
 
-    for item in data:
-        full_text = item['text']
-        tokens = tokenizer.encode(full_text, add_special_tokens=False)
 
-        num_tokens = len(tokens)
-        
-        # Calculate the number of chunks needed
-        num_chunks = math.ceil(num_tokens / (CHUNK_SIZE_TOKENS - OVERLAP_TOKENS)) if num_tokens > CHUNK_SIZE_TOKENS - OVERLAP_TOKENS else 1
+def main(corpus_path, follow=False, rebuild=False, workers=None, batch_size=DEFAULT_BATCH_SIZE, backend=DEFAULT_BACKEND,
+         index_type=DEFAULT_INDEX_TYPE, keywords=0, dedup_threshold=DEFAULT_DEDUP_THRESHOLD):
+    '''
+    Performs chunking of the given corpus based on E5 tokenizer, and then constructs FAISS vector store.
+    Records are streamed from the corpus file; with `follow=True` chunking starts while the scraper is still writing it.
 
-        for i in range(num_chunks):
-            start_token = i * (CHUNK_SIZE_TOKENS - OVERLAP_TOKENS)
-            end_token = min(start_token + CHUNK_SIZE_TOKENS, num_tokens)
+    If an index built with the same settings already exists, it is updated in place: only new or
+    changed chunks are embedded and vectors of removed chunks are deleted. Pass `rebuild=True`
+    to re-embed everything.
 
-            # Handle overlap for subsequent chunks
-            if i > 0:
-                start_token = max(0, start_token - OVERLAP_TOKENS)
+    Embedding runs on `workers` processes (by default one per 4 cores) in batches of `batch_size` chunks,
+    using the selected embedding `backend` ('torch', 'onnx' or 'onnx-int8'). The backend is recorded
+    in the manifest so the consult agent embeds queries the same way.
 
-            chunk_tokens = tokens[start_token:end_token]
-            chunk_text = tokenizer.decode(chunk_tokens)
+    `index_type` selects the FAISS index: 'flat' (exact), 'ivf' (IVF-Flat), 'hnsw',
+    'ivfpq' (IVF-PQ) or 'ivfopq' (OPQ + IVF-PQ).
 
-            # Add the "passage:" prefix as recommended for E5 models
-            prefixed_chunk_text = "passage: " + chunk_text
+    Near-duplicate chunks (estimated Jaccard similarity of their word shingles at least `dedup_threshold`,
+    see vector_dbs/dedup.py) are collapsed into one before embedding, which lists where the others came
+    from under "sources"; `dedup_threshold=0` keeps them all.
 
-            final_chunk_tokens = tokenizer.encode(prefixed_chunk_text, truncation=True, max_length=MAX_TOKENS)
-            final_chunk_text = tokenizer.decode(final_chunk_tokens)
+    With `keywords` > 0, that many keyphrases of each chunk are extracted from the chunk embeddings
+    just computed (see utils/keywords.py) and stored in its metadata, where the BM25 index of hybrid
+    retrieval weights them up.
+    '''
+    # transformers takes seconds to import and is only needed to chunk the corpus, not to load the index
+    from transformers import AutoTokenizer
 
-            chunked_documents.append(Document(
-                page_content=final_chunk_text,
-                metadata={
-                    "chapter": item['chapter'],
-                    "topic": item['topic'],
-                    "chunk_id": f"{item['id']}_{i}",
-                    "token_count": len(final_chunk_tokens)
-                }
-            ))
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
 
+    # With `follow`, this includes waiting for the scraper
+    try:
+        with METRICS.span("create_db.chunk"):
+            chunked_documents = [
+                Document(page_content=chunk['text'], metadata=chunk['metadata'])
+                for chunk in iter_chunks(iter_records(corpus_path, follow=follow), tokenizer, CHUNK_SIZE_TOKENS, OVERLAP_TOKENS)
+            ]
+    except RuntimeError as e:
+        # The scraper being followed died; an incremental build would delete every topic it didn't reach
+        print(f"Error: {e}")
+        return
+    METRICS.count("create_db_chunks", len(chunked_documents))
+    print(f"Created {len(chunked_documents)} chunks.")
+    if dedup_threshold:
+        start = time.perf_counter()
+        num_chunks = len(chunked_documents)
+        with METRICS.span("create_db.dedup"):
+            chunked_documents = dedup_documents(chunked_documents, dedup_threshold)
+        METRICS.count("create_db_duplicate_chunks", num_chunks - len(chunked_documents))
+        print(f"Collapsed {num_chunks - len(chunked_documents)} near-duplicate chunks in {time.perf_counter() - start:.1f} s; "
+              f"{len(chunked_documents)} chunks left.")
 
-    embeddings = HuggingFaceEmbeddings(model_name='intfloat/multilingual-e5-large')
+    documents_by_id = {doc.metadata['chunk_id']: doc for doc in chunked_documents}
+    settings = {"embedding_model": EMBEDDING_MODEL, "embedding_backend": backend, "chunk_size": CHUNK_SIZE_TOKENS,
+                "overlap": OVERLAP_TOKENS, "index_type": index_type, "keywords": keywords, "dedup_threshold": dedup_threshold,
+                "store_format": STORE_FORMAT}
+    manifest = dict(settings, chunks={chunk_id: chunk_hash(doc) for chunk_id, doc in documents_by_id.items()})
 
-    print(f"Setting up FAISS database at: {DB_PATH}")
-    faiss_db = FAISS.from_documents(chunked_documents, embeddings)
+    # Passages embedded by earlier builds or experiments are served from the on-disk embedding cache;
+    # the rest are spread over the worker pool
+    embedding_pool = ParallelEmbeddings(EMBEDDING_MODEL, workers=workers, batch_size=batch_size, backend=backend)
+    embeddings = CachedEmbeddings(embedding_pool, cache_model_key(EMBEDDING_MODEL, backend))
+    try:
+        faiss_db = build_index(documents_by_id, manifest, settings, embeddings, rebuild)
+    finally:
+        embedding_pool.close()
+    if faiss_db is None:
+        return
 
     print("\nFAISS database creation complete!")
-    print(f"Total documents in FAISS index (approx): {len(faiss_db.docstore._dict)}")
+    print(f"Total documents in FAISS index: {len(faiss_db)}")
+    print(f"Embedding cache: {embeddings.stats()}")
 
-    faiss_db.save_local(DB_PATH)
+    with METRICS.span("create_db.save"):
+        save_index(faiss_db, manifest, DB_PATH)
     print(f"FAISS index saved to {DB_PATH}")
 
 def test():
 
-    embeddings = HuggingFaceEmbeddings(model_name='intfloat/multilingual-e5-large')
-    loaded_faiss_db = FAISS.load_local(DB_PATH, embeddings, allow_dangerous_deserialization=True)
-    print(f"Loaded FAISS index with {len(loaded_faiss_db.docstore._dict)} documents.")
+    embeddings = load_embeddings(indexed_backend())
+    loaded_faiss_db = load_store(embeddings, DB_PATH)
+    print(f"Loaded FAISS index with {len(loaded_faiss_db)} documents.")
 
     query = "How would you differentiate between symptoms of kennel cough and canine distemper?"
     docs = loaded_faiss_db.similarity_search(query, k=3)
@@ -92,4 +257,4 @@ def test():
 
 if __name__ == '__main__':
     
-    main('data/msdvetmanual_dog_owners_data.json')
\ No newline at end of file
+    main(CORPUS_PATH)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import math
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq', 'ivfopq')
+DEFAULT_INDEX_TYPE = 'flat'
+HNSW_NEIGHBORS = 32
+PQ_SUBQUANTIZERS = 64
+DEFAULT_SEARCH_PARAMS = {
+    'flat': {},
+    'ivf': {'nprobe': 16},
+    'hnsw': {'efSearch': 64},
+    'ivfpq': {'nprobe': 16},
+    'ivfopq': {'nprobe': 16},
+}
+
+# k-means wants roughly this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def pq_bits(num_vectors):
+    '''
+    Bits per PQ code: 8-bit codebooks have 256 centroids per subquantizer; small corpora get 4-bit (16 centroid) codebooks.
+    '''
+    return 8 if num_vectors >= 256 * MIN_POINTS_PER_CENTROID else 4
+
+
+def factory_string(index_type, num_vectors, dim):
+    '''
+    Returns the faiss.index_factory description for `index_type`, sized for `num_vectors` vectors.
+    Falls back to an exact flat index when there are too few vectors to train the requested type.
+    '''
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Choose one of: {', '.join(INDEX_TYPES)}.")
+    if index_type == 'flat':
+        return 'Flat'
+    if index_type == 'hnsw':
+        return f'HNSW{HNSW_NEIGHBORS}'
+
+    nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+    if index_type == 'ivf':
+        if nlist < 2:
+            print(f"WARNING: {num_vectors} vectors are too few to train an IVF index; using a flat index.")
+            return 'Flat'
+        return f'IVF{nlist},Flat'
+
+    nbits = pq_bits(num_vectors)
+    if nlist < 2 or num_vectors < 2 ** nbits * MIN_POINTS_PER_CENTROID or dim % PQ_SUBQUANTIZERS:
+        print(f"WARNING: Cannot train an IVF-PQ index on {num_vectors} {dim}-d vectors; using a flat index.")
+        return 'Flat'
+    pq = f'IVF{nlist},PQ{PQ_SUBQUANTIZERS}x{nbits}'
+    # OPQ learns a rotation that balances variance across subquantizers: better recall, much slower training
+    return f'OPQ{PQ_SUBQUANTIZERS},{pq}' if index_type == 'ivfopq' else pq
+
+
+def build_faiss_index(index_type, vectors, ids=None):
+    '''
+    Creates, trains and fills a FAISS index of the given type with `vectors` (L2 metric), stored under
+    `ids` (by default their positions). IVF indexes keep IDs natively; other types are wrapped in an IDMap.
+    '''
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ids = np.arange(len(vectors), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+    description = factory_string(index_type, len(vectors), vectors.shape[1])
+    if not description.startswith(('IVF', 'OPQ')):
+        description = 'IDMap2,' + description
+    index = faiss.index_factory(vectors.shape[1], description, faiss.METRIC_L2)
+    if not index.is_trained:
+        opq = None
+        if description.startswith('OPQ'):
+            # OPQ trains its rotation with 8-bit codebooks of its own unless given a quantizer; use the
+            # index's code size, or small corpora are clustered into 256 centroids per subquantizer
+            opq = faiss.downcast_VectorTransform(index.chain.at(0))
+            training_pq = faiss.ProductQuantizer(vectors.shape[1], PQ_SUBQUANTIZERS, pq_bits(len(vectors)))
+            opq.pq = training_pq
+        index.train(vectors)
+        if opq is not None:
+            # Only used for training; not left pointing at a quantizer Python frees
+            opq.pq = None
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def set_search_params(index, params):
+    '''
+    Applies search-time parameters such as {'nprobe': 32} or {'efSearch': 128} to the index.
+    '''
+    parameter_space = faiss.ParameterSpace()
+    for name, value in (params or {}).items():
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            print(f"WARNING: Search parameter '{name}' does not apply to this index; ignoring it.")
+
+
+def supports_removal(index_type):
+    '''
+    HNSW graphs cannot drop vectors, so an HNSW index is rebuilt when chunks are removed.
+    '''
+    return index_type != 'hnsw'
+
+
+def mmap_read_flags(path):
+    '''
+    faiss.read_index flags that memory-map the index saved at `path` read-only instead of reading it
+    into RAM: the inverted lists of IVF indexes (also IVF-PQ and OPQ) are mapped as OnDiskInvertedLists,
+    and the vectors of flat and HNSW indexes with IO_FLAG_MMAP_IFC (an HNSW graph itself is still read).
+    Faiss cannot combine the two in one read, so the header of the file decides.
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(4)
+    # IVF indexes are written as 'Iw..'; OPQ wraps one in a pre-transform ('IxPT')
+    ivf = header.startswith(b'Iw') or header == b'IxPT'
+    return (faiss.IO_FLAG_MMAP if ivf else faiss.IO_FLAG_MMAP_IFC) | faiss.IO_FLAG_READ_ONLY
+
+
+def filtered_search_params(index, selector, fraction=1.0):
+    '''
+    Returns SearchParameters that restrict a search of `index` to the IDs in `selector`, which
+    holds about `fraction` of its vectors. Per-call parameters replace the index's own, so its
+    nprobe/efSearch are carried over, scaled by 1 / fraction: the search then visits as many
+    matching vectors as an unfiltered one would, instead of running out of them.
+    '''
+    scale = 1.0 / max(fraction, 1e-6)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=min(ivf.nlist, math.ceil(ivf.nprobe * scale)))
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=min(max(index.ntotal, 1), math.ceil(inner.hnsw.efSearch * scale)))
+    return faiss.SearchParameters(sel=selector)
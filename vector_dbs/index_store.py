@@ -0,0 +1,356 @@
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from vector_dbs.bm25 import BM25_DIRNAME, BM25Index, boosted_text
+from vector_dbs.index_factory import filtered_search_params, mmap_read_flags
+from vector_dbs.partitions import DEFAULT_ROUTE_CHAPTERS, ChapterRouter, Partitions
+from utils.metrics import METRICS
+
+INDEX_FILENAME = "index.faiss"
+DOCSTORE_FILENAME = "docstore.sqlite"
+# Bumped whenever the on-disk layout changes, so create_db rebuilds indexes saved in an older format
+STORE_FORMAT = "faiss-sqlite-3"
+RETRIEVAL_MODES = ('dense', 'hybrid')
+# Constant of reciprocal rank fusion, and how deep each ranking is read before fusing
+RRF_K = 60
+RRF_CANDIDATES = 20
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    '''
+    Fuses ranked ID lists by summing 1 / (rrf_k + rank) over the lists each ID appears in; returns the top `k` IDs.
+    '''
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[int(doc_id)] = scores.get(int(doc_id), 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+class ChunkDocstore:
+    '''
+    SQLite store of chunk texts and metadata, keyed by the chunk's FAISS ID.
+
+    Only the chunks a search returns are read, so opening the store costs nothing no matter
+    how large the corpus is. Readers get one connection per thread, so searches can run
+    on a thread pool.
+    '''
+
+    def __init__(self, path, readonly=True):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        if not readonly:
+            self._connection().executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    chunk_id TEXT NOT NULL UNIQUE,
+                    text TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+            """)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def fetch(self, ids):
+        '''
+        Returns {faiss id: Document} for the given IDs.
+        '''
+        ids = [int(i) for i in set(ids)]
+        documents = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self._connection().execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", batch).fetchall()
+            documents.update((row_id, Document(page_content=text, metadata=json.loads(metadata))) for row_id, text, metadata in rows)
+        return documents
+
+    def faiss_ids(self, chunk_ids):
+        '''
+        Returns the FAISS IDs of the given chunk IDs, skipping unknown ones.
+        '''
+        ids = []
+        for start in range(0, len(chunk_ids), 500):
+            batch = list(chunk_ids[start:start + 500])
+            placeholders = ','.join('?' * len(batch))
+            ids.extend(row[0] for row in self._connection().execute(
+                f"SELECT id FROM chunks WHERE chunk_id IN ({placeholders})", batch))
+        return ids
+
+    def iter_bm25_texts(self):
+        '''
+        Yields (FAISS ID, text the BM25 index sees) for every chunk, keyphrases included (see `boosted_text`).
+        '''
+        for row_id, text, metadata in self._connection().execute("SELECT id, text, metadata FROM chunks ORDER BY id"):
+            yield row_id, boosted_text(text, json.loads(metadata).get("keywords"))
+
+    def iter_metadata(self):
+        '''
+        Yields (FAISS ID, chunk metadata) for every chunk.
+        '''
+        for row_id, metadata in self._connection().execute("SELECT id, metadata FROM chunks ORDER BY id"):
+            yield row_id, json.loads(metadata)
+
+    def next_id(self):
+        return self._connection().execute("SELECT COALESCE(MAX(id) + 1, 0) FROM chunks").fetchone()[0]
+
+    def add(self, ids, documents):
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chunks (id, chunk_id, text, metadata) VALUES (?, ?, ?, ?)",
+                [(int(i), doc.metadata['chunk_id'], doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+                 for i, doc in zip(ids, documents)],
+            )
+
+    def delete(self, ids):
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM chunks WHERE id = ?", [(int(i),) for i in ids])
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class ChunkIndex:
+    '''
+    A FAISS index plus the SQLite docstore of the chunks it holds, stored side by side in one directory
+    together with a BM25 index of the same chunks.
+
+    Unlike LangChain's FAISS store it needs no pickle: the index is written with faiss.write_index
+    and loaded memory-mapped, so the vectors are paged in by the OS on demand and shared between
+    processes serving the same index, and chunk texts are only read for search results.
+
+    With `hybrid=True`, queries are searched in the BM25 index (on a helper thread, while they
+    are embedded) as well as in FAISS, and the two rankings are merged with reciprocal rank fusion,
+    so exact drug and disease names are found even when the embeddings miss them.
+
+    Searches can be restricted to chapters or topics (see `Partitions`), either explicitly or by
+    a `ChapterRouter` that picks the likely chapters of each question from its embedding.
+    With a `reranker`, the first-stage candidates are reordered by a cross-encoder before the top ones are returned.
+    '''
+
+    def __init__(self, index, docstore, embeddings=None, bm25=None, partitions=None):
+        self.index = index
+        self.docstore = docstore
+        self.embeddings = embeddings
+        self.bm25 = bm25
+        self.partitions = partitions
+        self.router = None
+        self.reranker = None
+        self.hybrid = False
+        self._lexical_executor = None
+
+    def set_retrieval(self, mode):
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}'. Choose one of: {', '.join(RETRIEVAL_MODES)}.")
+        if mode == 'hybrid' and self.bm25 is None:
+            print("WARNING: The index has no BM25 data (run create_db to add it); using dense retrieval only.")
+            mode = 'dense'
+        self.hybrid = mode == 'hybrid'
+
+    def set_router(self, num_chapters=DEFAULT_ROUTE_CHAPTERS):
+        '''
+        Restricts unfiltered questions to their `num_chapters` most likely chapters (0 turns routing off).
+        '''
+        if num_chapters and self.partitions is None:
+            print("WARNING: The index has no chapter partitions (run create_db to add them); searching all chapters.")
+            num_chapters = 0
+        self.router = ChapterRouter(self.partitions, self.embeddings, num_chapters) if num_chapters else None
+
+    def normalize_filters(self, filters):
+        '''
+        Validates a {"chapter": [...], "topic": [...]} filter; see `Partitions.normalize`.
+        '''
+        if not filters or not any(filters.values()):
+            return None
+        if self.partitions is None:
+            raise ValueError("The index has no chapter/topic partitions; run create_db to add them.")
+        return self.partitions.normalize(filters)
+
+    @classmethod
+    def create(cls, path, index, ids, documents, embeddings=None):
+        '''
+        Starts a new store in `path` around an index already filled with `ids`.
+        '''
+        os.makedirs(path, exist_ok=True)
+        docstore = ChunkDocstore(os.path.join(path, DOCSTORE_FILENAME), readonly=False)
+        docstore.add(ids, documents)
+        return cls(index, docstore, embeddings)
+
+    @classmethod
+    def load(cls, path, embeddings=None, mmap=True):
+        '''
+        Opens a saved store. With `mmap=True` the index is read-only and memory-mapped, so its vectors
+        (the inverted lists of IVF indexes) stay on disk; pass `mmap=False` to load an index that is going to be modified.
+        '''
+        index_path = os.path.join(path, INDEX_FILENAME)
+        docstore_path = os.path.join(path, DOCSTORE_FILENAME)
+        if not os.path.exists(index_path) or not os.path.exists(docstore_path):
+            raise FileNotFoundError(f"No index found at '{path}'.")
+        flags = mmap_read_flags(index_path) if mmap else 0
+        bm25_path = os.path.join(path, BM25_DIRNAME)
+        bm25 = BM25Index.load(bm25_path) if BM25Index.exists(bm25_path) else None
+        partitions = Partitions.load(path) if Partitions.exists(path) else None
+        return cls(faiss.read_index(index_path, flags), ChunkDocstore(docstore_path, readonly=mmap), embeddings, bm25, partitions)
+
+    def save(self, path):
+        '''
+        Writes the index next to its docstore in `path`, and rebuilds the BM25 index and the
+        chapter/topic partitions from the docstore.
+        '''
+        faiss.write_index(self.index, os.path.join(path, INDEX_FILENAME))
+        self.bm25 = BM25Index.build(self.docstore.iter_bm25_texts())
+        self.bm25.save(os.path.join(path, BM25_DIRNAME))
+        self.partitions = Partitions.build(self.docstore.iter_metadata())
+        self.partitions.save(path)
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def add(self, documents, vectors):
+        first_id = self.docstore.next_id()
+        ids = np.arange(first_id, first_id + len(documents), dtype=np.int64)
+        self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), ids)
+        self.docstore.add(ids, documents)
+
+    def delete(self, chunk_ids):
+        ids = self.docstore.faiss_ids(chunk_ids)
+        self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        self.docstore.delete(ids)
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        '''
+        Searches all vectors in one FAISS call and returns, for each, the `k` nearest chunks
+        as (Document, L2 distance) pairs, nearest first.
+        '''
+        distances, ids = self.index.search(np.asarray(embeddings, dtype=np.float32), k)
+        documents = self.docstore.fetch(i for row in ids for i in row if i != -1)
+        return [[(documents[i], float(distance)) for i, distance in zip(row_ids, row_distances) if i in documents]
+                for row_ids, row_distances in zip(ids, distances)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        return self.similarity_search_with_score_by_vectors([embedding], k)[0]
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k)
+
+    def similarity_search(self, query, k=4):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _lexical_search(self, queries, k, filters):
+        with METRICS.span("retrieval.lexical_search"):
+            return [self.bm25.search(query, k, self.partitions.allowed(f) if f else None)[0] for query, f in zip(queries, filters)]
+
+    def _dense_search(self, vectors, k, filters, routed):
+        '''
+        Returns the FAISS IDs of the `k` nearest chunks of each vector, one FAISS call per distinct filter.
+        A routed query whose chapters hold fewer than `k` matches is searched again without its filter
+        (which is then cleared in `filters`).
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ids = np.empty((len(vectors), k), dtype=np.int64)
+        groups = {}
+        for i, f in enumerate(filters):
+            groups.setdefault(Partitions.key(f), []).append(i)
+        for key, rows in groups.items():
+            params = None
+            if key:
+                f = filters[rows[0]]
+                params = filtered_search_params(self.index, self.partitions.selector(f), self.partitions.fraction(f))
+            ids[rows] = self.index.search(vectors[rows], k, params=params)[1]
+
+        unfilled = [i for i in range(len(vectors)) if routed[i] and (ids[i] == -1).any()]
+        if unfilled:
+            ids[unfilled] = self.index.search(vectors[unfilled], k)[1]
+            for i in unfilled:
+                filters[i] = None
+        return ids
+
+    def embed_and_search(self, queries, k=4, filters=None):
+        '''
+        Embeds all queries in one forward pass and searches them in one FAISS call (and in the
+        BM25 index, when hybrid). Returns (query vectors, list of retrieved documents per query).
+        Queries are embedded as-is, the same way `embed_query` does.
+
+        `filters` optionally gives a validated chapter/topic filter (or None) per query; queries
+        without one are routed to their likely chapters when a router is set.
+        '''
+        queries = list(queries)
+        filters = list(filters) if filters is not None else [None] * len(queries)
+        # With a reranker, the first stage returns its candidates instead of the final top k
+        first_k = max(k, self.reranker.candidates) if self.reranker is not None else k
+        depth = max(first_k, RRF_CANDIDATES) if self.hybrid else first_k
+        lexical = None
+        if self.hybrid:
+            if self._lexical_executor is None:
+                self._lexical_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bm25")
+            # Run in a copy of the caller's context, so the BM25 span joins the caller's trace
+            lexical = self._lexical_executor.submit(contextvars.copy_context().run, self._lexical_search, queries, depth,
+                                                    list(filters))
+
+        METRICS.count("retrieval_queries", len(queries))
+        with METRICS.span("retrieval.embed"):
+            vectors = self.embeddings.embed_documents(queries)
+        routed = [False] * len(queries)
+        if self.router is not None and None in filters:
+            with METRICS.span("retrieval.route"):
+                for i, route in enumerate(self.router.route(vectors)):
+                    if filters[i] is None and route is not None:
+                        filters[i], routed[i] = route, True
+            METRICS.count("retrieval_routed_queries", sum(routed))
+
+        with METRICS.span("retrieval.dense_search"):
+            dense_ids = self._dense_search(vectors, depth, filters, routed)
+        if lexical is None:
+            ranked = [row[row != -1] for row in dense_ids]
+        else:
+            # Includes waiting for the BM25 search, when it takes longer than embedding and the dense search
+            with METRICS.span("retrieval.fuse"):
+                ranked = []
+                for row, lexical_ids, f, was_routed in zip(dense_ids, lexical.result(), filters, routed):
+                    if was_routed and f is not None:
+                        lexical_ids = lexical_ids[self.partitions.allowed(f)[lexical_ids]]
+                    ranked.append(reciprocal_rank_fusion([row[row != -1], lexical_ids], first_k))
+        with METRICS.span("retrieval.fetch"):
+            documents = self.docstore.fetch(int(i) for ids in ranked for i in ids)
+        results = [[documents[int(i)] for i in ids if int(i) in documents] for ids in ranked]
+        if self.reranker is not None:
+            with METRICS.span("retrieval.rerank"):
+                results = self.reranker.rerank(queries, results, k)
+        return vectors, results
+
+    def similarity_search_batch(self, queries, k=4):
+        return self.embed_and_search(queries, k)[1]
+
+    def close(self):
+        self.docstore.close()
+        if self.reranker is not None:
+            self.reranker.close()
+        if self._lexical_executor is not None:
+            self._lexical_executor.shutdown()
+            self._lexical_executor = None
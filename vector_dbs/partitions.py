@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import faiss
+import numpy as np
+from vector_dbs.chunking import PASSAGE_PREFIX
+
+PARTITIONS_FILENAME = "partitions.json"
+PARTITION_FIELDS = ('chapter', 'topic')
+DEFAULT_ROUTE_CHAPTERS = 2
+# Selector bitmaps are cached per distinct filter; this bounds how many are kept
+MAX_CACHED_SELECTORS = 256
+
+
+class Partitions:
+    '''
+    FAISS IDs of the chunks of each chapter and topic, written next to the index when it is saved,
+    and the ID-selector bitmaps that restrict a FAISS search to them.
+
+    Filters are dicts such as {"chapter": ["Digestive Disorders"], "topic": [...]}: a chunk matches
+    when it has one of the listed values of every given field. The filter is applied inside FAISS,
+    so a search restricted to one chapter only computes distances to that chapter's vectors
+    (flat and HNSW indexes) or skips the other chapters' vectors in the lists it probes (IVF).
+    '''
+
+    def __init__(self, ids_by_field, topics_by_chapter, size):
+        self.ids_by_field = {field: {value: np.asarray(ids, dtype=np.int64) for value, ids in values.items()}
+                             for field, values in ids_by_field.items()}
+        self.topics_by_chapter = topics_by_chapter
+        # One past the largest FAISS ID, i.e. the length of the masks
+        self.size = size
+        self._selectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, chunks):
+        '''
+        Builds the partitions from (FAISS ID, chunk metadata) pairs.
+        '''
+        ids_by_field = {field: {} for field in PARTITION_FIELDS}
+        topics_by_chapter = {}
+        size = 0
+        for doc_id, metadata in chunks:
+            size = max(size, doc_id + 1)
+            # A chunk that near-duplicates others (see vector_dbs/dedup.py) belongs to all their chapters and topics
+            sources = [metadata] + (metadata.get('sources') or [])
+            for field in PARTITION_FIELDS:
+                for value in dict.fromkeys(source.get(field) for source in sources):
+                    if value:
+                        ids_by_field[field].setdefault(value, []).append(doc_id)
+            for source in sources:
+                if source.get('chapter') and source.get('topic'):
+                    topics = topics_by_chapter.setdefault(source['chapter'], [])
+                    if source['topic'] not in topics:
+                        topics.append(source['topic'])
+        return cls(ids_by_field, topics_by_chapter, size)
+
+    def save(self, path):
+        payload = {
+            "ids": {field: {value: ids.tolist() for value, ids in values.items()} for field, values in self.ids_by_field.items()},
+            "topics_by_chapter": self.topics_by_chapter,
+            "size": self.size,
+        }
+        with open(os.path.join(path, PARTITIONS_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, PARTITIONS_FILENAME), 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+        return cls(payload["ids"], payload["topics_by_chapter"], payload["size"])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, PARTITIONS_FILENAME))
+
+    def values(self, field):
+        return sorted(self.ids_by_field.get(field, {}))
+
+    def normalize(self, filters):
+        '''
+        Validates a filter and returns it with sorted, de-duplicated values, or None for an empty filter.
+        Raises ValueError for unknown fields or values.
+        '''
+        normalized = {}
+        for field, values in (filters or {}).items():
+            if field not in PARTITION_FIELDS:
+                raise ValueError(f"Cannot filter by '{field}'. Choose one of: {', '.join(PARTITION_FIELDS)}.")
+            values = [values] if isinstance(values, str) else list(values or [])
+            for value in values:
+                if value not in self.ids_by_field[field]:
+                    raise ValueError(f"Unknown {field} '{value}'.")
+            if values:
+                normalized[field] = sorted(set(values))
+        return normalized or None
+
+    @staticmethod
+    def key(filters):
+        return tuple((field, tuple(values)) for field, values in sorted((filters or {}).items()))
+
+    def mask(self, filters):
+        '''
+        Boolean array, indexed by FAISS ID, of the chunks matching `filters`.
+        '''
+        mask = np.ones(self.size, dtype=bool)
+        for field, values in (filters or {}).items():
+            field_mask = np.zeros(self.size, dtype=bool)
+            for value in values:
+                field_mask[self.ids_by_field[field][value]] = True
+            mask &= field_mask
+        return mask
+
+    def _entry(self, filters):
+        key = self.key(filters)
+        with self._lock:
+            if key in self._selectors:
+                self._selectors.move_to_end(key)
+                return self._selectors[key]
+        mask = self.mask(filters)
+        # FAISS reads bit (id & 7) of byte (id >> 3), i.e. little bit order; the array must outlive the selector
+        bits = np.packbits(mask, bitorder='little')
+        entry = (faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bits)), mask, bits)
+        with self._lock:
+            self._selectors[key] = entry
+            while len(self._selectors) > MAX_CACHED_SELECTORS:
+                self._selectors.popitem(last=False)
+        return entry
+
+    def selector(self, filters):
+        '''
+        Returns the faiss.IDSelectorBitmap of the chunks matching `filters`, cached per filter.
+        '''
+        return self._entry(filters)[0]
+
+    def allowed(self, filters):
+        '''
+        Cached `mask` of `filters`.
+        '''
+        return self._entry(filters)[1]
+
+    def fraction(self, filters):
+        '''
+        Share of all chunks that match `filters`.
+        '''
+        mask = self.allowed(filters)
+        return float(mask.sum()) / max(len(mask), 1)
+
+
+class ChapterRouter:
+    '''
+    Picks the chapters a question most likely belongs to, by comparing its embedding with
+    embeddings of the "chapter: topic" titles of the manual. The titles are embedded on first
+    use (and kept in the embedding cache), so routing costs one small matrix product per question.
+    '''
+
+    def __init__(self, partitions, embeddings, num_chapters=DEFAULT_ROUTE_CHAPTERS):
+        self.partitions = partitions
+        self.embeddings = embeddings
+        self.num_chapters = num_chapters
+        self._chapters = None
+        self._label_chapters = None
+        self._label_vectors = None
+        self._lock = threading.Lock()
+
+    def _labels(self):
+        with self._lock:
+            if self._label_vectors is None:
+                chapters = sorted(self.partitions.topics_by_chapter)
+                labels = [(c, f"{PASSAGE_PREFIX}{c}: {topic}") for c in chapters for topic in self.partitions.topics_by_chapter[c]]
+                vectors = np.asarray(self.embeddings.embed_documents([text for _, text in labels]), dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+                self._chapters = chapters
+                self._label_chapters = np.array([chapters.index(c) for c, _ in labels])
+                self._label_vectors = vectors
+        return self._chapters, self._label_chapters, self._label_vectors
+
+    def route(self, vectors):
+        '''
+        Returns a chapter filter ({"chapter": [...]}) for each query vector.
+        '''
+        chapters, label_chapters, label_vectors = self._labels()
+        if not chapters:
+            return [None] * len(vectors)
+        similarities = np.asarray(vectors, dtype=np.float32) @ label_vectors.T
+        # A chapter scores as well as its best-matching topic title
+        scores = np.full((len(similarities), len(chapters)), -np.inf, dtype=np.float32)
+        np.maximum.at(scores.T, label_chapters, similarities.T)
+        best = np.argsort(-scores, axis=1)[:, :self.num_chapters]
+        return [{"chapter": sorted(chapters[i] for i in row)} for row in best]
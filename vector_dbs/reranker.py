@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from vector_dbs.chunking import PASSAGE_PREFIX
+from vector_dbs.embedding_cache import text_key
+from utils.metrics import METRICS
+
+RERANK_MODEL = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+RERANK_CANDIDATES = 20
+RERANK_BUDGET_MS = 200.0
+RERANK_KEEP = 2
+RERANK_BATCH_SIZE = 32
+MAX_CACHED_SCORES = 100_000
+
+
+class CrossEncoderReranker:
+    '''
+    Reorders the first-stage candidates of each question with a small multilingual cross-encoder
+    (sentence-transformers, on CPU) and keeps the best `keep`.
+
+    All (question, chunk) pairs of a batch of questions are scored in one batched call. Scores are
+    cached per (question hash, chunk ID), so repeated questions cost nothing. Reranking gets at most
+    `budget_ms` per call: when the model does not finish in time, or is still busy with an earlier
+    call, the first-stage order is used instead (the late scores are still cached). Either way each
+    query gets the same number of chunks, so the prompt size does not depend on timing.
+    '''
+
+    def __init__(self, model_name=RERANK_MODEL, candidates=RERANK_CANDIDATES, budget_ms=RERANK_BUDGET_MS, keep=RERANK_KEEP,
+                 batch_size=RERANK_BATCH_SIZE, max_cached_scores=MAX_CACHED_SCORES):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.model_name = model_name
+        self.candidates = candidates
+        self.budget = budget_ms / 1000
+        self.keep = keep
+        self.batch_size = batch_size
+        self.max_cached_scores = max_cached_scores
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        self._busy = threading.Semaphore(1)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+        self.reranked = 0
+        self.fallbacks = 0
+        self.cache_hits = 0
+        self.scored_pairs = 0
+        self.rerank_seconds = 0.0
+
+    def _cached(self, key):
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def _predict(self, keys, pairs):
+        try:
+            scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            with self._lock:
+                for key, score in zip(keys, scores):
+                    self._scores[key] = float(score)
+                while len(self._scores) > self.max_cached_scores:
+                    self._scores.popitem(last=False)
+            self.scored_pairs += len(pairs)
+        finally:
+            self._busy.release()
+
+    def rerank(self, queries, candidates, k):
+        '''
+        Returns the best min(`k`, `keep`) candidate documents of each query: the top ones by
+        cross-encoder score, or the first ones in their original order when reranking does not fit
+        the budget or fails.
+        '''
+        start = time.perf_counter()
+        top = min(k, self.keep)
+        query_keys = [text_key(query.casefold()) for query in queries]
+        keys, pairs, pending = [], [], set()
+        for query, query_key, documents in zip(queries, query_keys, candidates):
+            for doc in documents:
+                key = (query_key, doc.metadata["chunk_id"])
+                if key not in pending and self._cached(key) is None:
+                    pending.add(key)
+                    keys.append(key)
+                    text = doc.page_content
+                    pairs.append((query, text[len(PASSAGE_PREFIX):] if text.startswith(PASSAGE_PREFIX) else text))
+        self.cache_hits += sum(len(documents) for documents in candidates) - len(keys)
+
+        if pairs:
+            if not self._busy.acquire(blocking=False):
+                self.fallbacks += 1
+                METRICS.count("rerank_fallbacks", reason="busy")
+                return [documents[:top] for documents in candidates]
+            future = self._executor.submit(self._predict, keys, pairs)
+            try:
+                future.result(timeout=max(0.0, self.budget - (time.perf_counter() - start)))
+            except TimeoutError:
+                self.fallbacks += 1
+                METRICS.count("rerank_fallbacks", reason="budget")
+                return [documents[:top] for documents in candidates]
+            except Exception as e:
+                print(f"WARNING: Reranking failed ({e}); keeping the retrieval order.")
+                self.fallbacks += 1
+                METRICS.count("rerank_fallbacks", reason="error")
+                return [documents[:top] for documents in candidates]
+
+        reranked = []
+        for query_key, documents in zip(query_keys, candidates):
+            scores = [self._cached((query_key, doc.metadata["chunk_id"])) for doc in documents]
+            order = sorted(range(len(documents)), key=lambda i: scores[i] if scores[i] is not None else float('-inf'), reverse=True)
+            reranked.append([documents[i] for i in order[:top]])
+        self.reranked += len(queries)
+        self.rerank_seconds += time.perf_counter() - start
+        return reranked
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "reranked": self.reranked,
+            "fallbacks": self.fallbacks,
+            "cached_scores": len(self._scores),
+            "cache_hits": self.cache_hits,
+            "scored_pairs": self.scored_pairs,
+            "mean_rerank_ms": self.rerank_seconds / self.reranked * 1000 if self.reranked else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)